@@ -3,18 +3,45 @@ from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from sqlalchemy.orm import Session
-from typing import Annotated
+from typing import Annotated, Optional
 from dotenv import load_dotenv
 import os
 
 load_dotenv()
 SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
-ALGORITHM = os.getenv("ALGORITHM")
+ALGORITHM = os.getenv("ALGORITHM") or "HS256"
+
+# Supabase asymmetric signing keys; verified against the project's JWKS
+ASYMMETRIC_ALGORITHMS = {"RS256", "ES256"}
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")  # Dummy, since auth is in frontend
 
 from database import get_db  # Import get_db
 import schemas, crud  # Import schemas and crud
+import jwks
+import cache
+
+jwks_cache = jwks.from_env()
+if jwks_cache is not None:
+    # Before serving: get_key never fetches in the foreground
+    jwks_cache.refresh()
+
+def decode_token(token: str, audience: Optional[str] = None) -> dict:
+    """
+    Verify a Supabase JWT and return its claims. Tokens signed with an
+    asymmetric key are checked against the cached JWKS by `kid`; everything
+    else uses the shared HS256 secret. Raises JWTError if verification fails.
+    """
+    header = jwt.get_unverified_header(token)
+    alg = header.get("alg")
+    if alg in ASYMMETRIC_ALGORITHMS:
+        if jwks_cache is None:
+            raise JWTError("Token is signed with an asymmetric key but no JWKS is configured")
+        key = jwks_cache.get_key(header.get("kid"))
+        if key is None:
+            raise JWTError("Unknown signing key")
+        return jwt.decode(token, key, algorithms=[alg], audience=audience)
+    return jwt.decode(token, SUPABASE_JWT_SECRET, algorithms=[ALGORITHM], audience=audience)
 
 async def get_current_user(
     token: Annotated[str, Depends(oauth2_scheme)],
@@ -26,7 +53,7 @@ async def get_current_user(
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SUPABASE_JWT_SECRET, algorithms=[ALGORITHM])
+        payload = decode_token(token, audience="authenticated")
         user_id: str = payload.get("sub")
         email: str = payload.get("email")
         if user_id is None:
@@ -34,9 +61,22 @@ async def get_current_user(
     except JWTError as e:
         print("JWT Error:", e)
         raise credentials_exception
-    user = crud.get_user_by_id(db, user_id)
+    return get_user_principal(db, user_id, credentials_exception)
+
+def get_user_principal(db: Session, user_id: str, credentials_exception: HTTPException):
+    """
+    Cached snapshot of the user's profile. crud.create_user/update_user drop the
+    entry, so a change to `disabled` takes effect on the next request.
+    """
+    user = cache.principals.get(user_id)
     if user is None:
-        raise credentials_exception
+        db_user = crud.get_user_by_id(db, user_id)
+        if db_user is None:
+            raise credentials_exception
+        user = schemas.UserResponse.model_validate(db_user)
+        cache.principals.set(user_id, user)
+    if user.disabled:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="User account is disabled")
     return user
 
 
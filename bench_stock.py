@@ -0,0 +1,97 @@
+# bench_stock.py
+"""
+Reservation throughput on a single SKU, with and without stock shards.
+
+Every worker thread runs the stock step of add-to-cart/checkout in a loop:
+reserve one unit with crud.reserve_stock, then commit. --hold-ms keeps the
+transaction open that much longer after the reservation, standing in for the
+rest of a real checkout (cart rows, order rows, network round trips), which
+is what makes a single hot row lock the bottleneck.
+
+Point DATABASE_URL at a scratch Postgres database; SQLite serializes all
+writers on one file lock, so it shows no scaling either way. DB_POOL_SIZE
+must cover the largest worker count.
+
+    DATABASE_URL=postgresql://... DB_POOL_SIZE=16 python bench_stock.py --workers 1,2,4,8,16
+"""
+import argparse
+import threading
+import time
+
+import crud
+import database
+import models
+
+BENCH_PRODUCT_ID = "bench-stock-sku"
+BENCH_SIZE = "M"
+
+
+def setup(shards: int):
+    models.Base.metadata.create_all(bind=database.engine)
+    with database.SessionLocal() as db:
+        db.query(models.Product).filter(models.Product.id == BENCH_PRODUCT_ID).delete()
+        db.add(models.Product(
+            id=BENCH_PRODUCT_ID, name="Benchmark SKU", image="", collection="bench", category="bench",
+            XS_price=1, S_price=1, M_price=1, L_price=1, XL_price=1, XXL_price=1,
+            XS_stock=0, S_stock=0, M_stock=10_000_000, L_stock=0, XL_stock=0, XXL_stock=0,
+        ))
+        db.commit()
+        if shards > 1:
+            crud.shard_sku(db, BENCH_PRODUCT_ID, BENCH_SIZE, shards)
+
+
+def teardown():
+    with database.SessionLocal() as db:
+        # Shards and ledger rows go with it via ON DELETE CASCADE
+        db.query(models.Product).filter(models.Product.id == BENCH_PRODUCT_ID).delete()
+        db.commit()
+
+
+def run(workers: int, seconds: float, hold: float) -> float:
+    stop = threading.Event()
+    counts = [0] * workers
+
+    def worker(i):
+        with database.SessionLocal() as db:
+            while not stop.is_set():
+                if not crud.reserve_stock(db, BENCH_PRODUCT_ID, BENCH_SIZE, 1, "bench"):
+                    raise RuntimeError("Benchmark SKU ran out of stock")
+                if hold:
+                    time.sleep(hold)
+                db.commit()
+                counts[i] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(workers)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+    return sum(counts) / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", default="1,2,4,8,16", help="comma-separated worker counts")
+    parser.add_argument("--shards", default="1,8", help="comma-separated shard counts (1 = unsharded)")
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--hold-ms", type=float, default=5)
+    args = parser.parse_args()
+
+    worker_counts = [int(w) for w in args.workers.split(",")]
+    shard_counts = [int(s) for s in args.shards.split(",")]
+
+    print(f"{'shards':>6} {'workers':>7} {'reservations/s':>15}")
+    try:
+        for shards in shard_counts:
+            for workers in worker_counts:
+                setup(shards)
+                rate = run(workers, args.seconds, args.hold_ms / 1000)
+                print(f"{shards:>6} {workers:>7} {rate:>15.1f}")
+    finally:
+        teardown()
+
+
+if __name__ == "__main__":
+    main()
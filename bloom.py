@@ -0,0 +1,103 @@
+# bloom.py
+import hashlib
+import logging
+import math
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class BloomFilter:
+    """
+    Fixed-size Bloom filter. `might_contain` never returns False for an added
+    item; it returns True for a missing one with probability ~`error_rate`.
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        capacity = max(1, capacity)
+        self.size = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item: str):
+        # Double hashing: derive k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(item.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, item: str):
+        for pos in self._positions(item):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def might_contain(self, item: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class TakenNamesFilter:
+    """
+    Bloom filter of taken usernames and (lower-cased) emails, rebuilt from the
+    users table when older than `max_age` seconds so other workers' signups
+    are eventually seen.
+    """
+
+    def __init__(self, max_age: float = 600, error_rate: float = 0.01):
+        self.max_age = max_age
+        self.error_rate = error_rate
+        self._filter: Optional[BloomFilter] = None
+        self._built_at = 0.0
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+
+    @staticmethod
+    def _key(kind: str, value: str) -> str:
+        return f"{kind}:{value.lower() if kind == 'email' else value}"
+
+    def is_stale(self) -> bool:
+        return self._filter is None or time.monotonic() - self._built_at > self.max_age
+
+    def ensure_fresh(self, load: Callable[[], Tuple[List[str], List[str]]]):
+        """
+        If stale, rebuild from `load()` -> (usernames, emails) on a background
+        thread; `load` must open its own session. Never blocks the caller:
+        the current filter stays in use meanwhile, and before the first build
+        every name is reported as possibly taken (so callers ask the database).
+        """
+        if not self.is_stale() or not self._rebuild_lock.acquire(blocking=False):
+            return
+        threading.Thread(target=self._rebuild_from, args=(load,), name="taken-names-rebuild", daemon=True).start()
+
+    def _rebuild_from(self, load: Callable[[], Tuple[List[str], List[str]]]):
+        try:
+            usernames, emails = load()
+            self.rebuild(usernames, emails)
+        except Exception as e:
+            logger.error(f"Could not rebuild the taken names filter: {e}")
+        finally:
+            self._rebuild_lock.release()
+
+    def rebuild(self, usernames: List[str], emails: List[str]):
+        # Both usernames and emails go in; double it for signups until the next rebuild
+        capacity = max(10000, (len(usernames) + len(emails)) * 2)
+        new_filter = BloomFilter(capacity=capacity, error_rate=self.error_rate)
+        for username in usernames:
+            new_filter.add(self._key("username", username))
+        for email in emails:
+            new_filter.add(self._key("email", email))
+        with self._lock:
+            self._filter = new_filter
+            self._built_at = time.monotonic()
+
+    def add(self, kind: str, value: str):
+        with self._lock:
+            if self._filter is not None:
+                self._filter.add(self._key(kind, value))
+
+    def might_be_taken(self, kind: str, value: str) -> bool:
+        current = self._filter
+        if current is None:
+            return True
+        return current.might_contain(self._key(kind, value))
@@ -0,0 +1,102 @@
+# bulk_import.py
+import csv
+import json
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+# Columns holding JSON arrays; in CSV they may also be written as a|b|c
+LIST_FIELDS = ("images", "colors")
+
+
+class InvalidEncoding(ValueError):
+    """The body is not UTF-8; `line` is the 1-based line that failed to decode."""
+
+    def __init__(self, line: int):
+        super().__init__(f"Line {line} is not valid UTF-8")
+        self.line = line
+
+
+def _decode(line: bytes, line_number: int) -> str:
+    try:
+        return line.decode("utf-8").rstrip("\r")
+    except UnicodeDecodeError:
+        raise InvalidEncoding(line_number) from None
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Split a streamed request body into text lines without buffering all of it."""
+    pending = b""
+    line_number = 0
+    async for chunk in chunks:
+        pending += chunk
+        *lines, pending = pending.split(b"\n")
+        for line in lines:
+            line_number += 1
+            yield _decode(line, line_number)
+    if pending:
+        yield _decode(pending, line_number + 1)
+
+
+async def iter_ndjson(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, Optional[Dict], Optional[str]]]:
+    """Yields (row_number, row, error) for every non-blank line."""
+    row_number = 0
+    async for line in iter_lines(chunks):
+        if not line.strip():
+            continue
+        row_number += 1
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield row_number, None, f"Invalid JSON: {e}"
+            continue
+        if not isinstance(row, dict):
+            yield row_number, None, "Each line must be a JSON object"
+            continue
+        yield row_number, row, None
+
+
+def _csv_cell(field: str, value: str):
+    if value == "":
+        return None
+    if field in LIST_FIELDS:
+        if value.lstrip().startswith("["):
+            return json.loads(value)
+        return [part.strip() for part in value.split("|") if part.strip()]
+    return value
+
+
+async def iter_csv(chunks: AsyncIterator[bytes]) -> AsyncIterator[Tuple[int, Optional[Dict], Optional[str]]]:
+    """
+    Yields (row_number, row, error). The first record is the header. Quoted
+    cells may span lines; a record is complete once its quotes are balanced.
+    """
+    header = None
+    record = []
+    row_number = 0
+    async for line in iter_lines(chunks):
+        record.append(line)
+        text = "\n".join(record)
+        if text.count('"') % 2:
+            continue
+        record = []
+        if not text.strip():
+            continue
+
+        values = next(csv.reader([text]))
+        if header is None:
+            header = [name.strip() for name in values]
+            continue
+
+        row_number += 1
+        if len(values) != len(header):
+            yield row_number, None, f"Expected {len(header)} columns, got {len(values)}"
+            continue
+        try:
+            row = {field: _csv_cell(field, value) for field, value in zip(header, values)}
+        except json.JSONDecodeError as e:
+            yield row_number, None, f"Invalid JSON list: {e}"
+            continue
+        yield row_number, row, None
+
+    if record:
+        row_number += 1
+        yield row_number, None, "Unterminated quoted field"
@@ -0,0 +1,163 @@
+# cache.py
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, Optional
+
+import metrics
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    Thread-safe in-process cache with a per-entry TTL and LRU eviction once
+    `maxsize` entries are stored.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: float = 60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Bumped by every invalidation; see `set(..., generation=)`
+        self.generation = 0
+        # key -> generation of its last invalidation, oldest first, at most `maxsize`
+        self._invalidated_at: "OrderedDict[Hashable, int]" = OrderedDict()
+        # Loads that started before this generation are refused for every key
+        # (set by clear(), and raised when _invalidated_at drops old keys)
+        self._refuse_before = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None, generation: Optional[int] = None):
+        """
+        Pass the `generation` read before loading `value` to skip storing it
+        if `key` was invalidated (or the cache cleared) meanwhile, since the
+        value may predate that. Invalidations of other keys do not matter.
+        """
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            if generation is not None and (
+                generation < self._refuse_before or generation < self._invalidated_at.get(key, 0)
+            ):
+                return
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            self._data.pop(key, None)
+            self.generation += 1
+            self._invalidated_at[key] = self.generation
+            self._invalidated_at.move_to_end(key)
+            if len(self._invalidated_at) > self.maxsize:
+                # Forgetting a key's invalidation would accept loads that predate it
+                _, forgotten = self._invalidated_at.popitem(last=False)
+                self._refuse_before = max(self._refuse_before, forgotten)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.generation += 1
+            self._invalidated_at.clear()
+            self._refuse_before = self.generation
+
+    def __len__(self):
+        return len(self._data)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical loads: the first caller for a key runs
+    `fn`, everyone arriving while it runs waits for and shares its result (or
+    exception). Sync callers (threadpool endpoints) and async callers can
+    wait on the same load.
+    """
+
+    def __init__(self, name: str = "singleflight"):
+        self.name = name
+        self._calls: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def _claim(self, key: Hashable):
+        with self._lock:
+            future = self._calls.get(key)
+            if future is not None:
+                metrics.incr(f"{self.name}.coalesced")
+                return future, False
+            future = Future()
+            self._calls[key] = future
+            return future, True
+
+    def _run(self, key: Hashable, future: Future, fn: Callable[[], Any]):
+        try:
+            future.set_result(fn())
+        except BaseException as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        future, leader = self._claim(key)
+        if leader:
+            self._run(key, future, fn)
+        return future.result()
+
+    async def do_async(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """`fn` is blocking; the leader runs it in the default executor."""
+        future, leader = self._claim(key)
+        if leader:
+            await asyncio.get_running_loop().run_in_executor(None, self._run, key, future, fn)
+        return await asyncio.wrap_future(future)
+
+
+# -------------------------
+# SHARED CACHES
+# -------------------------
+# Authenticated user principals (schemas.UserResponse) keyed by user ID
+principals = TTLCache(
+    maxsize=int(os.getenv("USER_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("USER_CACHE_TTL_SECONDS", "60")),
+)
+
+# Catalog products (schemas.ProductResponse) keyed by product ID. crud drops
+# entries on every product, stock or review write; the TTL bounds staleness
+# from writes made by other instances.
+catalog = TTLCache(
+    maxsize=int(os.getenv("CATALOG_CACHE_SIZE", "5000")),
+    ttl=float(os.getenv("CATALOG_CACHE_TTL_SECONDS", "30")),
+)
+
+# Whole product lists (/products, per projection); cleared by product writes.
+# Cart stock movements leave them alone, so list stock can lag by the TTL.
+catalog_lists = TTLCache(
+    maxsize=32,
+    ttl=float(os.getenv("CATALOG_CACHE_TTL_SECONDS", "30")),
+)
+
+# Catalog loads in flight, so a cache miss under load runs one query
+catalog_loads = SingleFlight("catalog_loads")
+
+# Last good catalog responses, kept long after `catalog` entries expire and
+# never invalidated. Served (marked stale) only while the database is down.
+snapshots = TTLCache(
+    maxsize=int(os.getenv("CATALOG_SNAPSHOT_SIZE", "10000")),
+    ttl=float(os.getenv("CATALOG_SNAPSHOT_TTL_SECONDS", "86400")),
+)
@@ -0,0 +1,97 @@
+# circuit_breaker.py
+import logging
+import random
+import threading
+import time
+from typing import Callable
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling a dependency whose breaker is open."""
+
+    def __init__(self, retry_after: float):
+        super().__init__("Circuit breaker is open")
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """
+    Opens after `failure_threshold` consecutive failures. While open, callers
+    fail fast instead of piling onto the failing dependency, and a single
+    background thread runs `probe` with jittered exponential backoff. The first
+    successful probe closes the breaker, so only the probe touches the
+    dependency while it recovers.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        probe: Callable[[], None],
+        failure_threshold: int = 5,
+        probe_base_delay: float = 0.5,
+        probe_max_delay: float = 15,
+    ):
+        self.name = name
+        self.probe = probe
+        self.failure_threshold = failure_threshold
+        self.probe_base_delay = probe_base_delay
+        self.probe_max_delay = probe_max_delay
+        self.failures = 0
+        self.opened_at = None
+        self.next_probe_at = 0.0
+        self._lock = threading.Lock()
+        self._probe_thread = None
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def check(self):
+        """Raise CircuitOpen if calls should not be attempted right now."""
+        if self.opened_at is not None:
+            raise CircuitOpen(max(1.0, self.next_probe_at - time.monotonic()))
+
+    def record_success(self):
+        # Hot path: a plain store, no lock
+        if self.failures:
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.opened_at is not None or self.failures < self.failure_threshold:
+                return
+            self.opened_at = time.monotonic()
+            self.next_probe_at = self.opened_at + self.probe_base_delay
+            self._probe_thread = threading.Thread(target=self._probe_loop, name=f"{self.name}-probe", daemon=True)
+            self._probe_thread.start()
+        logger.error(f"Circuit breaker {self.name} opened after {self.failures} consecutive failures")
+        metrics.incr(f"{self.name}.opened")
+        metrics.set_gauge(f"{self.name}.open", 1)
+
+    def _probe_loop(self):
+        attempt = 0
+        while True:
+            # Full jitter, so instances that tripped together do not probe together
+            delay = random.uniform(0, min(self.probe_max_delay, self.probe_base_delay * 2 ** attempt))
+            self.next_probe_at = time.monotonic() + delay
+            time.sleep(delay)
+            try:
+                self.probe()
+            except Exception as e:
+                attempt += 1
+                metrics.incr(f"{self.name}.probe_failures")
+                logger.warning(f"Circuit breaker {self.name} probe failed: {e}")
+                continue
+            break
+
+        with self._lock:
+            downtime = time.monotonic() - self.opened_at
+            self.failures = 0
+            self.opened_at = None
+        logger.info(f"Circuit breaker {self.name} closed after {downtime:.1f}s")
+        metrics.set_gauge(f"{self.name}.open", 0)
@@ -1,11 +1,21 @@
 # crud.py
 from datetime import datetime
 from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import func, case, and_
+from sqlalchemy import func, case, and_, or_, update, select, insert, literal, text
 from datetime import date
 from typing import Optional, List
 import models, schemas
+import cache
+import metrics
+import invalidation
 import json
+import os
+import base64
+import random
+import time
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from fastapi import HTTPException
 from datetime import datetime, timedelta
 
@@ -19,7 +29,17 @@ def get_user_by_username(db: Session, username: str):
     return db.query(models.User).filter(models.User.username == username).first()
 
 def get_user_by_email(db: Session, email: str):
-    return db.query(models.User).filter(models.User.email == email).first()
+    return db.query(models.User).filter(func.lower(models.User.email) == email.lower()).first()
+
+def is_username_taken(db: Session, username: str) -> bool:
+    return db.query(models.User.id).filter(models.User.username == username).first() is not None
+
+def is_email_taken(db: Session, email: str) -> bool:
+    return db.query(models.User.id).filter(func.lower(models.User.email) == email.lower()).first() is not None
+
+def get_all_usernames_and_emails(db: Session):
+    rows = db.query(models.User.username, models.User.email).all()
+    return [r.username for r in rows], [r.email for r in rows]
 
 def get_all_users(db: Session):
     return db.query(models.User).all()
@@ -38,6 +58,7 @@ def create_user(db: Session, user: schemas.UserCreate, user_id: str):
         contact_number_2=user.contact_number_2
     )
     db.add(db_user)
+    invalidation.invalidate(db, "principals", [user_id])
     db.commit()
     db.refresh(db_user)
     return db_user
@@ -59,6 +80,7 @@ def update_user(db: Session, db_user: models.User, updates: schemas.UserUpdate):
         db_user.city = updates.city
     if updates.contact_number_2 is not None:
         db_user.contact_number_2 = updates.contact_number_2
+    invalidation.invalidate(db, "principals", [db_user.id])
     db.commit()
     db.refresh(db_user)
     return db_user
@@ -66,8 +88,9 @@ def update_user(db: Session, db_user: models.User, updates: schemas.UserUpdate):
 # -------------------------
 # PRODUCT FUNCTIONS
 # -------------------------
-def get_all_products_with_reviews(db: Session):
-    results = (
+def _product_query(db: Session):
+    """Product columns plus review count/average, one row per product once grouped."""
+    return (
         db.query(
             models.Product.id,
             models.Product.name,
@@ -85,129 +108,361 @@ def get_all_products_with_reviews(db: Session):
             models.Product.L_price,
             models.Product.XL_price,
             models.Product.XXL_price,
-            models.Product.XS_stock,
-            models.Product.S_stock,
-            models.Product.M_stock,
-            models.Product.L_stock,
-            models.Product.XL_stock,
-            models.Product.XXL_stock,
+            _stock_column("XS"),
+            _stock_column("S"),
+            _stock_column("M"),
+            _stock_column("L"),
+            _stock_column("XL"),
+            _stock_column("XXL"),
             models.Product.kids,
             models.Product.description,
+            models.Product.archived,
         )
         .outerjoin(models.Review, models.Product.id == models.Review.product_id)
+    )
+
+
+def _product_response(r):
+    images = json.loads(r.images) if r.images else None
+    colors = json.loads(r.colors) if r.colors else None
+
+    return schemas.ProductResponse(
+        id=r.id,
+        name=r.name,
+        image=r.image,
+        images=images,
+        collection=r.collection,
+        category=r.category,
+        discount=r.discount or 0,
+        colors=colors,
+        total_reviews=r.total_reviews,
+        average_rating=round(float(r.average_rating or 0), 2),
+        XS_price=r.XS_price,
+        S_price=r.S_price,
+        M_price=r.M_price,
+        L_price=r.L_price,
+        XL_price=r.XL_price,
+        XXL_price=r.XXL_price,
+        XS_stock=r.XS_stock,
+        S_stock=r.S_stock,
+        M_stock=r.M_stock,
+        L_stock=r.L_stock,
+        XL_stock=r.XL_stock,
+        XXL_stock=r.XXL_stock,
+        kids=r.kids,
+        description=r.description,
+        archived=r.archived,
+    )
+
+
+def _cache_product(product: schemas.ProductResponse, generation: int):
+    cache.catalog.set(product.id, product, generation=generation)
+    cache.snapshots.set(("product", product.id), (product, time.time()))
+
+
+def get_stale_product(product_id: str):
+    """Last good copy of a product and its age in seconds, or (None, None)."""
+    snapshot = cache.snapshots.get(("product", product_id))
+    if snapshot is None:
+        return None, None
+    product, stored_at = snapshot
+    return product, time.time() - stored_at
+
+
+def invalidate_products(db: Session, product_ids):
+    """
+    Drop the products (and all cached lists) from every process's catalog cache
+    when `db` commits.
+    """
+    invalidation.invalidate(db, "catalog", product_ids)
+    invalidation.invalidate(db, "catalog_lists", [None])
+
+
+def invalidate_stock(db: Session, product_ids):
+    """
+    For cart stock movements and shard rebalancing: drop only this process's
+    entries for the products when `db` commits. Clearing every list on each cart write would
+    keep the list cache empty, and broadcasting them would put a message on
+    every cart write, so lists and other processes lag by up to the TTL.
+    """
+    invalidation.invalidate(db, "catalog", product_ids, broadcast=False)
+
+
+def get_all_products_with_reviews(db: Session):
+    generation = cache.catalog.generation
+    results = (
+        _product_query(db)
+        .filter(models.Product.archived.is_(False))
         .group_by(models.Product.id)
         .all()
     )
 
     products = []
     for r in results:
-        images = json.loads(r.images) if r.images else None
-        colors = json.loads(r.colors) if r.colors else None
+        product = _product_response(r)
+        _cache_product(product, generation)
+        products.append(product)
+    return products
 
-        products.append(
-            schemas.ProductResponse(
-                id=r.id,
-                name=r.name,
-                image=r.image,
-                images=images,
-                collection=r.collection,
-                category=r.category,
-                discount=r.discount or 0,
-                colors=colors,
-                total_reviews=r.total_reviews,
-                average_rating=round(float(r.average_rating or 0), 2),
-                XS_price=r.XS_price,
-                S_price=r.S_price,
-                M_price=r.M_price,
-                L_price=r.L_price,
-                XL_price=r.XL_price,
-                XXL_price=r.XXL_price,
-                XS_stock=r.XS_stock,
-                S_stock=r.S_stock,
-                M_stock=r.M_stock,
-                L_stock=r.L_stock,
-                XL_stock=r.XL_stock,
-                XXL_stock=r.XXL_stock,
-                kids=r.kids,
-                description=r.description,
-            )
+
+def _cached_list(key, load):
+    """A cached product list, loaded once for all concurrent callers on a miss."""
+    products = cache.catalog_lists.get(key)
+    if products is not None:
+        return products
+
+    def load_and_cache():
+        generation = cache.catalog_lists.generation
+        products = load()
+        cache.catalog_lists.set(key, products, generation=generation)
+        return products
+
+    return cache.catalog_loads.do(key, load_and_cache)
+
+
+def get_all_products_cached(db: Session):
+    return _cached_list(("products", None), lambda: get_all_products_with_reviews(db))
+
+
+def get_products_projection_cached(db: Session, fields):
+    return _cached_list(("products", fields), lambda: get_products_projection(db, fields))
+
+
+def get_product_cached(db: Session, product_id: str):
+    """get_product_with_reviews through cache.catalog; concurrent misses share one query."""
+    product = cache.catalog.get(product_id)
+    if product is not None:
+        return product
+    return cache.catalog_loads.do(("product", product_id), lambda: get_product_with_reviews(db, product_id))
+
+
+def get_products_by_ids(db: Session, product_ids: List[str]):
+    """
+    ProductResponse for each requested ID in request order, None where the
+    product does not exist or is archived. Cached products come from
+    cache.catalog; the rest are loaded in one query and cached.
+    """
+    generation = cache.catalog.generation
+    found = {}
+    missing = []
+    for product_id in dict.fromkeys(product_ids):
+        product = cache.catalog.get(product_id)
+        if product is None:
+            missing.append(product_id)
+        else:
+            found[product_id] = product
+
+    if missing:
+        results = (
+            _product_query(db)
+            .filter(models.Product.id.in_(missing), models.Product.archived.is_(False))
+            .group_by(models.Product.id)
+            .all()
         )
-    return products
+        for r in results:
+            product = _product_response(r)
+            _cache_product(product, generation)
+            found[product.id] = product
+
+    return [found.get(product_id) for product_id in product_ids]
+
+
+# -------------------------
+# PRODUCT PROJECTIONS (?fields= / ?view=card)
+# -------------------------
+PRODUCT_VIEWS = {
+    "card": ("id", "name", "image", "discount", "min_price", "average_rating", "total_reviews"),
+}
+PRICE_FIELDS = ("XS_price", "S_price", "M_price", "L_price", "XL_price", "XXL_price")
+REVIEW_FIELDS = ("total_reviews", "average_rating")
+JSON_FIELDS = ("images", "colors")
+PROJECTABLE_FIELDS = set(schemas.ProductResponse.model_fields) | {"min_price"}
+
+
+def resolve_product_fields(fields: Optional[str], view: Optional[str]):
+    """
+    Field names for a projection request, or None for the full ProductResponse.
+    `id` is always included.
+    """
+    if view is not None:
+        if view not in PRODUCT_VIEWS:
+            raise HTTPException(status_code=400, detail=f"Unknown view: {view}")
+        return PRODUCT_VIEWS[view]
+    if fields is None:
+        return None
+
+    requested = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in requested if f not in PROJECTABLE_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)}")
+    return tuple(dict.fromkeys(["id"] + requested))
+
+
+def _min_price_column(db: Session):
+    columns = [getattr(models.Product, f) for f in PRICE_FIELDS]
+    if db.get_bind().dialect.name == "sqlite":
+        return func.min(*columns)  # multi-argument min() is scalar in SQLite
+    return func.least(*columns)
+
+
+def _projection_query(db: Session, fields):
+    """Selects only what `fields` needs; the review join only for rating fields."""
+    columns = []
+    for field in fields:
+        if field == "min_price":
+            columns.append(_min_price_column(db).label("min_price"))
+        elif field == "total_reviews":
+            columns.append(func.count(models.Review.id).label("total_reviews"))
+        elif field == "average_rating":
+            columns.append(func.coalesce(func.avg(models.Review.stars), 0).label("average_rating"))
+        elif field.endswith("_stock"):
+            columns.append(_stock_column(field[:-len("_stock")]))
+        else:
+            columns.append(getattr(models.Product, field))
+
+    query = db.query(*columns)
+    if any(f in REVIEW_FIELDS for f in fields):
+        query = (
+            query.select_from(models.Product)
+            .outerjoin(models.Review, models.Product.id == models.Review.product_id)
+            .group_by(models.Product.id)
+        )
+    return query
+
+
+def _projected_row(r, fields):
+    row = {}
+    for field in fields:
+        value = getattr(r, field)
+        if field in JSON_FIELDS:
+            value = json.loads(value) if value else None
+        elif field == "average_rating":
+            value = round(float(value or 0), 2)
+        elif field == "discount":
+            value = value or 0
+        row[field] = value
+    return row
+
+
+def project_product(product: schemas.ProductResponse, fields):
+    row = {}
+    for field in fields:
+        if field == "min_price":
+            row[field] = min(getattr(product, f) for f in PRICE_FIELDS)
+        else:
+            row[field] = getattr(product, field)
+    return row
+
+
+def get_products_projection(db: Session, fields):
+    """Non-archived products as dicts holding only `fields`."""
+    results = (
+        _projection_query(db, fields)
+        .filter(models.Product.archived.is_(False))
+        .all()
+    )
+    return [_projected_row(r, fields) for r in results]
+
+
+def get_products_projection_by_ids(db: Session, product_ids: List[str], fields):
+    """
+    Like get_products_by_ids, but each product is a dict holding only `fields`.
+    Cached products are projected in memory; misses are selected column-wise
+    and not cached, since they are partial.
+    """
+    found = {}
+    missing = []
+    for product_id in dict.fromkeys(product_ids):
+        product = cache.catalog.get(product_id)
+        if product is None:
+            missing.append(product_id)
+        else:
+            found[product_id] = project_product(product, fields)
+
+    if missing:
+        results = (
+            _projection_query(db, fields)
+            .filter(models.Product.id.in_(missing), models.Product.archived.is_(False))
+            .all()
+        )
+        for r in results:
+            found[r.id] = _projected_row(r, fields)
+
+    return [found.get(product_id) for product_id in product_ids]
+
+
+def iter_products(db: Session, fields=None, batch_size: int = 500):
+    """
+    Non-archived products one at a time, as ProductResponse or, with `fields`,
+    projected dicts. Rows are fetched `batch_size` at a time (a server-side
+    cursor on Postgres), so memory stays flat however big the catalog is.
+    Nothing is cached.
+    """
+    if fields is None:
+        query = _product_query(db).group_by(models.Product.id)
+    else:
+        query = _projection_query(db, fields)
+    query = query.filter(models.Product.archived.is_(False)).yield_per(batch_size)
+
+    for r in query:
+        yield _product_response(r) if fields is None else _projected_row(r, fields)
 
 
 def get_product_by_id(db: Session, product_id: str):
     return db.query(models.Product).filter(models.Product.id == product_id).first()
 
 
-def get_product_with_reviews(db: Session, product_id: str):
-    result = (
-        db.query(
-            models.Product.id,
-            models.Product.name,
-            models.Product.image,
-            models.Product.images,
-            models.Product.collection,
-            models.Product.category,
-            models.Product.discount,
-            models.Product.colors,
-            func.count(models.Review.id).label("total_reviews"),
-            func.coalesce(func.avg(models.Review.stars), 0).label("average_rating"),
-            models.Product.XS_price,
-            models.Product.S_price,
-            models.Product.M_price,
-            models.Product.L_price,
-            models.Product.XL_price,
-            models.Product.XXL_price,
-            models.Product.XS_stock,
-            models.Product.S_stock,
-            models.Product.M_stock,
-            models.Product.L_stock,
-            models.Product.XL_stock,
-            models.Product.XXL_stock,
-            models.Product.kids,
-            models.Product.description,
-        )
-        .outerjoin(models.Review, models.Product.id == models.Review.product_id)
-        .filter(models.Product.id == product_id)
-        .group_by(models.Product.id)
+def get_product_with_reviews(db: Session, product_id: str, include_archived: bool = False):
+    generation = cache.catalog.generation
+    query = _product_query(db).filter(models.Product.id == product_id)
+    if not include_archived:
+        query = query.filter(models.Product.archived.is_(False))
+    result = query.group_by(models.Product.id).first()
+    if not result:
+        return None
+
+    product = _product_response(result)
+    if not product.archived:
+        _cache_product(product, generation)
+    return product
+
+
+def get_product_description(db: Session, product_id: str):
+    """Returns None if the product does not exist, "" if it has no description."""
+    row = (
+        db.query(models.Product.description)
+        .filter(models.Product.id == product_id, models.Product.archived.is_(False))
         .first()
     )
-    if not result:
+    if row is None:
         return None
+    return row.description or ""
 
-    images = json.loads(result.images) if result.images else None
-    colors = json.loads(result.colors) if result.colors else None
 
-    return schemas.ProductResponse(
-        id=result.id,
-        name=result.name,
-        image=result.image,
-        images=images,
-        collection=result.collection,
-        category=result.category,
-        discount=result.discount or 0,
-        colors=colors,
-        total_reviews=result.total_reviews,
-        average_rating=round(float(result.average_rating or 0), 2),
-        XS_price=result.XS_price,
-        S_price=result.S_price,
-        M_price=result.M_price,
-        L_price=result.L_price,
-        XL_price=result.XL_price,
-        XXL_price=result.XXL_price,
-        XS_stock=result.XS_stock,
-        S_stock=result.S_stock,
-        M_stock=result.M_stock,
-        L_stock=result.L_stock,
-        XL_stock=result.XL_stock,
-        XXL_stock=result.XXL_stock,
-        kids=result.kids,
-        description=result.description,
+def get_product_page(db: Session, product_id: str, review_limit: int = 10):
+    """Product, review stats, first page of reviews and description in two queries."""
+    product = get_product_with_reviews(db, product_id)
+    if not product:
+        return None
+
+    reviews, next_cursor = [], None
+    if product.total_reviews:
+        reviews, next_cursor = get_reviews_by_product(db, product_id, review_limit)
+
+    return schemas.ProductPageResponse(
+        product=product,
+        description=product.description or "",
+        review_stats=schemas.ReviewStats(
+            total_reviews=product.total_reviews,
+            average_rating=product.average_rating or 0.0,
+        ),
+        reviews=reviews,
+        next_cursor=next_cursor,
     )
 
 
-def create_product(db: Session, product: schemas.ProductCreate):
-    db_product = models.Product(
+def _product_row(product: schemas.ProductCreate):
+    return dict(
         id=product.id,
         name=product.name,
         image=product.image,
@@ -231,17 +486,58 @@ def create_product(db: Session, product: schemas.ProductCreate):
         kids=product.kids,
         description=product.description,
     )
+
+
+def create_product(db: Session, product: schemas.ProductCreate):
+    db_product = models.Product(**_product_row(product))
     db.add(db_product)
+    invalidate_products(db, [db_product.id])
     db.commit()
     db.refresh(db_product)
     return db_product
 
 
+def upsert_products(db: Session, products: List[schemas.ProductCreate], invalidate: bool = True):
+    """
+    Insert or overwrite a batch of products with one INSERT ... ON CONFLICT (id)
+    DO UPDATE. Later rows win when the batch repeats an ID. Returns rows written.
+    Pass invalidate=False to invalidate the cache yourself, once for many batches.
+    """
+    rows = list({p.id: _product_row(p) for p in products}.values())
+    if not rows:
+        return 0
+
+    dialect = db.get_bind().dialect.name
+    if dialect == "postgresql":
+        stmt = pg_insert(models.Product).values(rows)
+    elif dialect == "sqlite":
+        stmt = sqlite_insert(models.Product).values(rows)
+    else:
+        raise HTTPException(status_code=501, detail=f"Bulk upsert is not supported on {dialect}")
+
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[models.Product.id],
+        set_={column: stmt.excluded[column] for column in rows[0] if column != "id"}
+    )
+    # Stock is set absolutely, so move sharded stock back onto the rows first
+    _fold_stock_shards(db, [row["id"] for row in rows])
+    db.execute(stmt)
+    if invalidate:
+        invalidate_products(db, [row["id"] for row in rows])
+    db.commit()
+    return len(rows)
+
+
 def update_product(db: Session, product_id: str, updates: schemas.ProductUpdate):
     product = get_product_by_id(db, product_id)
     if not product:
         return None
 
+    if any(getattr(updates, f"{size}_stock") is not None for size in SIZES):
+        # Stock is set absolutely, so move sharded stock back onto the row first
+        _fold_stock_shards(db, [product_id])
+        db.refresh(product)
+
     if updates.name is not None:
         product.name = updates.name
     if updates.image is not None:
@@ -284,27 +580,408 @@ def update_product(db: Session, product_id: str, updates: schemas.ProductUpdate)
         product.XXL_stock = updates.XXL_stock
     if updates.kids is not None:
         product.kids = updates.kids
+    if updates.archived is not None:
+        product.archived = updates.archived
 
+    invalidate_products(db, [product.id])
     db.commit()
     db.refresh(product)
     return product
 
 
+# -------------------------
+# INVENTORY FUNCTIONS
+# -------------------------
+SIZES = ("XS", "S", "M", "L", "XL", "XXL")
+
+
+def adjust_inventory(db: Session, adjustments: List[schemas.InventoryAdjustment]):
+    """
+    Apply a batch of stock adjustments: one locking SELECT of the affected stock
+    columns, then one UPDATE ... SET <size>_stock = CASE id ... END for all rows.
+    Adjustments that would make stock negative are skipped and reported.
+    Returns (applied_count, rejections).
+    """
+    # Sorted, and locked in id order, so concurrent batches cannot deadlock
+    product_ids = sorted({a.product_id for a in adjustments})
+    _fold_stock_shards(db, product_ids)
+    stock_columns = [getattr(models.Product, f"{size}_stock") for size in SIZES]
+    current = {
+        row.id: row
+        for row in db.query(models.Product.id, *stock_columns)
+        .filter(models.Product.id.in_(product_ids))
+        .order_by(models.Product.id)
+        .with_for_update()
+        .all()
+    }
+
+    new_stock = {}  # (product_id, size) -> value
+    applied = 0
+    rejections = []
+    for a in adjustments:
+        row = current.get(a.product_id)
+        if row is None:
+            rejections.append(schemas.InventoryRejection(
+                product_id=a.product_id, size=a.size, reason="Product not found"
+            ))
+            continue
+
+        key = (a.product_id, a.size)
+        stock = new_stock.get(key, getattr(row, f"{a.size}_stock"))
+        target = a.absolute if a.absolute is not None else stock + a.delta
+        if target < 0:
+            rejections.append(schemas.InventoryRejection(
+                product_id=a.product_id,
+                size=a.size,
+                reason="Stock would go negative",
+                current_stock=stock,
+                requested_stock=target
+            ))
+            continue
+        new_stock[key] = target
+        applied += 1
+
+    if new_stock:
+        values = {}
+        for size in SIZES:
+            column = getattr(models.Product, f"{size}_stock")
+            whens = [(models.Product.id == pid, value) for (pid, s), value in new_stock.items() if s == size]
+            if whens:
+                values[column] = case(*whens, else_=column)
+        db.execute(
+            update(models.Product)
+            .where(models.Product.id.in_({pid for pid, _ in new_stock}))
+            .values(values)
+        )
+    invalidate_products(db, {pid for pid, _ in new_stock})
+    db.commit()
+    return applied, rejections
+
+
 def delete_product(db: Session, product_id: str):
-    product = get_product_by_id(db, product_id)
-    if not product:
+    # Reviews, cart rows and order lines go with it via ON DELETE CASCADE
+    deleted = (
+        db.query(models.Product)
+        .filter(models.Product.id == product_id)
+        .delete(synchronize_session=False)
+    )
+    invalidate_products(db, [product_id])
+    db.commit()
+    return deleted > 0
+
+
+def archive_product(db: Session, product_id: str, archived: bool = True):
+    """Hide (or restore) a product without touching its reviews, carts or orders."""
+    updated = (
+        db.query(models.Product)
+        .filter(models.Product.id == product_id)
+        .update({models.Product.archived: archived}, synchronize_session=False)
+    )
+    invalidate_products(db, [product_id])
+    db.commit()
+    return updated > 0
+
+
+# -------------------------
+# STOCK LEDGER (sharded counters for hot SKUs)
+# -------------------------
+# A SKU's available stock is products.<size>_stock plus its stock_shards rows.
+# Most SKUs have no shards. Hot ones are split across STOCK_SHARDS counters so
+# concurrent reservations land on different rows instead of queueing on the
+# one products row lock; products.stock_sharded marks them. Every movement is
+# appended to stock_movements.
+STOCK_SHARDS = int(os.getenv("STOCK_SHARDS", "8"))
+STOCK_LEDGER_RETENTION_DAYS = int(os.getenv("STOCK_LEDGER_RETENTION_DAYS", "30"))
+
+
+def _stock_column(size: str):
+    """
+    products.<size>_stock plus whatever sits in that SKU's shards. The shard
+    subquery sits behind CASE on products.stock_sharded, so it only runs for
+    the few products that have shards.
+    """
+    stock = getattr(models.Product, f"{size}_stock")
+    shard_total = (
+        select(func.coalesce(func.sum(models.StockShard.available), 0))
+        .where(models.StockShard.product_id == models.Product.id, models.StockShard.size == size)
+        .correlate(models.Product)
+        .scalar_subquery()
+    )
+    return case((models.Product.stock_sharded, stock + shard_total), else_=stock).label(f"{size}_stock")
+
+
+def backfill_stock_sharded(db: Session):
+    """Set products.stock_sharded for products that already have shards (after the column is added)."""
+    db.execute(
+        update(models.Product)
+        .where(
+            models.Product.id.in_(select(models.StockShard.product_id)),
+            models.Product.stock_sharded.isnot(True)
+        )
+        .values(stock_sharded=True)
+    )
+    db.commit()
+
+
+def _log_stock_movement(db: Session, product_id: str, size: str, shard: Optional[int], delta: float, reason: str):
+    db.add(models.StockMovement(
+        product_id=product_id,
+        size=size,
+        shard=shard,
+        delta=delta,
+        reason=reason
+    ))
+
+
+def _take_from_product_row(db: Session, product_id: str, size: str, quantity: float, reason: str) -> bool:
+    column = getattr(models.Product, f"{size}_stock")
+    updated = db.execute(
+        update(models.Product)
+        .where(models.Product.id == product_id, column >= quantity)
+        .values({column: column - quantity})
+    ).rowcount
+    if updated:
+        _log_stock_movement(db, product_id, size, None, -quantity, reason)
+    return updated > 0
+
+
+def reserve_stock(db: Session, product_id: str, size: str, quantity: float, reason: str) -> bool:
+    """
+    Take `quantity` of a SKU in the caller's transaction. Sharded SKUs take from
+    their shards in random order, then from the products row for any shortfall.
+    Returns False, with nothing taken, if there is not enough stock.
+    """
+    shards = (
+        db.query(models.StockShard.shard, models.StockShard.available)
+        .filter(models.StockShard.product_id == product_id, models.StockShard.size == size)
+        .all()
+    )
+    if not shards:
+        return _take_from_product_row(db, product_id, size, quantity, reason)
+
+    savepoint = db.begin_nested()
+    remaining = quantity
+    random.shuffle(shards)
+    for shard, available in shards:
+        take = min(available, remaining)
+        if take <= 0:
+            continue
+        # `available` is a snapshot; the condition re-checks it under the row lock
+        updated = db.execute(
+            update(models.StockShard)
+            .where(
+                models.StockShard.product_id == product_id,
+                models.StockShard.size == size,
+                models.StockShard.shard == shard,
+                models.StockShard.available >= take,
+            )
+            .values(available=models.StockShard.available - take)
+        ).rowcount
+        if updated:
+            _log_stock_movement(db, product_id, size, shard, -take, reason)
+            remaining -= take
+            if remaining <= 0:
+                break
+
+    if remaining > 0 and not _take_from_product_row(db, product_id, size, remaining, reason):
+        savepoint.rollback()
+        return False
+    savepoint.commit()
+    return True
+
+
+def release_stock(db: Session, product_id: str, size: str, quantity: float, reason: str):
+    """Return `quantity` of a SKU, to a random shard if it is sharded."""
+    shards = [
+        shard for (shard,) in db.query(models.StockShard.shard)
+        .filter(models.StockShard.product_id == product_id, models.StockShard.size == size)
+        .all()
+    ]
+    if shards:
+        shard = random.choice(shards)
+        db.execute(
+            update(models.StockShard)
+            .where(
+                models.StockShard.product_id == product_id,
+                models.StockShard.size == size,
+                models.StockShard.shard == shard,
+            )
+            .values(available=models.StockShard.available + quantity)
+        )
+    else:
+        shard = None
+        column = getattr(models.Product, f"{size}_stock")
+        db.execute(
+            update(models.Product)
+            .where(models.Product.id == product_id)
+            .values({column: column + quantity})
+        )
+    _log_stock_movement(db, product_id, size, shard, quantity, reason)
+
+
+def _rebalance_sku(db: Session, product_id: str, size: str) -> bool:
+    """Spread a sharded SKU's stock evenly over its shards. Caller commits."""
+    product = (
+        db.query(models.Product)
+        .filter(models.Product.id == product_id)
+        .with_for_update()
+        .first()
+    )
+    shards = (
+        db.query(models.StockShard)
+        .filter(models.StockShard.product_id == product_id, models.StockShard.size == size)
+        .order_by(models.StockShard.shard)
+        .with_for_update()
+        .all()
+    )
+    if product is None or not shards:
         return False
-    db.delete(product)
+
+    stock_col = f"{size}_stock"
+    total = getattr(product, stock_col) + sum(s.available for s in shards)
+    per_shard = total // len(shards)
+    for s in shards:
+        s.available = per_shard
+    # Whatever does not divide evenly stays on the products row
+    setattr(product, stock_col, total - per_shard * len(shards))
+    return True
+
+
+def shard_sku(db: Session, product_id: str, size: str, shards: int = STOCK_SHARDS) -> bool:
+    """Split a SKU's stock across `shards` counters (or resize its shards)."""
+    if get_product_by_id(db, product_id) is None:
+        return False
+
+    _fold_stock_shards(db, [product_id], sizes=[size])
+    db.query(models.StockShard).filter(
+        models.StockShard.product_id == product_id,
+        models.StockShard.size == size,
+        models.StockShard.shard >= shards,
+    ).delete(synchronize_session=False)
+    existing = {
+        shard for (shard,) in db.query(models.StockShard.shard)
+        .filter(models.StockShard.product_id == product_id, models.StockShard.size == size)
+        .all()
+    }
+    for shard in range(shards):
+        if shard not in existing:
+            db.add(models.StockShard(product_id=product_id, size=size, shard=shard, available=0))
+    db.execute(
+        update(models.Product)
+        .where(models.Product.id == product_id)
+        .values(stock_sharded=True)
+    )
+    db.flush()
+
+    _rebalance_sku(db, product_id, size)
+    invalidate_products(db, [product_id])
     db.commit()
     return True
 
 
+def unshard_sku(db: Session, product_id: str, size: str) -> bool:
+    """Move a SKU's stock back onto the products row and drop its shards."""
+    _fold_stock_shards(db, [product_id], sizes=[size])
+    deleted = db.query(models.StockShard).filter(
+        models.StockShard.product_id == product_id,
+        models.StockShard.size == size,
+    ).delete(synchronize_session=False)
+    db.execute(
+        update(models.Product)
+        .where(
+            models.Product.id == product_id,
+            ~select(models.StockShard.product_id)
+            .where(models.StockShard.product_id == product_id)
+            .exists()
+        )
+        .values(stock_sharded=False)
+    )
+    invalidate_products(db, [product_id])
+    db.commit()
+    return deleted > 0
+
+
+def _fold_stock_shards(db: Session, product_ids: List[str], sizes=SIZES):
+    """
+    Move shard stock onto the products rows (shards keep existing, at 0), so
+    code that sets stock absolutely sees the whole amount. Caller commits.
+    Locks the products rows, then their shards, both in key order.
+    """
+    product_ids = sorted(set(product_ids))
+    db.query(models.Product.id).filter(
+        models.Product.id.in_(product_ids)
+    ).order_by(models.Product.id).with_for_update().all()
+    shards = (
+        db.query(models.StockShard)
+        .filter(models.StockShard.product_id.in_(product_ids), models.StockShard.size.in_(sizes))
+        .order_by(models.StockShard.product_id, models.StockShard.size, models.StockShard.shard)
+        .with_for_update()
+        .all()
+    )
+    totals = {}
+    for s in shards:
+        if s.available:
+            totals[(s.product_id, s.size)] = totals.get((s.product_id, s.size), 0) + s.available
+            s.available = 0
+    for (product_id, size), amount in totals.items():
+        column = getattr(models.Product, f"{size}_stock")
+        db.execute(
+            update(models.Product)
+            .where(models.Product.id == product_id)
+            .values({column: column + amount})
+        )
+    db.flush()
+
+
+def compact_stock(db: Session):
+    """
+    Periodic maintenance: rebalance every sharded SKU (shards drained by
+    reservations are refilled from the others) and prune ledger rows older
+    than STOCK_LEDGER_RETENTION_DAYS.
+    """
+    skus = db.query(models.StockShard.product_id, models.StockShard.size).distinct().all()
+    rebalanced = 0
+    for product_id, size in skus:
+        # One short transaction per SKU, so reservations are blocked only briefly
+        if _rebalance_sku(db, product_id, size):
+            rebalanced += 1
+        invalidate_stock(db, [product_id])
+        db.commit()
+
+    cutoff = datetime.utcnow() - timedelta(days=STOCK_LEDGER_RETENTION_DAYS)
+    pruned = (
+        db.query(models.StockMovement)
+        .filter(models.StockMovement.created_at < cutoff)
+        .delete(synchronize_session=False)
+    )
+    db.commit()
+    return {"rebalanced": rebalanced, "pruned": pruned}
+
+
 # -------------------------
 # REVIEW FUNCTIONS
 # -------------------------
-def get_reviews_by_product(db: Session, product_id: str):
-    return (
+def encode_review_cursor(time: date, review_id: int) -> str:
+    raw = f"{time.isoformat()}|{review_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_review_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode()).decode()
+        time_str, id_str = raw.split("|")
+        return date.fromisoformat(time_str), int(id_str)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def get_reviews_by_product(db: Session, product_id: str, limit: Optional[int] = 20, cursor: Optional[str] = None):
+    """
+    One page of reviews, newest first, using keyset pagination on (time, id).
+    Returns (reviews, next_cursor); next_cursor is None on the last page.
+    limit=None returns every review.
+    """
+    query = (
         db.query(
+            models.Review.id,
             models.User.username,
             models.Review.stars,
             models.Review.text,
@@ -312,8 +989,135 @@ def get_reviews_by_product(db: Session, product_id: str):
         )
         .join(models.User, models.Review.user_id == models.User.id)
         .filter(models.Review.product_id == product_id)
+    )
+    if cursor:
+        cursor_time, cursor_id = decode_review_cursor(cursor)
+        query = query.filter(
+            or_(
+                models.Review.time < cursor_time,
+                and_(models.Review.time == cursor_time, models.Review.id < cursor_id)
+            )
+        )
+
+    query = query.order_by(models.Review.time.desc(), models.Review.id.desc())
+    if limit is not None:
+        query = query.limit(limit + 1)
+    rows = query.all()
+
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_review_cursor(rows[-1].time, rows[-1].id)
+
+    reviews = [
+        schemas.ReviewDetail(username=r.username, stars=r.stars, text=r.text, time=r.time)
+        for r in rows
+    ]
+    return reviews, next_cursor
+
+def star_bucket(stars: float) -> int:
+    return min(5, max(1, int(stars + 0.5)))
+
+def _count_review_stars(db: Session, product_id: str):
+    """Reviews per star bucket (1-5), or None if the product has no reviews."""
+    rows = (
+        db.query(models.Review.stars, func.count(models.Review.id))
+        .filter(models.Review.product_id == product_id)
+        .group_by(models.Review.stars)
+        .all()
+    )
+    if not rows:
+        return None
+    counts = {i: 0 for i in range(1, 6)}
+    for stars, n in rows:
+        counts[star_bucket(stars)] += n
+    return counts
+
+def _rebuild_review_stats(db: Session, product_id: str) -> bool:
+    """
+    Backfill the histogram counters for a product from its reviews (runs once
+    per product). Returns False if another request created them first.
+    """
+    counts = _count_review_stars(db, product_id)
+    if counts is None:
+        return True
+    try:
+        with db.begin_nested():
+            db.add(models.ProductReviewStats(
+                product_id=product_id,
+                **{f"stars_{i}": counts[i] for i in counts}
+            ))
+    except IntegrityError:
+        return False
+    return True
+
+def dedupe_reviews(db: Session) -> int:
+    """
+    Keep only the newest review per (user, product), so uq_reviews_user_product
+    can be built over reviews written before it existed. The affected products'
+    histogram counters are rebuilt. Returns how many reviews were deleted.
+    """
+    groups = (
+        db.query(models.Review.user_id, models.Review.product_id, func.max(models.Review.id))
+        .group_by(models.Review.user_id, models.Review.product_id)
+        .having(func.count(models.Review.id) > 1)
         .all()
     )
+    deleted = 0
+    for user_id, product_id, keep_id in groups:
+        deleted += db.query(models.Review).filter(
+            models.Review.user_id == user_id,
+            models.Review.product_id == product_id,
+            models.Review.id != keep_id
+        ).delete(synchronize_session=False)
+
+    product_ids = {product_id for _, product_id, _ in groups}
+    if product_ids:
+        db.query(models.ProductReviewStats).filter(
+            models.ProductReviewStats.product_id.in_(product_ids)
+        ).delete(synchronize_session=False)
+        for product_id in product_ids:
+            _rebuild_review_stats(db, product_id)
+        invalidate_products(db, product_ids)
+    db.commit()
+    return deleted
+
+def _increment_review_stats(db: Session, product_id: str, stars: float):
+    column = getattr(models.ProductReviewStats, f"stars_{star_bucket(stars)}")
+
+    def increment():
+        return (
+            db.query(models.ProductReviewStats)
+            .filter(models.ProductReviewStats.product_id == product_id)
+            .update({column: column + 1}, synchronize_session=False)
+        )
+
+    # No counters yet: the backfill already includes the flushed new review.
+    # If another request backfilled first, it could not see this uncommitted
+    # review, so count it on the winner's row.
+    if not increment() and not _rebuild_review_stats(db, product_id):
+        increment()
+
+def get_review_histogram(db: Session, product_id: str):
+    """Read-only: products without counters yet are counted on the fly; create_review backfills them."""
+    stats = db.query(models.ProductReviewStats).filter(
+        models.ProductReviewStats.product_id == product_id
+    ).first()
+    if stats is not None:
+        return {str(i): getattr(stats, f"stars_{i}") for i in range(1, 6)}
+    counts = _count_review_stars(db, product_id) or {}
+    return {str(i): counts.get(i, 0) for i in range(1, 6)}
+
+def _is_unique_violation(error: IntegrityError, index_name: str, columns) -> bool:
+    # Postgres names the index; SQLite only lists the columns
+    constraint = getattr(getattr(error.orig, "diag", None), "constraint_name", None)
+    if constraint:
+        return constraint == index_name
+    message = str(error.orig)
+    return "UNIQUE constraint failed" in message and all(f".{c}" in message for c in columns)
+
+def _is_foreign_key_violation(error: IntegrityError) -> bool:
+    return getattr(error.orig, "pgcode", None) == "23503" or "FOREIGN KEY constraint failed" in str(error.orig)
 
 def create_review(db: Session, review: schemas.ReviewCreate):
     db_review = models.Review(
@@ -324,6 +1128,17 @@ def create_review(db: Session, review: schemas.ReviewCreate):
         product_id=review.product_id
     )
     db.add(db_review)
+    try:
+        db.flush()
+    except IntegrityError as e:
+        db.rollback()
+        if _is_unique_violation(e, "uq_reviews_user_product", ("user_id", "product_id")):
+            raise HTTPException(status_code=400, detail="You have already reviewed this product")
+        if _is_foreign_key_violation(e):
+            raise HTTPException(status_code=404, detail="Product or user not found")
+        raise
+    _increment_review_stats(db, db_review.product_id, db_review.stars)
+    invalidate_products(db, [db_review.product_id])
     db.commit()
     db.refresh(db_review)
     return db_review
@@ -347,10 +1162,115 @@ def has_user_reviewed_product(db: Session, user_id: str, product_id: str):
     ).first()
     return review is not None
 
+def get_reviewed_product_ids(db: Session, user_id: str, product_ids: List[str]):
+    """Which of `product_ids` the user has reviewed, in one indexed query."""
+    if not product_ids:
+        return set()
+    rows = (
+        db.query(models.Review.product_id)
+        .filter(
+            models.Review.user_id == user_id,
+            models.Review.product_id.in_(product_ids)
+        )
+        .all()
+    )
+    return {r.product_id for r in rows}
+
 
 # -------------------------
 # CART FUNCTIONS
 # -------------------------
+def get_cart_version(db: Session, user_id: str) -> int:
+    row = db.query(models.CartVersion.version).filter(models.CartVersion.user_id == user_id).first()
+    return row.version if row else 0
+
+def bump_cart_version(db: Session, user_id: str):
+    """
+    Increment the user's cart version inside the caller's transaction. The
+    cart_versions row stays locked until commit, which is also the cart lock
+    sweep_abandoned_carts honours, so cart writers call this before reading
+    their lines.
+    """
+    updated = (
+        db.query(models.CartVersion)
+        .filter(models.CartVersion.user_id == user_id)
+        .update({models.CartVersion.version: models.CartVersion.version + 1}, synchronize_session=False)
+    )
+    if updated:
+        return
+    try:
+        with db.begin_nested():
+            db.add(models.CartVersion(user_id=user_id, version=1))
+    except IntegrityError:
+        db.query(models.CartVersion).filter(models.CartVersion.user_id == user_id).update(
+            {models.CartVersion.version: models.CartVersion.version + 1}, synchronize_session=False
+        )
+
+def _cart_price_column():
+    return case(
+        (models.Cart.size == "XS", models.Product.XS_price),
+        (models.Cart.size == "S", models.Product.S_price),
+        (models.Cart.size == "M", models.Product.M_price),
+        (models.Cart.size == "L", models.Product.L_price),
+        (models.Cart.size == "XL", models.Product.XL_price),
+        (models.Cart.size == "XXL", models.Product.XXL_price),
+        else_=0
+    )
+
+def get_cart_line(db: Session, user_id: str, product_id: str, size: str, color: Optional[str]):
+    item = (
+        db.query(
+            models.Cart.size,
+            models.Cart.quantity,
+            models.Cart.color,
+            models.Cart.product_id,
+            models.Product.name.label("product_name"),
+            models.Product.image,
+            models.Product.collection,
+            models.Product.discount,
+            _cart_price_column().label("price")
+        )
+        .join(models.Product, models.Cart.product_id == models.Product.id)
+        .filter(
+            models.Cart.user_id == user_id,
+            models.Cart.product_id == product_id,
+            models.Cart.size == size,
+            models.Cart.color == color
+        )
+        .first()
+    )
+    if not item:
+        return None
+    return schemas.CartProduct(
+        product_name=item.product_name,
+        collection=item.collection,
+        size=item.size,
+        quantity=item.quantity,
+        image=item.image,
+        user_id=user_id,
+        product_id=item.product_id,
+        price=item.price,
+        color=item.color or None,
+        discount=item.discount or 0
+    )
+
+def get_cart_totals(db: Session, user_id: str):
+    totals = (
+        db.query(
+            func.count(models.Cart.id).label("total_products"),
+            func.coalesce(func.sum(models.Cart.quantity), 0).label("total_quantity"),
+            func.coalesce(func.sum(models.Cart.quantity * _cart_price_column()), 0).label("subtotal")
+        )
+        .join(models.Product, models.Cart.product_id == models.Product.id)
+        .filter(models.Cart.user_id == user_id)
+        .one()
+    )
+    return schemas.CartTotals(
+        total_products=totals.total_products,
+        total_quantity=int(totals.total_quantity),
+        subtotal=int(totals.subtotal)
+    )
+
 def get_user_cart(db: Session, user_id: str):
     items = (
         db.query(
@@ -359,15 +1279,7 @@ def get_user_cart(db: Session, user_id: str):
             models.Product.name.label("product_name"),
             models.Product.image,
             models.Product.collection,
-            case(
-                (models.Cart.size == "XS", models.Product.XS_price),
-                (models.Cart.size == "S", models.Product.S_price),
-                (models.Cart.size == "M", models.Product.M_price),
-                (models.Cart.size == "L", models.Product.L_price),
-                (models.Cart.size == "XL", models.Product.XL_price),
-                (models.Cart.size == "XXL", models.Product.XXL_price),
-                else_=0
-            ).label("price")
+            _cart_price_column().label("price")
         )
         .join(models.Product, models.Cart.product_id == models.Product.id)
         .filter(models.Cart.user_id == user_id)
@@ -397,7 +1309,8 @@ def get_user_cart(db: Session, user_id: str):
 
 
 
-def add_to_cart(db: Session, cart_item: schemas.CartCreate):
+def add_to_cart(db: Session, cart_item: schemas.CartCreate, commit: bool = True):
+    bump_cart_version(db, cart_item.user_id)  # locks the cart against the sweeper
     existing = db.query(models.Cart).filter(
         models.Cart.user_id == cart_item.user_id,
         models.Cart.product_id == cart_item.product_id,
@@ -418,21 +1331,21 @@ def add_to_cart(db: Session, cart_item: schemas.CartCreate):
         db.add(new_item)
     
     
-    # --- UPDATE STOCK ---
-    product = db.query(models.Product).filter(models.Product.id == cart_item.product_id).first()
-    stock_col = f"{cart_item.size}_stock"
-    
-    current_stock = getattr(product, stock_col)
-    if current_stock < cart_item.quantity:
+    # --- RESERVE STOCK ---
+    if not reserve_stock(db, cart_item.product_id, cart_item.size, cart_item.quantity, "cart"):
         raise HTTPException(status_code=400, detail="Not enough stock")
-    
-    setattr(product, stock_col, current_stock - cart_item.quantity)
 # ---------------------    
     
-    db.commit()
+    touch_cart(db, cart_item.user_id)
+    invalidate_stock(db, [cart_item.product_id])
+    if commit:
+        db.commit()
+    else:
+        db.flush()
     return True
 
 def update_cart_quantity(db: Session, user_id: str, product_id: str, size: str,color: str, quantity: int):
+    bump_cart_version(db, user_id)  # locks the cart against the sweeper
     item = db.query(models.Cart).filter(
         models.Cart.user_id == user_id,
         models.Cart.product_id == product_id,
@@ -440,24 +1353,19 @@ def update_cart_quantity(db: Session, user_id: str, product_id: str, size: str,c
         models.Cart.color == color
     ).first()
     if not item:
+        db.rollback()  # release the cart lock
         return False
     
     
     # --- STOCK ADJUSTMENT ---
-    product = db.query(models.Product).filter(models.Product.id == product_id).first()
-    stock_col = f"{size}_stock"
-    
     old_qty = item.quantity
     
     if quantity > old_qty:  # increasing cart qty
-        diff = quantity - old_qty
-        if getattr(product, stock_col) < diff:
+        if not reserve_stock(db, product_id, size, quantity - old_qty, "cart_update"):
             raise HTTPException(status_code=400, detail="Not enough stock")
-        setattr(product, stock_col, getattr(product, stock_col) - diff)
     
     elif quantity < old_qty:  # decreasing cart qty
-        diff = old_qty - quantity
-        setattr(product, stock_col, getattr(product, stock_col) + diff)
+        release_stock(db, product_id, size, old_qty - quantity, "cart_update")
     # -------------------------
 
     
@@ -466,10 +1374,13 @@ def update_cart_quantity(db: Session, user_id: str, product_id: str, size: str,c
         db.delete(item)
     else:
         item.quantity = quantity
+    touch_cart(db, user_id)
+    invalidate_stock(db, [product_id])
     db.commit()
     return True
 
 def remove_from_cart(db: Session, user_id: str, product_id: str, size: str, color: str):
+    bump_cart_version(db, user_id)  # locks the cart against the sweeper
     item = db.query(models.Cart).filter(
         models.Cart.user_id == user_id,
         models.Cart.product_id == product_id,
@@ -477,230 +1388,321 @@ def remove_from_cart(db: Session, user_id: str, product_id: str, size: str, colo
         models.Cart.color == color
     ).first()
     if not item:
+        db.rollback()  # release the cart lock
         return False
     
     
     # --- RETURN STOCK ---
-    product = db.query(models.Product).filter(models.Product.id == product_id).first()
-    stock_col = f"{size}_stock"
-    setattr(product, stock_col, getattr(product, stock_col) + item.quantity)
+    release_stock(db, product_id, size, item.quantity, "cart_remove")
     # --------------------
 
     
     
     db.delete(item)
+    touch_cart(db, user_id)
+    invalidate_stock(db, [product_id])
     db.commit()
     return True
 
 
 # -------------------------
-# ORDER FUNCTIONS
+# ABANDONED CART SWEEPER
 # -------------------------
-def get_all_orders(db: Session):
+CART_HOLD_MINUTES = int(os.getenv("CART_HOLD_MINUTES", "60"))
+CART_SWEEP_BATCH_SIZE = int(os.getenv("CART_SWEEP_BATCH_SIZE", "500"))
 
-    # ---- LAST 30 DAYS FILTER ----
-    today = datetime.utcnow().date()
-    last_month = today - timedelta(days=30)
 
-    # ---- CUSTOM ORDER FOR STATUS ----
-    status_order = case(
-        (models.Order.status == "pending", 1),
-        (models.Order.status == "processing", 2),
-        (models.Order.status == "shipped", 3),
-        (models.Order.status == "delivered", 4),
-        (models.Order.status == "cancelled", 5),
-        else_=6
+def touch_cart(db: Session, user_id: str):
+    """Mark every line of the user's cart as active. Caller commits."""
+    db.query(models.Cart).filter(models.Cart.user_id == user_id).update(
+        {models.Cart.last_touched: datetime.utcnow()}, synchronize_session=False
     )
 
-    raw_orders = (
-        db.query(
-            models.Order.id.label("order_id"),
-            models.Order.user_id,
-            models.User.username,
-            models.Order.status,
-            func.count(models.OrderItem.id).label("total_products"),
-            func.sum(
-                models.OrderItem.quantity *
-                case(
-                    (models.OrderItem.size == "XS", models.Product.XS_price),
-                    (models.OrderItem.size == "S", models.Product.S_price),
-                    (models.OrderItem.size == "M", models.Product.M_price),
-                    (models.OrderItem.size == "L", models.Product.L_price),
-                    (models.OrderItem.size == "XL", models.Product.XL_price),
-                    (models.OrderItem.size == "XXL", models.Product.XXL_price),
-                    else_=0
-                )
-            ).label("total_price"),
-            models.Order.time.label("order_time")
-        )
-        .join(models.User, models.Order.user_id == models.User.id)
-        .join(models.OrderItem, models.Order.id == models.OrderItem.order_id)
-        .join(models.Product, models.OrderItem.product_id == models.Product.id)
 
-        # ---- FILTER: ONLY LAST 30 DAYS ----
-        .filter(models.Order.time >= last_month)
+def backfill_cart_last_touched(db: Session):
+    """Start the hold clock now for cart lines created before last_touched existed."""
+    db.query(models.Cart).filter(models.Cart.last_touched.is_(None)).update(
+        {models.Cart.last_touched: datetime.utcnow()}, synchronize_session=False
+    )
+    db.commit()
 
-        # ---- SORT BY STATUS → THEN NEWEST ----
-        .order_by(status_order, models.Order.time.desc())
 
-        .group_by(models.Order.id, models.User.username)
+def _lock_carts(db: Session, user_ids: List[str]) -> List[str]:
+    """
+    Lock the cart_versions rows of `user_ids`, skipping carts a cart write or
+    checkout holds right now. Returns the users whose carts are now locked.
+    """
+    existing = {
+        user_id for (user_id,) in db.query(models.CartVersion.user_id)
+        .filter(models.CartVersion.user_id.in_(user_ids))
+    }
+    for user_id in user_ids:
+        if user_id not in existing:
+            # Carts from before versioning have no row to lock yet
+            try:
+                with db.begin_nested():
+                    db.add(models.CartVersion(user_id=user_id, version=0))
+            except IntegrityError:
+                pass
+    return [
+        user_id for (user_id,) in db.query(models.CartVersion.user_id)
+        .filter(models.CartVersion.user_id.in_(user_ids))
+        .order_by(models.CartVersion.user_id)
+        .with_for_update(skip_locked=True)
         .all()
-    )
+    ]
+
 
-    final_results = []
-
-    for order in raw_orders:
-        order_items = (
-            db.query(
-                models.OrderItem.product_id,
-                models.OrderItem.quantity,
-                models.OrderItem.size,
-                models.OrderItem.color,
-                models.Product.name.label("product_name"),
-                models.Product.discount.label("discount"),
-                models.Product.XS_price,
-                models.Product.S_price,
-                models.Product.M_price,
-                models.Product.L_price,
-                models.Product.XL_price,
-                models.Product.XXL_price,
+def sweep_abandoned_carts(
+    db: Session,
+    hold_minutes: int = CART_HOLD_MINUTES,
+    batch_size: int = CART_SWEEP_BATCH_SIZE,
+    max_batches: Optional[int] = None
+):
+    """
+    Return the stock held by cart lines untouched for `hold_minutes` and delete
+    the lines. Each batch covers the carts of up to `batch_size` expired lines
+    and is one short transaction: lock those carts (skipping ones a live request
+    holds), re-read their expired lines, add the quantities back with a single
+    UPDATE products ... FROM (SELECT ... GROUP BY product_id), append them to
+    the stock ledger and bulk-delete the lines.
+    """
+    cutoff = datetime.utcnow() - timedelta(minutes=hold_minutes)
+    totals = {"batches": 0, "lines": 0, "units": 0, "carts": 0}
+
+    while max_batches is None or totals["batches"] < max_batches:
+        candidates = list(dict.fromkeys(
+            user_id for (user_id,) in db.query(models.Cart.user_id)
+            .filter(models.Cart.last_touched < cutoff)
+            .order_by(models.Cart.last_touched)
+            .limit(batch_size)
+            .all()
+        ))
+        if not candidates:
+            break
+        user_ids = _lock_carts(db, candidates)
+        if not user_ids:
+            # Every candidate cart is in use right now; the next run gets them
+            db.rollback()
+            break
+
+        # Re-checked under the cart lock: a cart touched since is no longer expired
+        line_ids = [
+            line_id for (line_id,) in db.query(models.Cart.id)
+            .filter(models.Cart.user_id.in_(user_ids), models.Cart.last_touched < cutoff)
+            .all()
+        ]
+        if not line_ids:
+            db.commit()
+            continue
+        in_batch = models.Cart.id.in_(line_ids)
+
+        held = (
+            select(
+                models.Cart.product_id,
+                *[
+                    func.sum(case((models.Cart.size == size, models.Cart.quantity), else_=0)).label(size)
+                    for size in SIZES
+                ]
             )
-            .join(models.Product, models.OrderItem.product_id == models.Product.id)
-            .filter(models.OrderItem.order_id == order.order_id)
+            .where(in_batch)
+            .group_by(models.Cart.product_id)
+            .subquery()
+        )
+        db.execute(
+            update(models.Product)
+            .where(models.Product.id == held.c.product_id)
+            .values({
+                getattr(models.Product, f"{size}_stock"): getattr(models.Product, f"{size}_stock") + held.c[size]
+                for size in SIZES
+            })
+            .execution_options(synchronize_session=False)
+        )
+        db.execute(
+            insert(models.StockMovement).from_select(
+                ["product_id", "size", "delta", "reason"],
+                select(
+                    models.Cart.product_id,
+                    models.Cart.size,
+                    func.sum(models.Cart.quantity),
+                    literal("cart_expired"),
+                )
+                .where(in_batch)
+                .group_by(models.Cart.product_id, models.Cart.size)
+            )
+        )
+
+        users = (
+            db.query(models.Cart.user_id, func.sum(models.Cart.quantity).label("units"))
+            .filter(in_batch)
+            .group_by(models.Cart.user_id)
             .all()
         )
+        product_ids = [pid for (pid,) in db.query(models.Cart.product_id).filter(in_batch).distinct()]
 
-        products = []
-        for item in order_items:
-            unit_price = (
-                item.XS_price if item.size == "XS" else
-                item.S_price if item.size == "S" else
-                item.M_price if item.size == "M" else
-                item.L_price if item.size == "L" else
-                item.XL_price if item.size == "XL" else
-                item.XXL_price
-            )
+        db.query(models.Cart).filter(in_batch).delete(synchronize_session=False)
+        for user in users:
+            bump_cart_version(db, user.user_id)
+        invalidate_stock(db, product_ids)
+        db.commit()
 
-            products.append(
-                schemas.OrderProduct(
-                    product_id=item.product_id,
-                    product_name=item.product_name,
-                    quantity=item.quantity,
-                    size=item.size,
-                    color=item.color or None,
-                    price=unit_price * item.quantity,
-                    discount=item.discount or 0
-                )
+        units = int(sum(user.units for user in users))
+        totals["batches"] += 1
+        totals["lines"] += len(line_ids)
+        totals["units"] += units
+        totals["carts"] += len(users)
+        metrics.incr("cart_sweeper.lines_released", len(line_ids))
+        metrics.incr("cart_sweeper.units_released", units)
+        metrics.incr("cart_sweeper.carts_released", len(users))
+
+    metrics.incr("cart_sweeper.runs")
+    metrics.set_gauge("cart_sweeper.last_run_lines", totals["lines"])
+    metrics.set_gauge("cart_sweeper.last_run_at", datetime.utcnow().timestamp())
+    return totals
+
+
+# -------------------------
+# ORDER FUNCTIONS
+# -------------------------
+ORDER_STATUS_RANK = {
+    "pending": 1,
+    "processing": 2,
+    "shipped": 3,
+    "delivered": 4,
+    "cancelled": 5,
+}
+
+def order_status_rank(status: str) -> int:
+    return ORDER_STATUS_RANK.get(status, 6)
+
+def backfill_order_status_rank(db: Session):
+    """Fill status_rank for orders created before the column existed."""
+    rank = case(
+        *[(models.Order.status == status, r) for status, r in ORDER_STATUS_RANK.items()],
+        else_=6
+    )
+    db.query(models.Order).filter(models.Order.status_rank.is_(None)).update(
+        {models.Order.status_rank: rank}, synchronize_session=False
+    )
+    db.commit()
+
+
+def _build_order_responses(db: Session, orders):
+    """
+    OrderResponse objects for `orders` (rows with id, user_id, username, status,
+    time), keeping their order. All lines come from one query; orders without
+    lines are left out, as the old inner-joined aggregate did.
+    """
+    order_ids = [o.id for o in orders]
+    if not order_ids:
+        return []
+
+    order_items = (
+        db.query(
+            models.OrderItem.order_id,
+            models.OrderItem.product_id,
+            models.OrderItem.quantity,
+            models.OrderItem.size,
+            models.OrderItem.color,
+            models.Product.name.label("product_name"),
+            models.Product.discount.label("discount"),
+            models.Product.XS_price,
+            models.Product.S_price,
+            models.Product.M_price,
+            models.Product.L_price,
+            models.Product.XL_price,
+            models.Product.XXL_price,
+        )
+        .join(models.Product, models.OrderItem.product_id == models.Product.id)
+        .filter(models.OrderItem.order_id.in_(order_ids))
+        .order_by(models.OrderItem.order_id, models.OrderItem.id)
+        .all()
+    )
+
+    products_by_order = {}
+    for item in order_items:
+        unit_price = (
+            item.XS_price if item.size == "XS" else
+            item.S_price if item.size == "S" else
+            item.M_price if item.size == "M" else
+            item.L_price if item.size == "L" else
+            item.XL_price if item.size == "XL" else
+            item.XXL_price
+        )
+
+        products_by_order.setdefault(item.order_id, []).append(
+            schemas.OrderProduct(
+                product_id=item.product_id,
+                product_name=item.product_name,
+                quantity=item.quantity,
+                size=item.size,
+                color=item.color or None,
+                price=unit_price * item.quantity,
+                discount=item.discount or 0
             )
+        )
 
-        final_results.append(
+    results = []
+    for order in orders:
+        products = products_by_order.get(order.id)
+        if not products:
+            continue
+        results.append(
             schemas.OrderResponse(
-                order_id=order.order_id,
+                order_id=order.id,
                 user_id=order.user_id,
                 username=order.username,
                 status=order.status,
-                total_products=order.total_products,
-                total_price=int(order.total_price or 0),
-                order_time=order.order_time,
+                total_products=len(products),
+                total_price=int(sum(p.price for p in products)),
+                order_time=order.time,
                 products=products
             )
         )
+    return results
 
-    return final_results
 
+def get_all_orders(db: Session):
 
+    # ---- LAST 30 DAYS FILTER ----
+    today = datetime.utcnow().date()
+    last_month = today - timedelta(days=30)
 
-def get_user_orders(db: Session, user_id: str):
-    results = (
+    # ---- SORT BY STATUS → THEN NEWEST (walks ix_orders_status_rank_time_id) ----
+    orders = (
         db.query(
-            models.Order.id.label("order_id"),
+            models.Order.id,
             models.Order.user_id,
             models.User.username,
             models.Order.status,
-            func.count(models.OrderItem.id).label("total_products"),
-            func.sum(
-                models.OrderItem.quantity *
-                case(
-                    (models.OrderItem.size == "XS", models.Product.XS_price),
-                    (models.OrderItem.size == "S", models.Product.S_price),
-                    (models.OrderItem.size == "M", models.Product.M_price),
-                    (models.OrderItem.size == "L", models.Product.L_price),
-                    (models.OrderItem.size == "XL", models.Product.XL_price),
-                    (models.OrderItem.size == "XXL", models.Product.XXL_price),
-                    else_=0
-                )
-            ).label("total_price"),
-            models.Order.time.label("order_time")
+            models.Order.time,
         )
         .join(models.User, models.Order.user_id == models.User.id)
-        .join(models.OrderItem, models.Order.id == models.OrderItem.order_id)
-        .join(models.Product, models.OrderItem.product_id == models.Product.id)
-        .filter(models.Order.user_id == user_id)
-        .group_by(models.Order.id, models.User.username)
+        .filter(models.Order.time >= last_month)
+        .order_by(models.Order.status_rank, models.Order.time.desc(), models.Order.id)
         .all()
     )
 
-    orders = []
-    for r in results:
-        order_items = (
-            db.query(
-                models.OrderItem.quantity,
-                models.OrderItem.size,
-                models.OrderItem.product_id,
-                models.OrderItem.color,
-                models.Product.name.label("product_name"),
-                models.Product.discount.label("discount"),
-                models.Product.XS_price,
-                models.Product.S_price,
-                models.Product.M_price,
-                models.Product.L_price,
-                models.Product.XL_price,
-                models.Product.XXL_price
-            )
-            .join(models.Product, models.OrderItem.product_id == models.Product.id)
-            .filter(models.OrderItem.order_id == r.order_id)
-            .all()
-        )
+    return _build_order_responses(db, orders)
 
-        products = []
-        for item in order_items:
-            unit_price = (
-                item.XS_price if item.size == "XS" else
-                item.S_price if item.size == "S" else
-                item.M_price if item.size == "M" else
-                item.L_price if item.size == "L" else
-                item.XL_price if item.size == "XL" else
-                item.XXL_price
-            )
 
-            products.append(
-                schemas.OrderProduct(
-                    product_name=item.product_name,
-                    product_id=item.product_id,
-                    quantity=item.quantity,
-                    size=item.size,
-                    color=item.color or None,
-                    price=unit_price * item.quantity,
-                    discount=item.discount or 0
-                )
-            )
-
-        orders.append(
-            schemas.OrderResponse(
-                order_id=r.order_id,
-                user_id=r.user_id,
-                username=r.username,
-                status=r.status,
-                total_products=r.total_products,
-                total_price=int(r.total_price or 0),
-                order_time=r.order_time,
-                products=products
-            )
+def get_user_orders(db: Session, user_id: str):
+    # Newest first via ix_orders_user_time
+    orders = (
+        db.query(
+            models.Order.id,
+            models.Order.user_id,
+            models.User.username,
+            models.Order.status,
+            models.Order.time,
         )
+        .join(models.User, models.Order.user_id == models.User.id)
+        .filter(models.Order.user_id == user_id)
+        .order_by(models.Order.time.desc(), models.Order.id.desc())
+        .all()
+    )
 
-    return orders
-
-
+    return _build_order_responses(db, orders)
 
 
 def get_order(db: Session, order_id: int):
@@ -757,23 +1759,55 @@ def get_order(db: Session, order_id: int):
 
 
 def update_order_status(db: Session, order_id: int, status: str):
-    order = db.query(models.Order).filter(models.Order.id == order_id).first()
+    order = db.query(models.Order).filter(models.Order.id == order_id).with_for_update().first()
     if not order:
         return None
+    _record_status_changes(db, [order], status)
     order.status = status
+    order.status_rank = order_status_rank(status)
     db.commit()
     db.refresh(order)
     return order
 
 
-def create_order_from_cart(db: Session, order: schemas.OrderCreate):
+def bulk_update_order_status(db: Session, order_ids: List[int], status: str):
+    """Set `status` on many orders with one UPDATE ... RETURNING. Returns the updated IDs."""
+    if not order_ids:
+        return []
+    previous = (
+        db.query(models.Order.id, models.Order.user_id, models.Order.status)
+        .filter(models.Order.id.in_(order_ids))
+        .order_by(models.Order.id)
+        .with_for_update()
+        .all()
+    )
+    _record_status_changes(db, previous, status)
+    result = db.execute(
+        update(models.Order)
+        .where(models.Order.id.in_(order_ids))
+        .values(status=status, status_rank=order_status_rank(status))
+        .returning(models.Order.id)
+    )
+    updated_ids = [row.id for row in result]
+    db.commit()
+    return updated_ids
+
+
+def create_order_from_cart(db: Session, order: schemas.OrderCreate, commit: bool = True):
     user = db.query(models.User).filter(models.User.id == order.user_id).first()
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
 
+    bump_cart_version(db, order.user_id)  # locks the cart against the sweeper
     cart_items = db.query(models.Cart).filter(models.Cart.user_id == order.user_id).all()
     if not cart_items:
         raise HTTPException(status_code=400, detail="Cart is empty")
+    unit_prices = dict(
+        db.query(models.Cart.id, _cart_price_column())
+        .join(models.Product, models.Cart.product_id == models.Product.id)
+        .filter(models.Cart.user_id == order.user_id)
+        .all()
+    )
 
     try:
         order_time = datetime.fromisoformat(order.order_time.replace("Z", "+00:00")).date()
@@ -783,11 +1817,12 @@ def create_order_from_cart(db: Session, order: schemas.OrderCreate):
     db_order = models.Order(
         user_id=order.user_id,
         status="pending",
+        status_rank=order_status_rank("pending"),
         time=order_time
     )
     db.add(db_order)
-    db.commit()
-    db.refresh(db_order)
+    # Flush, not commit: the cart stays locked until the order is complete
+    db.flush()
 
     for item in cart_items:
         db.add(models.OrderItem(
@@ -795,10 +1830,296 @@ def create_order_from_cart(db: Session, order: schemas.OrderCreate):
             product_id=item.product_id,
             size=item.size,
             quantity=item.quantity,
-            color=item.color
+            color=item.color,
+            unit_price=unit_prices.get(item.id)
         ))
 
     db.query(models.Cart).filter(models.Cart.user_id == order.user_id).delete()
-    db.commit()
+    db.flush()
+    _record_new_order(db, db_order)
+    if commit:
+        db.commit()
+    else:
+        db.flush()
 
     return get_user_orders(db, order.user_id)
+
+
+
+# -------------------------
+# USER ORDER SUMMARY FUNCTIONS
+# -------------------------
+def _status_count_column(status: str):
+    name = f"{status}_count" if status in ORDER_STATUS_RANK else "other_count"
+    return getattr(models.UserOrderSummary, name)
+
+
+def _order_totals(db: Session, criterion):
+    """
+    order_id -> total charged (stored unit price x quantity) for orders matching
+    `criterion`. Lines from before unit_price was stored use today's size price.
+    """
+    current_price = case(
+        *[(models.OrderItem.size == size, getattr(models.Product, f"{size}_price")) for size in SIZES[:-1]],
+        else_=models.Product.XXL_price
+    )
+    unit_price = func.coalesce(models.OrderItem.unit_price, current_price)
+    rows = (
+        db.query(models.OrderItem.order_id, func.sum(unit_price * models.OrderItem.quantity))
+        .join(models.Product, models.OrderItem.product_id == models.Product.id)
+        .join(models.Order, models.OrderItem.order_id == models.Order.id)
+        .filter(criterion)
+        .group_by(models.OrderItem.order_id)
+        .all()
+    )
+    return {order_id: int(total or 0) for order_id, total in rows}
+
+
+def _compute_user_order_summary(db: Session, user_id: str):
+    """An unsaved UserOrderSummary built from the user's orders, or None if they have none."""
+    orders = (
+        db.query(models.Order.id, models.Order.status, models.Order.time)
+        .filter(models.Order.user_id == user_id)
+        .all()
+    )
+    if not orders:
+        return None
+    totals = _order_totals(db, models.Order.user_id == user_id)
+
+    summary = models.UserOrderSummary(
+        user_id=user_id,
+        order_count=len(orders),
+        lifetime_total=sum(totals.get(o.id, 0) for o in orders if o.status != "cancelled"),
+        **{f"{status}_count": 0 for status in ORDER_STATUS_RANK},
+        other_count=0
+    )
+    for o in orders:
+        name = _status_count_column(o.status).key
+        setattr(summary, name, getattr(summary, name) + 1)
+    last = max(orders, key=lambda o: (o.time, o.id))
+    summary.last_order_id = last.id
+    summary.last_order_time = last.time
+    summary.last_order_status = last.status
+    return summary
+
+
+def _rebuild_user_order_summary(db: Session, user_id: str) -> bool:
+    """
+    Backfill a user's summary from their orders (runs once per user). Returns
+    False if another request created it first.
+    """
+    summary = _compute_user_order_summary(db, user_id)
+    if summary is None:
+        return True
+    try:
+        with db.begin_nested():
+            db.add(summary)
+    except IntegrityError:
+        return False
+    return True
+
+
+def _record_new_order(db: Session, order: models.Order):
+    """Count a just-flushed order in its user's summary. Caller commits."""
+    total = _order_totals(db, models.Order.id == order.id).get(order.id, 0)
+    summary = models.UserOrderSummary
+    is_newer = or_(
+        summary.last_order_time.is_(None),
+        summary.last_order_time < order.time,
+        and_(summary.last_order_time == order.time, summary.last_order_id < order.id),
+    )
+    status_col = _status_count_column(order.status)
+
+    def increment():
+        return (
+            db.query(summary)
+            .filter(summary.user_id == order.user_id)
+            .update({
+                summary.order_count: summary.order_count + 1,
+                status_col: status_col + 1,
+                summary.lifetime_total: summary.lifetime_total + (0 if order.status == "cancelled" else total),
+                summary.last_order_id: case((is_newer, order.id), else_=summary.last_order_id),
+                summary.last_order_time: case((is_newer, order.time), else_=summary.last_order_time),
+                summary.last_order_status: case((is_newer, order.status), else_=summary.last_order_status),
+            }, synchronize_session=False)
+        )
+
+    # No summary yet: the backfill already includes the flushed new order. If
+    # another request backfilled first, it could not see this uncommitted
+    # order, so count it on the winner's row.
+    if not increment() and not _rebuild_user_order_summary(db, order.user_id):
+        increment()
+
+
+def _record_status_changes(db: Session, orders, status: str):
+    """
+    Move `orders` (locked rows with id, user_id and their current status) to
+    `status` in their users' summaries, one UPDATE per user. Call it before
+    the orders' status changes; caller commits. Users without a summary yet
+    are backfilled first (with the old statuses), then moved.
+    """
+    changed = [o for o in orders if o.status != status]
+    if not changed:
+        return
+
+    # Only orders entering or leaving "cancelled" change the lifetime total
+    flips = [o.id for o in changed if (o.status == "cancelled") != (status == "cancelled")]
+    totals = _order_totals(db, models.Order.id.in_(flips)) if flips else {}
+
+    per_user = {}
+    for o in changed:
+        entry = per_user.setdefault(o.user_id, {"counts": {}, "total": 0, "order_ids": []})
+        old_name = _status_count_column(o.status).key
+        new_name = _status_count_column(status).key
+        entry["counts"][old_name] = entry["counts"].get(old_name, 0) - 1
+        entry["counts"][new_name] = entry["counts"].get(new_name, 0) + 1
+        entry["total"] += totals.get(o.id, 0) * (1 if o.status == "cancelled" else -1)
+        entry["order_ids"].append(o.id)
+
+    summary = models.UserOrderSummary
+    for user_id, entry in per_user.items():
+        values = {
+            getattr(summary, name): getattr(summary, name) + n
+            for name, n in entry["counts"].items() if n
+        }
+        if entry["total"]:
+            values[summary.lifetime_total] = summary.lifetime_total + entry["total"]
+        values[summary.last_order_status] = case(
+            (summary.last_order_id.in_(entry["order_ids"]), status),
+            else_=summary.last_order_status
+        )
+        if not db.query(summary).filter(summary.user_id == user_id).update(values, synchronize_session=False):
+            # Whoever creates the row (this backfill or a concurrent one) saw the old statuses
+            _rebuild_user_order_summary(db, user_id)
+            db.query(summary).filter(summary.user_id == user_id).update(values, synchronize_session=False)
+
+
+def get_user_order_summary(db: Session, user_id: str):
+    """Read-only: users without a summary row yet get one computed on the fly; order writes backfill it."""
+    summary = db.query(models.UserOrderSummary).filter(
+        models.UserOrderSummary.user_id == user_id
+    ).first()
+    if summary is None:
+        summary = _compute_user_order_summary(db, user_id)
+    if summary is None:
+        return schemas.UserOrderSummary(
+            user_id=user_id,
+            status_counts={**{status: 0 for status in ORDER_STATUS_RANK}, "other": 0}
+        )
+
+    return schemas.UserOrderSummary(
+        user_id=user_id,
+        order_count=summary.order_count,
+        status_counts={
+            **{status: getattr(summary, f"{status}_count") for status in ORDER_STATUS_RANK},
+            "other": summary.other_count,
+        },
+        lifetime_total=summary.lifetime_total,
+        last_order_id=summary.last_order_id,
+        last_order_time=summary.last_order_time,
+        last_order_status=summary.last_order_status,
+    )
+
+
+# -------------------------
+# IDEMPOTENCY FUNCTIONS
+# -------------------------
+IDEMPOTENCY_TTL = timedelta(hours=int(os.getenv("IDEMPOTENCY_TTL_HOURS", "24")))
+# How long a retry waits for the first request with its key before getting 409
+IDEMPOTENCY_WAIT_MS = int(os.getenv("IDEMPOTENCY_WAIT_MS", "2000"))
+# Share of claims that also delete a batch of expired keys
+IDEMPOTENCY_PURGE_RATE = float(os.getenv("IDEMPOTENCY_PURGE_RATE", "0.01"))
+IDEMPOTENCY_PURGE_BATCH = 500
+
+
+class IdempotencyKeyBusy(Exception):
+    """Another request holding the same Idempotency-Key has not finished yet."""
+
+
+def purge_idempotency_keys(db: Session, limit: int = IDEMPOTENCY_PURGE_BATCH) -> int:
+    """Delete up to `limit` expired keys, oldest first. Returns how many went."""
+    expired = (
+        select(models.IdempotencyKey.user_id, models.IdempotencyKey.key)
+        .where(models.IdempotencyKey.expires_at <= datetime.utcnow())
+        .order_by(models.IdempotencyKey.expires_at)
+        .limit(limit)
+    )
+    rows = db.execute(expired).all()
+    if not rows:
+        return 0
+    db.query(models.IdempotencyKey).filter(
+        or_(*(
+            and_(models.IdempotencyKey.user_id == user_id, models.IdempotencyKey.key == key)
+            for user_id, key in rows
+        ))
+    ).delete(synchronize_session=False)
+    return len(rows)
+
+
+def claim_idempotency_key(db: Session, user_id: str, key: str, scope: str, fingerprint: str):
+    """
+    Insert the claim for `key` into the caller's open transaction. Returns None
+    if the caller now owns the key, otherwise the finished record.
+
+    The claim is only committed together with the handler's writes and response
+    (save_idempotency_response), so there is no in-flight state to go stale: a
+    crashed request rolls its claim back with everything else. A concurrent
+    retry blocks on the unique key until the first request commits or rolls
+    back; if that takes longer than IDEMPOTENCY_WAIT_MS it raises
+    IdempotencyKeyBusy.
+    """
+    if random.random() < IDEMPOTENCY_PURGE_RATE:
+        purge_idempotency_keys(db)
+        db.commit()
+
+    now = datetime.utcnow()
+    postgres = db.get_bind().dialect.name == "postgresql"
+    try:
+        if postgres:
+            previous = db.execute(text("SHOW lock_timeout")).scalar()
+            db.execute(
+                text("SELECT set_config('lock_timeout', :wait, true)"),
+                {"wait": f"{IDEMPOTENCY_WAIT_MS}ms"}
+            )
+        # Claims are never committed without a response, so a row with no status
+        # is left over from before that was the case and cannot still be running
+        db.query(models.IdempotencyKey).filter(
+            models.IdempotencyKey.user_id == user_id,
+            models.IdempotencyKey.key == key,
+            or_(models.IdempotencyKey.expires_at <= now, models.IdempotencyKey.status_code.is_(None))
+        ).delete(synchronize_session=False)
+        with db.begin_nested():
+            db.add(models.IdempotencyKey(
+                user_id=user_id,
+                key=key,
+                scope=scope,
+                fingerprint=fingerprint,
+                created_at=now,
+                expires_at=now + IDEMPOTENCY_TTL
+            ))
+        if postgres:
+            db.execute(text("SELECT set_config('lock_timeout', :previous, true)"), {"previous": previous})
+    except IntegrityError:
+        # The first request with this key committed while we waited
+        db.rollback()
+        return db.query(models.IdempotencyKey).filter(
+            models.IdempotencyKey.user_id == user_id,
+            models.IdempotencyKey.key == key
+        ).first()
+    except OperationalError as e:
+        if getattr(e.orig, "pgcode", None) == "55P03" or "database is locked" in str(e):
+            db.rollback()
+            raise IdempotencyKeyBusy(key) from e
+        raise
+    return None
+
+
+def save_idempotency_response(db: Session, user_id: str, key: str, status_code: int, body):
+    """Record the response on a claim. The caller commits it with the handler's writes."""
+    db.query(models.IdempotencyKey).filter(
+        models.IdempotencyKey.user_id == user_id,
+        models.IdempotencyKey.key == key
+    ).update(
+        {"status_code": status_code, "response_body": json.dumps(body)},
+        synchronize_session=False
+    )
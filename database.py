@@ -1,5 +1,12 @@
 # database.py
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.schema import CreateColumn, CreateIndex
+import logging
+import random
+import time
+from slow_query import SlowQueryLog
+from circuit_breaker import CircuitBreaker
 from sqlalchemy.orm import sessionmaker, declarative_base
 from dotenv import load_dotenv
 import os
@@ -10,20 +17,175 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 if not DATABASE_URL:
     raise ValueError("DATABASE_URL not found in environment variables")
 
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+
 engine = create_engine(
     DATABASE_URL,
     pool_pre_ping=True,
     pool_recycle=300,
-    pool_size=5,
-    max_overflow=10
+    pool_size=POOL_SIZE,
+    max_overflow=MAX_OVERFLOW
 )
+if engine.dialect.name == "sqlite":
+    # SQLite ignores ON DELETE CASCADE unless foreign keys are switched on per connection
+    @event.listens_for(engine, "connect")
+    def _enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+# Statements slower than SLOW_QUERY_MS are kept (with plans) for /admin/slow-queries; 0 disables
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+slow_queries = SlowQueryLog(threshold_ms=SLOW_QUERY_MS)
+if SLOW_QUERY_MS > 0:
+    slow_queries.install(engine)
+
+# -------------------------
+# CIRCUIT BREAKER
+# -------------------------
+# DB_BREAKER_THRESHOLD consecutive OperationalErrors (other than pre-ping
+# disconnects and lock contention) open the breaker; get_db
+# then fails fast until a background probe gets through again.
+DB_BREAKER_THRESHOLD = int(os.getenv("DB_BREAKER_THRESHOLD", "5"))
+DB_RETRY_ATTEMPTS = int(os.getenv("DB_RETRY_ATTEMPTS", "3"))
+DB_RETRY_BASE_DELAY = float(os.getenv("DB_RETRY_BASE_MS", "50")) / 1000
+
+def _probe_database():
+    with engine.connect() as conn:
+        conn.exec_driver_sql("SELECT 1")
+
+breaker = CircuitBreaker("db_breaker", _probe_database, failure_threshold=DB_BREAKER_THRESHOLD)
+
+# Lock contention, not an unhealthy database: serialization failure, deadlock,
+# lock timeout (Postgres SQLSTATEs) and SQLite's busy timeout
+CONTENTION_PGCODES = {"40001", "40P01", "55P03"}
+
+def _is_contention(error) -> bool:
+    return getattr(error, "pgcode", None) in CONTENTION_PGCODES or "database is locked" in str(error)
+
+@event.listens_for(engine, "handle_error")
+def _record_db_error(context):
+    if context.is_pre_ping:
+        # The pool discards the dead connection and connects again on its own
+        return
+    if _is_contention(context.original_exception):
+        return
+    if context.is_disconnect or isinstance(context.sqlalchemy_exception, OperationalError):
+        breaker.record_failure()
+
+@event.listens_for(engine, "after_cursor_execute")
+def _record_db_success(conn, cursor, statement, parameters, context, executemany):
+    breaker.record_success()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
 
+logger = logging.getLogger(__name__)
+
+def _drop_invalid_indexes(conn, names):
+    """
+    A CREATE INDEX CONCURRENTLY that failed leaves an INVALID index behind,
+    which IF NOT EXISTS would then skip. Drop those so they are built again.
+    """
+    invalid = conn.execute(text(
+        "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE NOT i.indisvalid AND c.relname = ANY(:names)"
+    ), {"names": list(names)}).scalars().all()
+    for name in invalid:
+        logger.warning(f"Dropping invalid index {name} left by an earlier migration")
+        conn.execute(text(f"DROP INDEX CONCURRENTLY IF EXISTS {engine.dialect.identifier_preparer.quote(name)}"))
+
+def create_index(index):
+    """
+    CREATE INDEX IF NOT EXISTS; CONCURRENTLY on Postgres, so building it on a
+    live table does not block writes. Raises if the index cannot be created.
+    """
+    # IF NOT EXISTS rather than checkfirst: expression indexes such as
+    # lower(email) cannot be reflected, so checkfirst would miss them
+    if engine.dialect.name != "postgresql":
+        with engine.begin() as conn:
+            conn.execute(CreateIndex(index, if_not_exists=True))
+        return
+
+    options = index.dialect_options["postgresql"]
+    concurrently = options["concurrently"]
+    options["concurrently"] = True
+    try:
+        # CONCURRENTLY cannot run inside a transaction block
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            _drop_invalid_indexes(conn, [index.name])
+            conn.execute(CreateIndex(index, if_not_exists=True))
+    finally:
+        options["concurrently"] = concurrently
+
+def sync_schema(metadata):
+    """
+    create_all() only creates missing tables. For tables that already exist,
+    add columns and indexes that were added to the models later. Part of the
+    migration step (see migrate.py), never run at import. Raises if any column
+    or index could not be added, after trying all of them.
+    """
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    preparer = engine.dialect.identifier_preparer
+    failures = []
+
+    for table in metadata.sorted_tables:
+        if table.name in existing_tables:
+            existing_columns = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_ddl = CreateColumn(column).compile(dialect=engine.dialect)
+                try:
+                    with engine.begin() as conn:
+                        conn.execute(text(f"ALTER TABLE {preparer.format_table(table)} ADD COLUMN {column_ddl}"))
+                    logger.info(f"Added column {table.name}.{column.name}")
+                except Exception as e:
+                    logger.error(f"Could not add column {table.name}.{column.name}: {e}")
+                    failures.append(f"column {table.name}.{column.name}")
+
+        for index in table.indexes:
+            try:
+                create_index(index)
+            except Exception as e:
+                logger.error(f"Could not create index {index.name}: {e}")
+                failures.append(f"index {index.name}")
+
+    if failures:
+        raise RuntimeError(f"Schema sync failed for: {', '.join(failures)}")
+
 def get_db():
+    breaker.check()  # CircuitOpen -> 503 (see main.py)
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+def get_db_if_available():
+    """Like get_db, but yields None while the breaker is open, for endpoints that can serve stale data."""
+    if breaker.is_open:
+        yield None
+        return
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+def with_retries(db, load, attempts: int = DB_RETRY_ATTEMPTS):
+    """
+    Run the read-only `load()`, retrying transient OperationalErrors with
+    jittered exponential backoff. Gives up at once if the breaker opens.
+    """
+    for attempt in range(attempts):
+        try:
+            return load()
+        except OperationalError:
+            db.rollback()
+            if attempt == attempts - 1 or breaker.is_open:
+                raise
+            time.sleep(random.uniform(0, DB_RETRY_BASE_DELAY * 2 ** attempt))
\ No newline at end of file
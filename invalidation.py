@@ -0,0 +1,242 @@
+# invalidation.py
+import json
+import logging
+import os
+import queue
+import select
+import threading
+import time
+import uuid
+from typing import Iterable
+
+from sqlalchemy import create_engine, delete, event, func, insert, select as sql_select, text
+from sqlalchemy.pool import NullPool
+
+import cache
+import database
+import models
+
+logger = logging.getLogger(__name__)
+
+# -------------------------
+# CONFIG
+# -------------------------
+# CACHE_BUS: "auto" (NOTIFY on Postgres, outbox table elsewhere), "outbox", or "off"
+CACHE_BUS = os.getenv("CACHE_BUS", "auto")
+CHANNEL = "cache_invalidation"
+OUTBOX_POLL_INTERVAL = float(os.getenv("CACHE_OUTBOX_POLL_MS", "250")) / 1000
+# How often the NOTIFY listener sends the invalidations committed since its last send
+PUBLISH_INTERVAL = float(os.getenv("CACHE_PUBLISH_MS", "50")) / 1000
+OUTBOX_RETENTION = 300  # seconds; rows older than this are pruned
+MAX_PAYLOAD_BYTES = 7000  # NOTIFY payloads must stay under 8000 bytes
+
+# Caches other processes can invalidate, by name
+CACHES = {
+    "catalog": cache.catalog,
+    "catalog_lists": cache.catalog_lists,
+    "principals": cache.principals,
+}
+
+# Identifies this process, so it skips its own messages
+ORIGIN = uuid.uuid4().hex
+
+
+def invalidate(session, cache_name: str, keys: Iterable, broadcast: bool = True):
+    """
+    Drop `keys` from `cache_name` once the session commits. A None key clears
+    the whole cache. The local cache is cleared right after the commit.
+
+    With broadcast, other processes are told too: the bus thread sends what
+    was committed since its last send as one batch, on its own connection, so
+    the writer's transaction never takes Postgres' NOTIFY commit lock. A crash
+    between the commit and the send loses the message; the caches' TTL covers
+    that. Without broadcast, other processes catch up within the TTL.
+    """
+    name = "pending_invalidations" if broadcast else "local_invalidations"
+    session.info.setdefault(name, set()).update((cache_name, key) for key in keys)
+
+
+def _apply(cache_name: str, keys: Iterable):
+    target = CACHES.get(cache_name)
+    if target is None:
+        return
+    for key in keys:
+        if key is None:
+            target.clear()
+        else:
+            target.invalidate(key)
+
+
+def _group(pending):
+    by_cache = {}
+    for cache_name, key in pending:
+        by_cache.setdefault(cache_name, []).append(key)
+    return by_cache
+
+
+def _messages(pending):
+    """JSON messages of at most MAX_PAYLOAD_BYTES, one cache per message."""
+    for cache_name, keys in _group(pending).items():
+        batch, size = [], 0
+        for key in keys:
+            key_size = len(json.dumps(key)) + 2
+            if batch and size + key_size > MAX_PAYLOAD_BYTES:
+                yield json.dumps({"origin": ORIGIN, "cache": cache_name, "keys": batch})
+                batch, size = [], 0
+            batch.append(key)
+            size += key_size
+        if batch:
+            yield json.dumps({"origin": ORIGIN, "cache": cache_name, "keys": batch})
+
+
+def _handle_message(payload: str):
+    try:
+        message = json.loads(payload)
+    except ValueError:
+        logger.error(f"Bad cache invalidation payload: {payload[:200]}")
+        return
+    if message.get("origin") == ORIGIN:
+        return
+    _apply(message.get("cache"), message.get("keys", []))
+
+
+# -------------------------
+# BUS
+# -------------------------
+class InvalidationBus:
+    """
+    Sends committed invalidations to other processes and applies theirs.
+    `install` hooks a session factory; `start` runs the listener thread.
+    """
+
+    def __init__(self, engine, mode: str = CACHE_BUS):
+        if mode == "auto":
+            mode = "notify" if engine.dialect.name == "postgresql" else "outbox"
+        self.engine = engine
+        self.mode = mode
+        self._thread = None
+        self._stop = threading.Event()
+        self._outgoing = queue.SimpleQueue()
+
+    def install(self, session_factory):
+        event.listen(session_factory, "after_commit", self._after_commit)
+        event.listen(session_factory, "after_soft_rollback", self._after_rollback)
+
+    def _after_commit(self, session):
+        pending = session.info.pop("pending_invalidations", None) or set()
+        local = session.info.pop("local_invalidations", None) or set()
+        for cache_name, keys in _group(pending | local).items():
+            _apply(cache_name, keys)
+        # Only while the bus thread runs to send them, so nothing piles up
+        if pending and self._thread is not None and self._thread.is_alive():
+            self._outgoing.put(pending)
+
+    def _after_rollback(self, session, previous_transaction):
+        if previous_transaction.parent is None:
+            session.info.pop("pending_invalidations", None)
+            session.info.pop("local_invalidations", None)
+
+    def start(self):
+        if self.mode == "off" or (self._thread and self._thread.is_alive()):
+            return
+        target = self._listen_notify if self.mode == "notify" else self._poll_outbox
+        self._thread = threading.Thread(target=target, name="cache-invalidation", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _take_outgoing(self):
+        pending = set()
+        while True:
+            try:
+                pending |= self._outgoing.get_nowait()
+            except queue.Empty:
+                return pending
+
+    def _publish(self, conn):
+        """Send everything committed since the last call, in one transaction."""
+        pending = self._take_outgoing()
+        if not pending:
+            return
+        payloads = list(_messages(pending))
+        try:
+            if self.mode == "notify":
+                params = {"channel": CHANNEL, **{f"p{i}": payload for i, payload in enumerate(payloads)}}
+                calls = ", ".join(f"pg_notify(:channel, :p{i})" for i in range(len(payloads)))
+                conn.execute(text(f"SELECT {calls}"), params)
+            else:
+                now = time.time()
+                conn.execute(insert(models.CacheInvalidation), [
+                    {"payload": payload, "created_at": now} for payload in payloads
+                ])
+                conn.commit()
+        except Exception:
+            # Try again with the next batch once the connection is back
+            self._outgoing.put(pending)
+            raise
+
+    def _clear_all(self):
+        # Messages may have been missed while disconnected
+        for target in CACHES.values():
+            target.clear()
+
+    def _listen_notify(self):
+        listen_engine = create_engine(self.engine.url, poolclass=NullPool)
+        while not self._stop.is_set():
+            try:
+                with listen_engine.connect() as conn:
+                    conn = conn.execution_options(isolation_level="AUTOCOMMIT")
+                    conn.exec_driver_sql(f"LISTEN {CHANNEL}")
+                    dbapi_conn = conn.connection.dbapi_connection
+                    self._clear_all()
+                    while not self._stop.is_set():
+                        if select.select([dbapi_conn], [], [], PUBLISH_INTERVAL) != ([], [], []):
+                            dbapi_conn.poll()
+                            while dbapi_conn.notifies:
+                                _handle_message(dbapi_conn.notifies.pop(0).payload)
+                        self._publish(conn)
+            except Exception as e:
+                logger.error(f"Cache invalidation listener lost its connection: {e}")
+                self._stop.wait(1)
+
+    def _poll_outbox(self):
+        # Outbox ids are read in order; fine for SQLite's single writer. Use
+        # NOTIFY on Postgres, where concurrent transactions commit out of id order.
+        last_id = None
+        last_prune = 0.0
+        while not self._stop.wait(OUTBOX_POLL_INTERVAL):
+            try:
+                with self.engine.connect() as conn:
+                    self._publish(conn)
+                    if last_id is None:
+                        last_id = conn.execute(
+                            sql_select(func.coalesce(func.max(models.CacheInvalidation.id), 0))
+                        ).scalar()
+                        continue
+                    rows = conn.execute(
+                        sql_select(models.CacheInvalidation.id, models.CacheInvalidation.payload)
+                        .where(models.CacheInvalidation.id > last_id)
+                        .order_by(models.CacheInvalidation.id)
+                    ).fetchall()
+                    for row in rows:
+                        _handle_message(row.payload)
+                        last_id = row.id
+
+                    now = time.time()
+                    if now - last_prune > OUTBOX_RETENTION:
+                        conn.execute(
+                            delete(models.CacheInvalidation)
+                            .where(models.CacheInvalidation.created_at < now - OUTBOX_RETENTION)
+                        )
+                        conn.commit()
+                        last_prune = now
+            except Exception as e:
+                logger.error(f"Cache invalidation outbox poll failed: {e}")
+                self._clear_all()
+
+
+# Hooked into every session at import, so crud's invalidations always apply
+# locally; main.py starts the listener that applies other processes' ones.
+bus = InvalidationBus(database.engine)
+bus.install(database.SessionLocal)
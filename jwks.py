@@ -0,0 +1,113 @@
+# jwks.py
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class JWKSCache:
+    """
+    Signing keys from a JWKS document, cached in memory by `kid`.
+
+    Known kids are served from memory. Once the key set is older than `ttl`
+    it is refreshed on a background thread, so verification never waits on the
+    network; get_key is called from the async admission middleware. An unknown
+    kid (key rotation) starts the same single background refetch, at most once
+    per `min_refetch_interval` seconds, and is rejected until it has finished.
+    Call refresh() at startup so the first requests find the keys loaded.
+    """
+
+    def __init__(
+        self,
+        url: Optional[str] = None,
+        path: Optional[str] = None,
+        ttl: float = 600,
+        min_refetch_interval: float = 30,
+        timeout: float = 5,
+    ):
+        if not url and not path:
+            raise ValueError("JWKSCache needs a url or a path")
+        self.url = url
+        self.path = path
+        self.ttl = ttl
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+        self._keys: Dict[str, dict] = {}
+        self._fetched_at = 0.0
+        self._attempted_at = 0.0
+        self._fetch_lock = threading.Lock()
+        self._state_lock = threading.Lock()
+        self._refreshing = False
+
+    def _load(self) -> Dict[str, dict]:
+        if self.path:
+            with open(self.path, encoding="utf-8") as f:
+                document = json.load(f)
+        else:
+            response = requests.get(self.url, timeout=self.timeout)
+            response.raise_for_status()
+            document = response.json()
+        return {key["kid"]: key for key in document.get("keys", []) if "kid" in key}
+
+    def refresh(self):
+        """Fetch the key set now. Keeps the previous keys if the fetch fails."""
+        self._attempted_at = time.monotonic()
+        try:
+            keys = self._load()
+        except Exception as e:
+            logger.error(f"JWKS refresh failed: {e}")
+            return
+        self._keys = keys
+        self._fetched_at = time.monotonic()
+
+    def _refresh_in_background(self):
+        with self._state_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+
+        def run():
+            try:
+                with self._fetch_lock:
+                    self.refresh()
+            finally:
+                self._refreshing = False
+
+        threading.Thread(target=run, name="jwks-refresh", daemon=True).start()
+
+    def get_key(self, kid: Optional[str]) -> Optional[dict]:
+        if kid is None:
+            return None
+
+        key = self._keys.get(kid)
+        if key is not None:
+            now = time.monotonic()
+            if now - self._fetched_at > self.ttl and now - self._attempted_at > self.min_refetch_interval:
+                self._refresh_in_background()
+            return key
+
+        # Unknown kid: fetch the key set in the background and reject meanwhile
+        if self._attempted_at == 0.0 or time.monotonic() - self._attempted_at > self.min_refetch_interval:
+            self._refresh_in_background()
+        return None
+
+
+def from_env() -> Optional[JWKSCache]:
+    """
+    JWKS source from SUPABASE_JWKS_FILE, SUPABASE_JWKS_URL, or the project's
+    well-known endpoint under SUPABASE_URL. None if nothing is configured.
+    """
+    path = os.getenv("SUPABASE_JWKS_FILE")
+    url = os.getenv("SUPABASE_JWKS_URL")
+    supabase_url = os.getenv("SUPABASE_URL")
+    if not url and supabase_url:
+        url = f"{supabase_url.rstrip('/')}/auth/v1/.well-known/jwks.json"
+    if not path and not url:
+        return None
+    return JWKSCache(url=url, path=path, ttl=float(os.getenv("JWKS_TTL_SECONDS", "600")))
@@ -1,10 +1,20 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Query, Request, Response, UploadFile, File
+from fastapi import FastAPI, Depends, HTTPException, status, Query, Request, Response, UploadFile, File, Header
+from fastapi.encoders import jsonable_encoder
+from fastapi.concurrency import run_in_threadpool
+from pydantic import ValidationError
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from sqlalchemy.orm import Session
-from typing import Annotated, List, Optional 
+from typing import Annotated, List, Optional, Union
 from datetime import timedelta
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 import models, schemas, crud, database
+import rate_limit
+import bulk_import
+import bloom
+import profiler
+import metrics
+import invalidation
 from email_func import send_welcome
 import logging
 import json
@@ -16,6 +26,11 @@ import auth
 from dotenv import load_dotenv
 import os
 import requests
+import hashlib
+import hmac
+import time
+import cache
+from circuit_breaker import CircuitOpen
 
 load_dotenv()
 
@@ -23,6 +38,8 @@ SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
 ALGORITHM = os.getenv("ALGORITHM", "HS256")
 SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_SERVICE_ROLE = os.getenv("SUPABASE_SERVICE_ROLE")
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")
+CRON_SECRET = os.getenv("CRON_SECRET")
 
 # Custom auth dependency that handles both JWT and simple user ID tokens
 def verify_token(credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer())) -> str:
@@ -33,7 +50,7 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer(
     
     # First try to decode as JWT
     try:
-        payload = jwt.decode(token, SUPABASE_JWT_SECRET, algorithms=[ALGORITHM], audience="authenticated")
+        payload = auth.decode_token(token, audience="authenticated")
         return payload.get("sub")  # Return user ID from JWT
     except JWTError:
         # If JWT decode fails, treat as simple user ID for testing
@@ -42,12 +59,48 @@ def verify_token(credentials: HTTPAuthorizationCredentials = Depends(HTTPBearer(
             return token
         raise HTTPException(status_code=401, detail="Invalid token format")
 
+def verify_active_user(credentials: HTTPAuthorizationCredentials, db: Session) -> str:
+    """
+    verify_token, plus a check (cached in auth.get_user_principal) that the
+    user has a profile (401) that is not disabled (403).
+    """
+    user_id = verify_token(credentials)
+    auth.get_user_principal(db, user_id, HTTPException(status_code=401, detail="User profile not found"))
+    return user_id
+
+def decode_subject(token: str) -> Optional[str]:
+    """
+    Return the user ID of a verified JWT, or None. Unlike verify_token there is
+    no plain-user-ID fallback, so unverified tokens cannot pick their own identity.
+    """
+    try:
+        payload = auth.decode_token(token, audience="authenticated")
+    except JWTError:
+        return None
+    return payload.get("sub")
+
+# Admin-only endpoints: X-Admin-Token must match ADMIN_TOKEN (disabled when unset)
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    if not ADMIN_TOKEN or not x_admin_token or not hmac.compare_digest(x_admin_token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Admin access required")
+
+# Scheduled jobs (vercel.json "crons"): Vercel sends GET with
+# "Authorization: Bearer $CRON_SECRET" (disabled when unset)
+def require_cron(authorization: Optional[str] = Header(None)):
+    if not CRON_SECRET or not authorization or not hmac.compare_digest(authorization, f"Bearer {CRON_SECRET}"):
+        raise HTTPException(status_code=403, detail="Cron access required")
+
 # Set up logging
 logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
+# New columns, indexes and backfills for existing tables are applied by
+# migrate.py, run once per deploy rather than on every cold start
 models.Base.metadata.create_all(bind=database.engine)
 
+# Apply other processes' cache invalidations (NOTIFY on Postgres, outbox elsewhere)
+invalidation.bus.start()
+
 origins = [
     "http://localhost:8080",
     "http://127.0.0.1:8000",
@@ -59,6 +112,122 @@ app = FastAPI(title='User Management API')
 
 bearer_scheme = HTTPBearer()
 
+# get_db fails fast while the database circuit breaker is open
+@app.exception_handler(CircuitOpen)
+async def database_circuit_open(request: Request, exc: CircuitOpen):
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Database unavailable, please try again later"},
+        headers={"Retry-After": rate_limit.retry_after_header(exc.retry_after)}
+    )
+
+# -------------------------
+# ADMISSION CONTROL (rate limit + DB pool concurrency gate)
+# -------------------------
+concurrency_gate = rate_limit.ConcurrencyGate(database.POOL_SIZE + database.MAX_OVERFLOW)
+
+@app.middleware("http")
+async def admission_control(request: Request, call_next):
+    path = request.url.path
+    if path in rate_limit.EXEMPT_PATHS or request.method == "OPTIONS":
+        return await call_next(request)
+
+    identity = None
+    authorization = request.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        subject = decode_subject(authorization[7:].strip())
+        if subject:
+            identity = f"user:{subject}"
+    if identity is None:
+        identity = f"ip:{request.client.host if request.client else 'unknown'}"
+
+    route_class = rate_limit.classify_route(request.method, path)
+    allowed, retry_after = rate_limit.check_rate_limit(identity, route_class)
+    if not allowed:
+        return JSONResponse(
+            status_code=429,
+            content={"detail": "Too many requests, please slow down"},
+            headers={"Retry-After": rate_limit.retry_after_header(retry_after)},
+        )
+
+    if not await concurrency_gate.acquire():
+        logger.warning(f"Shedding {request.method} {path}: all {concurrency_gate.limit} DB slots busy")
+        return JSONResponse(
+            status_code=503,
+            content={"detail": "Server busy, please try again shortly"},
+            headers={"Retry-After": rate_limit.retry_after_header(1)},
+        )
+    try:
+        response = await call_next(request)
+    except BaseException:
+        concurrency_gate.release()
+        raise
+    # Hold the slot until the body is sent: /products?stream=true reads the DB while streaming
+    return rate_limit.ReleaseAfterSend(response, concurrency_gate.release)
+
+# -------------------------
+# OPT-IN REQUEST PROFILER (only installed when configured)
+# -------------------------
+if profiler.ENABLED:
+    @app.middleware("http")
+    async def request_profiler(request: Request, call_next):
+        if not profiler.should_profile(request.headers.get("x-profile-token")):
+            return await call_next(request)
+        profile = profiler.try_profile(request.method, request.url.path)
+        if profile is None:
+            return await call_next(request)
+        with profile:
+            response = await call_next(request)
+        response.headers["X-Profile-Wall-Ms"] = f"{profile.wall_time * 1000:.1f}"
+        return response
+
+# -------------------------
+# IDEMPOTENCY (Idempotency-Key header on retried writes)
+# -------------------------
+def run_idempotent(db: Session, idempotency_key: Optional[str], user_id: str, scope: str, payload, handler):
+    """
+    Run `handler` at most once per (user, Idempotency-Key). Retries with the same
+    key and body get the stored response back without repeating the writes.
+    `handler` must not commit: its writes, the claim and the stored response
+    are committed together here, so a crash never leaves a half-done key.
+    """
+    if not idempotency_key:
+        result = handler()
+        db.commit()
+        return result
+    if len(idempotency_key) > 255:
+        raise HTTPException(status_code=400, detail="Idempotency-Key too long")
+
+    body = json.dumps(jsonable_encoder(payload), sort_keys=True)
+    fingerprint = hashlib.sha256(f"{scope}\n{body}".encode()).hexdigest()
+
+    try:
+        record = crud.claim_idempotency_key(db, user_id, idempotency_key, scope, fingerprint)
+    except crud.IdempotencyKeyBusy:
+        raise HTTPException(
+            status_code=409,
+            detail="A request with this Idempotency-Key is still in progress",
+            headers={"Retry-After": "1"},
+        )
+    if record is not None:
+        if record.fingerprint != fingerprint:
+            raise HTTPException(status_code=422, detail="Idempotency-Key was already used with a different request")
+        return JSONResponse(
+            status_code=record.status_code,
+            content=json.loads(record.response_body),
+            headers={"Idempotent-Replayed": "true"},
+        )
+
+    try:
+        result = handler()
+        crud.save_idempotency_response(db, user_id, idempotency_key, 200, jsonable_encoder(result))
+        db.commit()
+    except Exception:
+        # The claim rolls back with the writes, so the request can be retried
+        db.rollback()
+        raise
+    return result
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=['*'],
@@ -87,6 +256,40 @@ def get_test_token():
     token = jwt.encode(payload, SUPABASE_JWT_SECRET, algorithm=ALGORITHM)
     return {"access_token": token}
 
+# -------------------------
+# USERNAME / EMAIL AVAILABILITY (live signup validation)
+# -------------------------
+taken_names = bloom.TakenNamesFilter(max_age=float(os.getenv("TAKEN_NAMES_REBUILD_SECONDS", "600")))
+
+def load_taken_names():
+    # Runs on the filter's rebuild thread, so it cannot share the request's session
+    with database.SessionLocal() as db:
+        return crud.get_all_usernames_and_emails(db)
+
+@app.get("/profiles/availability")
+def check_availability(
+    username: Optional[str] = Query(None),
+    email: Optional[str] = Query(None),
+    db: Session = Depends(database.get_db)
+):
+    """
+    Definite "available" answers come from the in-memory Bloom filter; only
+    possible conflicts are confirmed against the database.
+    """
+    if username is None and email is None:
+        raise HTTPException(status_code=400, detail="Provide username and/or email")
+
+    taken_names.ensure_fresh(load_taken_names)
+
+    result = {}
+    if username is not None:
+        taken = taken_names.might_be_taken("username", username) and crud.is_username_taken(db, username)
+        result["username_available"] = not taken
+    if email is not None:
+        taken = taken_names.might_be_taken("email", email) and crud.is_email_taken(db, email)
+        result["email_available"] = not taken
+    return result
+
 # -------------------------
 # CREATE USER PROFILE (called by frontend after Supabase signup)
 # -------------------------
@@ -102,7 +305,7 @@ async def create_profile(
     # For JWT tokens, also verify email match
     token = credentials.credentials
     try:
-        payload = jwt.decode(token, SUPABASE_JWT_SECRET, algorithms=[ALGORITHM], audience="authenticated")
+        payload = auth.decode_token(token, audience="authenticated")
         email_from_token: str = payload.get("email")
         if email_from_token and user.email != email_from_token:
             raise HTTPException(status_code=401, detail="Token/email mismatch")
@@ -117,6 +320,8 @@ async def create_profile(
         raise HTTPException(status_code=400, detail="Email already registered")
 
     created_user = crud.create_user(db, user, supabase_user_id)
+    taken_names.add("username", created_user.username)
+    taken_names.add("email", created_user.email)
     send_welcome(to_email=created_user.email, to_name=created_user.name or "there")
     return created_user
 
@@ -197,12 +402,164 @@ def update_user(
         raise HTTPException(status_code=404, detail="User not found")
     return crud.update_user(db, db_user, user_update)
 
+# -------------------------
+# STALE CATALOG FALLBACK
+# -------------------------
+def stale_headers(age: float):
+    return {"Age": str(int(age)), "X-Served-Stale": "true"}
+
+
+def database_unavailable():
+    return HTTPException(
+        status_code=503,
+        detail="Database unavailable, please try again later",
+        headers={"Retry-After": "5"}
+    )
+
+
+def serve_catalog(db: Optional[Session], key, load):
+    """
+    Run the read `load()` with retries on transient errors and keep the result
+    as the last good snapshot for `key`. If the database is down (breaker open,
+    or retries exhausted) return that snapshot instead. Returns (result, headers);
+    headers are set only for stale results.
+    """
+    if db is not None:
+        try:
+            result = database.with_retries(db, load)
+        except OperationalError as e:
+            logger.error(f"Catalog read failed, serving last good snapshot: {str(e)}")
+        else:
+            if result is not None:
+                cache.snapshots.set(key, (result, time.time()))
+            return result, {}
+
+    snapshot = cache.snapshots.get(key)
+    if snapshot is None:
+        raise database_unavailable()
+    result, stored_at = snapshot
+    return result, stale_headers(time.time() - stored_at)
+
+
 # -------------------------
 # GET ALL PRODUCTS
 # -------------------------
-@app.get("/products", response_model=List[schemas.ProductResponse])
-def get_all_products(db: Session = Depends(database.get_db)):
-    return crud.get_all_products_with_reviews(db)
+STREAM_CHUNK_BYTES = 64 * 1024
+
+
+def stream_products_json(fields):
+    """
+    The catalog as a JSON array, written incrementally in ~64 KiB chunks.
+    Uses its own session: the request's session is closed once streaming starts.
+    """
+    db = database.SessionLocal()
+    try:
+        chunk = ["["]
+        size = 1
+        first = True
+        for product in crud.iter_products(db, fields):
+            body = product.model_dump_json() if fields is None else json.dumps(jsonable_encoder(product))
+            if not first:
+                body = "," + body
+            first = False
+            chunk.append(body)
+            size += len(body)
+            if size >= STREAM_CHUNK_BYTES:
+                yield "".join(chunk)
+                chunk, size = [], 0
+        chunk.append("]")
+        yield "".join(chunk)
+    except Exception as e:
+        # Headers are already sent; the truncated array tells the client it failed
+        logger.error(f"Catalog stream failed: {str(e)}")
+        raise
+    finally:
+        db.close()
+
+
+@app.get(
+    "/products",
+    response_model=Union[List[schemas.ProductResponse], List[schemas.ProductCard], List[schemas.ProductProjection]]
+)
+def get_all_products(
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return, e.g. id,name,min_price"),
+    view: Optional[str] = Query(None, description="Named projection: card"),
+    stream: bool = Query(False, description="Stream the JSON array as rows are read"),
+    db: Optional[Session] = Depends(database.get_db_if_available)
+):
+    """
+    Full products by default. With ?view=card or ?fields=... only those fields
+    are selected and returned, for grids and other list views. ?stream=true
+    sends the array while rows are still being read instead of building it
+    in memory first.
+
+    Response shapes: ProductResponse by default, ProductCard for ?view=card,
+    and ProductProjection for ?fields= (only `id` and the requested keys are
+    present). The body is built here, not by response_model, so projected
+    fields are left out rather than sent as null.
+    """
+    selected = crud.resolve_product_fields(fields, view)
+    if stream and db is not None:
+        return StreamingResponse(stream_products_json(selected), media_type="application/json")
+
+    if selected is None:
+        products, headers = serve_catalog(db, ("products", None), lambda: crud.get_all_products_cached(db))
+    else:
+        products, headers = serve_catalog(db, ("products", selected), lambda: crud.get_products_projection_cached(db, selected))
+    return JSONResponse(jsonable_encoder(products), headers=headers)
+
+
+# -------------------------
+# GET PRODUCTS BY IDS
+# -------------------------
+MAX_BATCH_PRODUCT_IDS = 300
+
+
+@app.get("/products/batch", response_model=List[schemas.ProductBatchItem])
+def get_products_batch(
+    ids: str = Query(..., description="Comma-separated product IDs"),
+    fields: Optional[str] = Query(None, description="Comma-separated fields to return"),
+    view: Optional[str] = Query(None, description="Named projection: card"),
+    db: Optional[Session] = Depends(database.get_db_if_available)
+):
+    """
+    Products for wishlists, recently viewed and cart previews, in request
+    order. IDs that do not exist come back with found=false. Accepts the same
+    ?fields= / ?view= projections as /products.
+    """
+    product_ids = [pid.strip() for pid in ids.split(",") if pid.strip()]
+    if not product_ids:
+        raise HTTPException(status_code=400, detail="No product IDs given")
+    if len(product_ids) > MAX_BATCH_PRODUCT_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_PRODUCT_IDS} product IDs per request")
+
+    selected = crud.resolve_product_fields(fields, view)
+    if selected is None:
+        load = lambda: crud.get_products_by_ids(db, product_ids)
+    else:
+        load = lambda: crud.get_products_projection_by_ids(db, product_ids, selected)
+
+    products, headers = None, {}
+    if db is not None:
+        try:
+            products = database.with_retries(db, load)
+        except OperationalError as e:
+            logger.error(f"Batch product read failed, serving last good snapshots: {str(e)}")
+    if products is None:
+        # Database down: last good copy of each product
+        stale = [crud.get_stale_product(pid) for pid in product_ids]
+        if all(product is None for product, _ in stale):
+            raise database_unavailable()
+        products = [
+            product if product is None or selected is None else crud.project_product(product, selected)
+            for product, _ in stale
+        ]
+        headers = stale_headers(max(age for _, age in stale if age is not None))
+
+    return JSONResponse(jsonable_encoder([
+        {"id": pid, "found": product is not None, "product": product}
+        for pid, product in zip(product_ids, products)
+    ]), headers=headers)
 
 
 #-------------------------
@@ -210,19 +567,45 @@ def get_all_products(db: Session = Depends(database.get_db)):
 #-------------------------
 
 @app.get("/product/{product_id}", response_model=schemas.ProductResponse)
-def get_product_by_id(product_id: str, db: Session = Depends(database.get_db)):
+def get_product_by_id(
+    product_id: str,
+    response: Response,
+    db: Optional[Session] = Depends(database.get_db_if_available)
+):
     """
     get a complete product just by adding ID
     """
-    product = crud.get_product_with_reviews(db=db, product_id=product_id)
+    product, headers = serve_catalog(
+        db, ("product", product_id), lambda: crud.get_product_cached(db, product_id)
+    )
     
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     
+    response.headers.update(headers)
     return product
 
 
 
+#-------------------------
+# GET PRODUCT PAGE (product + reviews + description in one call)
+#-------------------------
+@app.get("/product/{product_id}/page", response_model=schemas.ProductPageResponse)
+def get_product_page(
+    product_id: str,
+    response: Response,
+    review_limit: int = Query(10, ge=1, le=50),
+    db: Optional[Session] = Depends(database.get_db_if_available)
+):
+    page, headers = serve_catalog(
+        db, ("page", product_id, review_limit), lambda: crud.get_product_page(db, product_id, review_limit)
+    )
+    if not page:
+        raise HTTPException(status_code=404, detail="Product not found")
+    response.headers.update(headers)
+    return page
+
+
 # -------------------------
 # CREATE PRODUCT
 # -------------------------
@@ -248,11 +631,158 @@ def create_product(product: schemas.ProductCreate, db: Session = Depends(databas
         logger.error(f"Unexpected error: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+# -------------------------
+# BULK PRODUCT IMPORT (NDJSON or CSV, streamed)
+# -------------------------
+BULK_IMPORT_BATCH_SIZE = 500
+MAX_REPORTED_IMPORT_ERRORS = 1000
+
+@app.post("/products/bulk", response_model=schemas.BulkImportResult, dependencies=[Depends(require_admin)])
+async def bulk_import_products(
+    request: Request,
+    format: Optional[str] = Query(None, pattern="^(ndjson|csv)$"),
+    db: Session = Depends(database.get_db)
+):
+    """
+    Upsert products from an NDJSON or CSV body (Content-Type text/csv or
+    ?format=csv). Rows are validated as they stream in and written in batches;
+    invalid rows are reported and skipped. The catalog cache is invalidated
+    once, after the last batch.
+    """
+    is_csv = format == "csv" or (format is None and "csv" in request.headers.get("content-type", ""))
+    rows = bulk_import.iter_csv(request.stream()) if is_csv else bulk_import.iter_ndjson(request.stream())
+
+    upserted = 0
+    imported_ids = set()
+    error_count = 0
+    errors = []
+    batch = []
+
+    def record_error(row_number, product_id, message):
+        nonlocal error_count
+        error_count += 1
+        if len(errors) < MAX_REPORTED_IMPORT_ERRORS:
+            errors.append(schemas.BulkImportError(row=row_number, id=product_id, error=message))
+
+    async def flush():
+        nonlocal upserted
+        try:
+            products = [p for _, p in batch]
+            upserted += await run_in_threadpool(crud.upsert_products, db, products, False)
+            imported_ids.update(p.id for p in products)
+        except OperationalError as e:
+            logger.error(f"Database error during bulk import: {str(e)}")
+            raise HTTPException(status_code=503, detail="Database unavailable, please try again later")
+        except Exception as e:
+            # Keep going with the next batch; report every row of the failed one
+            logger.error(f"Bulk import batch failed: {str(e)}")
+            await run_in_threadpool(db.rollback)
+            for row_number, product in batch:
+                record_error(row_number, product.id, "Batch write failed")
+        batch.clear()
+
+    async def invalidate():
+        if not imported_ids:
+            return
+        crud.invalidate_products(db, imported_ids)
+        try:
+            await run_in_threadpool(db.commit)
+        except Exception as e:
+            # Imported rows are committed already; caches catch up within their TTL
+            logger.error(f"Cache invalidation after bulk import failed: {str(e)}")
+
+    try:
+        async for row_number, row, error in rows:
+            if error:
+                record_error(row_number, None, error)
+                continue
+            try:
+                product = schemas.ProductCreate(**row)
+            except ValidationError as e:
+                record_error(row_number, row.get("id"), "; ".join(
+                    f"{'.'.join(str(p) for p in err['loc'])}: {err['msg']}" for err in e.errors()
+                ))
+                continue
+            batch.append((row_number, product))
+            if len(batch) >= BULK_IMPORT_BATCH_SIZE:
+                await flush()
+        if batch:
+            await flush()
+    except bulk_import.InvalidEncoding as e:
+        raise HTTPException(
+            status_code=400,
+            detail=f"{e}; {upserted} products were imported before it"
+        )
+    finally:
+        await invalidate()
+
+    return schemas.BulkImportResult(upserted=upserted, error_count=error_count, errors=errors)
+
+# -------------------------
+# BULK INVENTORY ADJUSTMENT
+# -------------------------
+INVENTORY_BATCH_SIZE = 500
+
+@app.post("/inventory/adjust", response_model=schemas.InventoryAdjustResult, dependencies=[Depends(require_admin)])
+def adjust_inventory(request: schemas.InventoryAdjustRequest, db: Session = Depends(database.get_db)):
+    applied = 0
+    rejected = []
+    for start in range(0, len(request.adjustments), INVENTORY_BATCH_SIZE):
+        batch = request.adjustments[start:start + INVENTORY_BATCH_SIZE]
+        batch_applied, batch_rejected = crud.adjust_inventory(db, batch)
+        applied += batch_applied
+        rejected.extend(batch_rejected)
+    return schemas.InventoryAdjustResult(applied=applied, rejected=rejected)
+
+# -------------------------
+# ADMIN: STOCK SHARDS (hot SKUs)
+# -------------------------
+MAX_STOCK_SHARDS = 64
+
+@app.post("/admin/stock/shards", dependencies=[Depends(require_admin)])
+def shard_sku(request: schemas.StockShardRequest, db: Session = Depends(database.get_db)):
+    """Split a hot SKU's stock across sharded counters before a drop."""
+    shards = request.shards or crud.STOCK_SHARDS
+    if not 1 <= shards <= MAX_STOCK_SHARDS:
+        raise HTTPException(status_code=400, detail=f"shards must be between 1 and {MAX_STOCK_SHARDS}")
+    if not crud.shard_sku(db, request.product_id, request.size, shards):
+        raise HTTPException(status_code=404, detail="Product not found")
+    return {"message": f"{request.product_id} {request.size} split across {shards} shards"}
+
+@app.delete("/admin/stock/shards", dependencies=[Depends(require_admin)])
+def unshard_sku(
+    product_id: str = Query(...),
+    size: str = Query(..., pattern="^(XS|S|M|L|XL|XXL)$"),
+    db: Session = Depends(database.get_db)
+):
+    if not crud.unshard_sku(db, product_id, size):
+        raise HTTPException(status_code=404, detail="SKU is not sharded")
+    return {"message": f"{product_id} {size} merged back into one counter"}
+
+@app.post("/admin/stock/compact", dependencies=[Depends(require_admin)])
+def compact_stock(db: Session = Depends(database.get_db)):
+    """Rebalance sharded SKUs and prune old ledger rows; also run hourly by cron."""
+    return crud.compact_stock(db)
+
+@app.get("/admin/stock/compact", dependencies=[Depends(require_cron)])
+def compact_stock_cron(db: Session = Depends(database.get_db)):
+    """The same, for the Vercel cron job in vercel.json."""
+    return crud.compact_stock(db)
+
 # -------------------------
 # DELETE PRODUCT (NEW)
 # -------------------------
 @app.delete("/products/{product_id}")
-def delete_product(product_id: str, db: Session = Depends(database.get_db)):
+def delete_product(
+    product_id: str,
+    archive: bool = Query(False, description="Hide the product but keep its reviews and order history"),
+    db: Session = Depends(database.get_db)
+):
+    if archive:
+        if not crud.archive_product(db, product_id):
+            raise HTTPException(status_code=404, detail="Product not found")
+        return {"message": "Product archived successfully"}
+
     deleted = crud.delete_product(db, product_id)
     if not deleted:
         raise HTTPException(status_code=404, detail="Product not found")
@@ -266,17 +796,68 @@ def update_product(product_id: str, product_update: schemas.ProductUpdate, db: S
     updated = crud.update_product(db, product_id, product_update)
     if not updated:
         raise HTTPException(status_code=404, detail="Product not found")
-    return crud.get_product_with_reviews(db, product_id)
+    return crud.get_product_with_reviews(db, product_id, include_archived=True)
 
 # -------------------------
 # GET ALL REVIEWS FOR A PRODUCT
 # -------------------------
-@app.get("/products/{product_id}/reviews", response_model=list[schemas.ReviewDetail])
-def get_product_reviews(product_id: str, db: Session = Depends(database.get_db)):
-    reviews = crud.get_reviews_by_product(db, product_id)
-    if not reviews:
+@app.get("/products/{product_id}/reviews", response_model=Union[List[schemas.ReviewDetail], schemas.ReviewPage])
+def get_product_reviews(
+    product_id: str,
+    paged: bool = Query(False, description="Return a ReviewPage (keyset pages) instead of the full list"),
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = Query(None),
+    histogram: bool = Query(False),
+    db: Session = Depends(database.get_db)
+):
+    # Plain list of every review by default, as existing clients expect;
+    # ?paged=true (or a cursor) opts into paging and the histogram
+    if not paged and cursor is None:
+        reviews, _ = crud.get_reviews_by_product(db, product_id, limit=None)
+        if not reviews:
+            raise HTTPException(status_code=404, detail="No reviews found for this product.")
+        return reviews
+
+    reviews, next_cursor = crud.get_reviews_by_product(db, product_id, limit, cursor)
+    if not reviews and cursor is None:
         raise HTTPException(status_code=404, detail="No reviews found for this product.")
-    return reviews
+    return schemas.ReviewPage(
+        reviews=reviews,
+        next_cursor=next_cursor,
+        histogram=crud.get_review_histogram(db, product_id) if histogram else None,
+    )
+
+# -------------------------
+# CART VERSIONING (ETag / delta responses)
+# -------------------------
+def cart_etag(version: int) -> str:
+    return f'"cart-{version}"'
+
+def cart_result(
+    db: Session,
+    response: Response,
+    user_id: str,
+    product_id: str,
+    size: str,
+    color: Optional[str],
+    delta: bool
+):
+    """
+    Response for a cart mutation: the whole cart, or with delta=true only the
+    changed line plus new totals. Either way the new version goes in ETag.
+    """
+    version = crud.get_cart_version(db, user_id)
+    response.headers["ETag"] = cart_etag(version)
+    if not delta:
+        return crud.get_user_cart(db, user_id)
+
+    line = crud.get_cart_line(db, user_id, product_id, size, color)
+    return schemas.CartDelta(
+        version=version,
+        line=line,
+        removed=line is None,
+        totals=crud.get_cart_totals(db, user_id)
+    )
 
 # -------------------------
 # GET USER CART ENDPOINT
@@ -284,16 +865,23 @@ def get_product_reviews(product_id: str, db: Session = Depends(database.get_db))
 @app.get("/cart/{user_id}", response_model=schemas.CartResponse)
 def get_user_cart(
     user_id: str,
+    request: Request,
+    response: Response,
     credentials: Annotated[HTTPAuthorizationCredentials, Depends(bearer_scheme)],
     db: Session = Depends(database.get_db)
 ):
-    token_user_id = verify_token(credentials)
+    token_user_id = verify_active_user(credentials, db)
     if token_user_id != user_id:
         raise HTTPException(status_code=403, detail="Not authorized")
     
+    etag = cart_etag(crud.get_cart_version(db, user_id))
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers={"ETag": etag})
+
     cart_data = crud.get_user_cart(db, user_id)
     if not cart_data.items:
-        raise HTTPException(status_code=404, detail="No items found in cart")
+        raise HTTPException(status_code=404, detail="No items found in cart", headers={"ETag": etag})
+    response.headers["ETag"] = etag
     return cart_data
 
 # -------------------------
@@ -315,7 +903,7 @@ def read_user_orders(
     credentials: Annotated[HTTPAuthorizationCredentials, Depends(bearer_scheme)], 
     db: Session = Depends(database.get_db)
 ):
-    token_user_id = verify_token(credentials)
+    token_user_id = verify_active_user(credentials, db)
     if token_user_id != user_id:
         raise HTTPException(status_code=403, detail="Not authorized")
     
@@ -324,6 +912,40 @@ def read_user_orders(
         raise HTTPException(status_code=404, detail="No orders found for this user")
     return orders
 
+# -------------------------
+# BULK UPDATE ORDER STATUS
+# -------------------------
+MAX_BULK_ORDER_IDS = 1000
+
+@app.put("/orders/status", response_model=schemas.BulkOrderStatusResult, dependencies=[Depends(require_admin)])
+def bulk_update_order_status(update: schemas.BulkOrderStatusUpdate, db: Session = Depends(database.get_db)):
+    order_ids = list(dict.fromkeys(update.order_ids))
+    if len(order_ids) > MAX_BULK_ORDER_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BULK_ORDER_IDS} orders per request")
+
+    updated = crud.bulk_update_order_status(db, order_ids, update.status)
+    updated_set = set(updated)
+    return schemas.BulkOrderStatusResult(
+        status=update.status,
+        updated=sorted(updated_set),
+        not_found=[order_id for order_id in order_ids if order_id not in updated_set]
+    )
+
+# -------------------------
+# USER ORDER SUMMARY (account page header)
+# -------------------------
+@app.get("/users/{user_id}/summary", response_model=schemas.UserOrderSummary)
+def read_user_order_summary(
+    user_id: str,
+    credentials: Annotated[HTTPAuthorizationCredentials, Depends(bearer_scheme)],
+    db: Session = Depends(database.get_db)
+):
+    token_user_id = verify_active_user(credentials, db)
+    if token_user_id != user_id:
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+    return crud.get_user_order_summary(db, user_id)
+
 # -------------------------
 # UPDATE ORDER STATUS
 # -------------------------
@@ -343,7 +965,7 @@ def create_product_review(
     credentials: Annotated[HTTPAuthorizationCredentials, Depends(bearer_scheme)], 
     db: Session = Depends(database.get_db)
 ):
-    token_user_id = verify_token(credentials)
+    token_user_id = verify_active_user(credentials, db)
     if token_user_id != review.user_id:
         raise HTTPException(status_code=403, detail="Not authorized")
     
@@ -356,13 +978,15 @@ def create_product_review(
 # UPDATE CART QUANTITY
 # -------------------------
 # NEW: UPDATE CART ITEM (quantity or remove if 0)
-@app.put("/cart/update", response_model=schemas.CartResponse)
+@app.put("/cart/update", response_model=Union[schemas.CartResponse, schemas.CartDelta])
 def update_cart_item(
     payload: schemas.CartUpdate,
+    response: Response,
     credentials: Annotated[HTTPAuthorizationCredentials, Depends(bearer_scheme)],
-    db: Session = Depends(database.get_db)
+    db: Session = Depends(database.get_db),
+    delta: bool = Query(False)
 ):
-    token_user_id = verify_token(credentials)
+    token_user_id = verify_active_user(credentials, db)
     if token_user_id != payload.user_id:
         raise HTTPException(status_code=403, detail="Not authorized")
 
@@ -387,19 +1011,21 @@ def update_cart_item(
     if not success:
         raise HTTPException(status_code=404, detail="Cart item not found")
 
-    return crud.get_user_cart(db, payload.user_id)
+    return cart_result(db, response, payload.user_id, payload.product_id, payload.size, payload.color, delta)
 
 
 # -------------------------
 # REMOVE FROM CART
 # -------------------------
-@app.delete("/cart/remove", response_model=schemas.CartResponse)
+@app.delete("/cart/remove", response_model=Union[schemas.CartResponse, schemas.CartDelta])
 def remove_cart_item(
     remove_data: schemas.CartRemoveRequest,
+    response: Response,
     credentials: Annotated[HTTPAuthorizationCredentials, Depends(bearer_scheme)],
-    db: Session = Depends(database.get_db)
+    db: Session = Depends(database.get_db),
+    delta: bool = Query(False)
 ):
-    token_user_id = verify_token(credentials)
+    token_user_id = verify_active_user(credentials, db)
 
     if token_user_id != remove_data.user_id:
         raise HTTPException(status_code=403, detail="Not authorized")
@@ -415,31 +1041,37 @@ def remove_cart_item(
     if not success:
         raise HTTPException(status_code=404, detail="Cart item not found")
 
-    return crud.get_user_cart(db, remove_data.user_id)
+    return cart_result(db, response, remove_data.user_id, remove_data.product_id, remove_data.size, remove_data.color, delta)
 
 
 # -------------------------
 # ADD TO CART
 # -------------------------
-@app.post("/cart/", response_model=schemas.CartResponse)
+@app.post("/cart/", response_model=Union[schemas.CartResponse, schemas.CartDelta])
 def add_to_cart(
     cart_item: schemas.CartCreate, 
+    response: Response,
     credentials: Annotated[HTTPAuthorizationCredentials, Depends(bearer_scheme)], 
-    db: Session = Depends(database.get_db)
+    db: Session = Depends(database.get_db),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key"),
+    delta: bool = Query(False)
 ):
-    token_user_id = verify_token(credentials)
+    token_user_id = verify_active_user(credentials, db)
     if token_user_id != cart_item.user_id:
         raise HTTPException(status_code=403, detail="Not authorized")
     
-    
-    product = crud.get_product_by_id(db, cart_item.product_id)
-    if not product:
-        raise HTTPException(status_code=404, detail="Product ID does not exist")
-    
-    added = crud.add_to_cart(db, cart_item)
-    if not added:
-        raise HTTPException(status_code=400, detail="Could not add item to cart")
-    return crud.get_user_cart(db, cart_item.user_id)
+    def add():
+        product = crud.get_product_by_id(db, cart_item.product_id)
+        if not product or product.archived:
+            raise HTTPException(status_code=404, detail="Product ID does not exist")
+        
+        added = crud.add_to_cart(db, cart_item, commit=False)
+        if not added:
+            raise HTTPException(status_code=400, detail="Could not add item to cart")
+        return cart_result(db, response, cart_item.user_id, cart_item.product_id, cart_item.size, cart_item.color, delta)
+
+    scope = "POST /cart/?delta" if delta else "POST /cart/"
+    return run_idempotent(db, idempotency_key, cart_item.user_id, scope, cart_item, add)
 
 # -------------------------
 # CREATE ORDER FROM CART
@@ -448,16 +1080,20 @@ def add_to_cart(
 def create_order_from_cart(
     order: schemas.OrderCreate, 
     credentials: Annotated[HTTPAuthorizationCredentials, Depends(bearer_scheme)], 
-    db: Session = Depends(database.get_db)
+    db: Session = Depends(database.get_db),
+    idempotency_key: Optional[str] = Header(None, alias="Idempotency-Key")
 ):
-    token_user_id = verify_token(credentials)
+    token_user_id = verify_active_user(credentials, db)
     if token_user_id != order.user_id:
         raise HTTPException(status_code=403, detail="Not authorized")
     
-    orders = crud.create_order_from_cart(db, order)
-    if not orders:
-        raise HTTPException(status_code=400, detail="Could not create order")
-    return orders
+    def checkout():
+        orders = crud.create_order_from_cart(db, order, commit=False)
+        if not orders:
+            raise HTTPException(status_code=400, detail="Could not create order")
+        return orders
+
+    return run_idempotent(db, idempotency_key, order.user_id, "POST /orders/from-cart/", order, checkout)
 
 @app.get("/reviews/check")
 def check_review(
@@ -468,22 +1104,79 @@ def check_review(
     size: Optional[str] = Query(None),
     db: Session = Depends(database.get_db)
 ):
-    token_user_id = verify_token(credentials)
+    token_user_id = verify_active_user(credentials, db)
     if token_user_id != user_id:
         raise HTTPException(status_code=403, detail="Not authorized")
     
     reviewed = crud.has_user_reviewed_product(db, user_id, product_id)
     return {"reviewed": reviewed}
 
+# -------------------------
+# BATCH REVIEW CHECK (one call per order instead of one per line)
+# -------------------------
+MAX_REVIEW_CHECK_IDS = 100
+
+@app.get("/reviews/check/batch")
+def check_reviews_batch(
+    credentials: Annotated[HTTPAuthorizationCredentials, Depends(bearer_scheme)],
+    user_id: str = Query(...),
+    product_ids: str = Query(..., description="Comma-separated product IDs"),
+    db: Session = Depends(database.get_db)
+):
+    token_user_id = verify_active_user(credentials, db)
+    if token_user_id != user_id:
+        raise HTTPException(status_code=403, detail="Not authorized")
+
+    ids = list(dict.fromkeys(pid.strip() for pid in product_ids.split(",") if pid.strip()))
+    if len(ids) > MAX_REVIEW_CHECK_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_REVIEW_CHECK_IDS} product IDs per request")
+
+    reviewed_ids = crud.get_reviewed_product_ids(db, user_id, ids)
+    return {"reviewed": {pid: pid in reviewed_ids for pid in ids}}
+
 # -------------------------
 # GET PRODUCT DESCRIPTION
 # -------------------------
 @app.get("/products/{product_id}/description")
 def get_product_description(product_id: str, db: Session = Depends(database.get_db)):
-    db_product = crud.get_product_by_id(db, product_id)
-    if not db_product:
+    description = crud.get_product_description(db, product_id)
+    if description is None:
         raise HTTPException(status_code=404, detail="Product not found")
-    return {"description": db_product.description or ""}
+    return {"description": description}
+
+# -------------------------
+# ADMIN: ABANDONED CART SWEEPER
+# -------------------------
+@app.post("/admin/cart/sweep", dependencies=[Depends(require_admin)])
+def sweep_abandoned_carts(
+    hold_minutes: int = Query(crud.CART_HOLD_MINUTES, ge=1),
+    max_batches: Optional[int] = Query(None, ge=1),
+    db: Session = Depends(database.get_db)
+):
+    """Release stock held by stale carts; also run every 15 minutes by cron."""
+    return crud.sweep_abandoned_carts(db, hold_minutes=hold_minutes, max_batches=max_batches)
+
+# Keeps one cron run within the function time limit; the rest waits for the next run
+CRON_SWEEP_MAX_BATCHES = int(os.getenv("CART_SWEEP_CRON_MAX_BATCHES", "20"))
+
+@app.get("/admin/cart/sweep", dependencies=[Depends(require_cron)])
+def sweep_abandoned_carts_cron(db: Session = Depends(database.get_db)):
+    """The same with the default hold, for the Vercel cron job in vercel.json."""
+    return crud.sweep_abandoned_carts(db, max_batches=CRON_SWEEP_MAX_BATCHES)
+
+@app.get("/admin/metrics", dependencies=[Depends(require_admin)])
+def get_metrics():
+    return metrics.snapshot()
+
+# -------------------------
+# ADMIN: SLOW QUERY LOG
+# -------------------------
+@app.get("/admin/slow-queries", dependencies=[Depends(require_admin)])
+def get_slow_queries():
+    return {
+        "threshold_ms": database.SLOW_QUERY_MS,
+        "queries": database.slow_queries.recent(),
+    }
 
 @app.get("/")
 def read_root():
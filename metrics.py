@@ -0,0 +1,29 @@
+# metrics.py
+import threading
+import time
+from typing import Dict
+
+# Process-wide counters and gauges, read by GET /admin/metrics.
+# Values are per instance: each serverless worker keeps its own.
+_lock = threading.Lock()
+_counters: Dict[str, float] = {}
+_gauges: Dict[str, float] = {}
+
+
+def incr(name: str, amount: float = 1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def set_gauge(name: str, value: float):
+    with _lock:
+        _gauges[name] = value
+
+
+def snapshot() -> dict:
+    with _lock:
+        return {
+            "counters": dict(_counters),
+            "gauges": dict(_gauges),
+            "time": time.time(),
+        }
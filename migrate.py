@@ -0,0 +1,42 @@
+# migrate.py
+"""
+Schema migrations for existing databases. Run once per deploy, before the new
+code takes traffic:
+
+    python migrate.py
+
+Creates missing tables, adds columns and indexes that were added to the models
+later (indexes CONCURRENTLY on Postgres), then runs the backfills. Fails with
+an error if any column or index cannot be added. Every step only touches what
+is still missing, so it is safe to run again.
+"""
+import logging
+
+import crud
+import database
+import models
+
+logger = logging.getLogger(__name__)
+
+
+def migrate():
+    models.Base.metadata.create_all(bind=database.engine)
+
+    # uq_reviews_user_product cannot be built while duplicates exist. Reviews
+    # written between this and the index build make sync_schema fail; rerun.
+    with database.SessionLocal() as db:
+        removed = crud.dedupe_reviews(db)
+    if removed:
+        logger.warning(f"Deleted {removed} duplicate reviews (kept the newest per user and product)")
+    database.sync_schema(models.Base.metadata)
+
+    with database.SessionLocal() as db:
+        crud.backfill_order_status_rank(db)
+        crud.backfill_cart_last_touched(db)
+        crud.backfill_stock_sharded(db)
+    logger.info("Migration complete")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    migrate()
@@ -1,8 +1,9 @@
 # models.py
-from sqlalchemy import Column, Integer, String, Boolean, Float, Date, ForeignKey, JSON, DateTime
-from sqlalchemy.sql import func
+from sqlalchemy import Column, Integer, String, Boolean, Float, Date, ForeignKey, JSON, DateTime, Text, Index
+from sqlalchemy.sql import func, false
 from sqlalchemy.orm import relationship
 from database import Base
+from datetime import datetime
 
 # -------------------------
 # USERS TABLE
@@ -26,6 +27,11 @@ class User(Base):
     carts = relationship("Cart", back_populates="user", cascade="all, delete")
     orders = relationship("Order", back_populates="user", cascade="all, delete")
 
+    __table_args__ = (
+        # Case-insensitive email lookups
+        Index("ix_users_email_lower", func.lower(email)),
+    )
+
 # -------------------------
 # PRODUCTS TABLE
 # -------------------------
@@ -54,11 +60,13 @@ class Product(Base):
     XL_stock = Column(Float, nullable=False)
     XXL_stock = Column(Float, nullable=False)
     kids = Column(Boolean, nullable=True)
+    archived = Column(Boolean, default=False, server_default=false(), nullable=False)  # hidden from the catalog
+    stock_sharded = Column(Boolean, default=False, server_default=false(), nullable=False)  # has stock_shards rows
 
-    # Relationships
-    reviews = relationship("Review", back_populates="product", cascade="all, delete")
-    carts = relationship("Cart", back_populates="product", cascade="all, delete")
-    order_items = relationship("OrderItem", back_populates="product", cascade="all, delete")
+    # Relationships (rows are removed by the FK's ON DELETE CASCADE, not loaded and deleted one by one)
+    reviews = relationship("Review", back_populates="product", cascade="all, delete", passive_deletes=True)
+    carts = relationship("Cart", back_populates="product", cascade="all, delete", passive_deletes=True)
+    order_items = relationship("OrderItem", back_populates="product", cascade="all, delete", passive_deletes=True)
 
 # -------------------------
 # REVIEWS TABLE
@@ -77,6 +85,26 @@ class Review(Base):
     user = relationship("User", back_populates="reviews")
     product = relationship("Product", back_populates="reviews")
 
+    __table_args__ = (
+        # Keyset pagination: newest first within a product
+        Index("ix_reviews_product_time_id", "product_id", "time", "id"),
+        # One review per user per product; also backs the review-status checks
+        Index("uq_reviews_user_product", "user_id", "product_id", unique=True),
+    )
+
+# -------------------------
+# REVIEW STATS TABLE (star histogram counters)
+# -------------------------
+class ProductReviewStats(Base):
+    __tablename__ = "product_review_stats"
+
+    product_id = Column(String, ForeignKey("products.id", ondelete="CASCADE"), primary_key=True)
+    stars_1 = Column(Integer, default=0, nullable=False)
+    stars_2 = Column(Integer, default=0, nullable=False)
+    stars_3 = Column(Integer, default=0, nullable=False)
+    stars_4 = Column(Integer, default=0, nullable=False)
+    stars_5 = Column(Integer, default=0, nullable=False)
+
 # -------------------------
 # CART TABLE
 # -------------------------
@@ -89,11 +117,22 @@ class Cart(Base):
     size = Column(String(5), nullable=False)  # XS, S, M, L, XL, XXL
     quantity = Column(Integer, default=1, nullable=False)
     color = Column(String, nullable=True)
+    # Last change to any line of this user's cart; the sweeper releases stock of stale carts
+    last_touched = Column(DateTime, nullable=True, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
 
     # Relationships
     user = relationship("User", back_populates="carts")
     product = relationship("Product", back_populates="carts")
 
+# -------------------------
+# CART VERSIONS TABLE (bumped by every cart mutation, used as ETag)
+# -------------------------
+class CartVersion(Base):
+    __tablename__ = "cart_versions"
+
+    user_id = Column(String, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    version = Column(Integer, default=0, nullable=False)
+
 # -------------------------
 # ORDERS TABLE
 # -------------------------
@@ -102,6 +141,7 @@ class Order(Base):
 
     id = Column(Integer, primary_key=True, index=True)
     status = Column(String, nullable=False)
+    status_rank = Column(Integer, nullable=True)  # admin queue sort key, see crud.ORDER_STATUS_RANK
     time = Column(Date, nullable=False)
     user_id = Column(String, ForeignKey("users.id", ondelete="CASCADE"), nullable=False)
 
@@ -109,6 +149,16 @@ class Order(Base):
     user = relationship("User", back_populates="orders")
     items = relationship("OrderItem", back_populates="order", cascade="all, delete")
 
+    __table_args__ = (
+        # Admin queue: status, then newest; INCLUDE makes it index-only on Postgres
+        Index(
+            "ix_orders_status_rank_time_id", status_rank, time.desc(), id,
+            postgresql_include=["user_id", "status"]
+        ),
+        # Per-user history, newest first
+        Index("ix_orders_user_time", user_id, time.desc(), postgresql_include=["status"]),
+    )
+
 # -------------------------
 # ORDER ITEMS TABLE
 # -------------------------
@@ -116,12 +166,82 @@ class OrderItem(Base):
     __tablename__ = "order_items"
 
     id = Column(Integer, primary_key=True, index=True)
-    order_id = Column(Integer, ForeignKey("orders.id", ondelete="CASCADE"), nullable=False)
+    order_id = Column(Integer, ForeignKey("orders.id", ondelete="CASCADE"), nullable=False, index=True)
     product_id = Column(String, ForeignKey("products.id", ondelete="CASCADE"), nullable=False)
     size = Column(String(5), nullable=False)  # XS, S, M, L, XL, XXL
     quantity = Column(Integer, default=1, nullable=False)
     color = Column(String, nullable=True)
+    unit_price = Column(Integer, nullable=True)  # size price at checkout; NULL for older lines
 
     # Relationships
     order = relationship("Order", back_populates="items")
-    product = relationship("Product", back_populates="order_items")
\ No newline at end of file
+    product = relationship("Product", back_populates="order_items")
+
+# -------------------------
+# IDEMPOTENCY KEYS TABLE
+# -------------------------
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+
+    user_id = Column(String, primary_key=True)
+    key = Column(String(255), primary_key=True)
+    scope = Column(String, nullable=False)  # e.g. "POST /cart/"
+    fingerprint = Column(String(64), nullable=False)  # sha256 of scope + request body
+    status_code = Column(Integer, nullable=True)  # NULL while the first request is in flight
+    response_body = Column(Text, nullable=True)  # JSON
+    created_at = Column(DateTime, nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+# -------------------------
+# STOCK SHARDS TABLE (hot SKUs split across N counters, see crud.reserve_stock)
+# -------------------------
+class StockShard(Base):
+    __tablename__ = "stock_shards"
+
+    product_id = Column(String, ForeignKey("products.id", ondelete="CASCADE"), primary_key=True)
+    size = Column(String(5), primary_key=True)
+    shard = Column(Integer, primary_key=True)
+    available = Column(Float, default=0, nullable=False)
+
+# -------------------------
+# STOCK LEDGER TABLE (append-only record of stock movements)
+# -------------------------
+class StockMovement(Base):
+    __tablename__ = "stock_movements"
+
+    id = Column(Integer, primary_key=True, index=True)
+    product_id = Column(String, ForeignKey("products.id", ondelete="CASCADE"), nullable=False)
+    size = Column(String(5), nullable=False)
+    shard = Column(Integer, nullable=True)  # NULL = the products row
+    delta = Column(Float, nullable=False)  # negative = reserved, positive = released
+    reason = Column(String, nullable=False)  # cart, cart_update, cart_remove, ...
+    created_at = Column(DateTime, nullable=False, server_default=func.now(), index=True)
+
+# -------------------------
+# CACHE INVALIDATION OUTBOX (cross-process cache invalidation where NOTIFY is unavailable)
+# -------------------------
+class CacheInvalidation(Base):
+    __tablename__ = "cache_invalidations"
+
+    id = Column(Integer, primary_key=True, index=True)
+    payload = Column(Text, nullable=False)  # JSON: {"origin", "cache", "keys"}
+    created_at = Column(Float, nullable=False, index=True)  # unix time
+
+# -------------------------
+# USER ORDER SUMMARY TABLE (account page header; kept in step by checkout and status updates)
+# -------------------------
+class UserOrderSummary(Base):
+    __tablename__ = "user_order_summaries"
+
+    user_id = Column(String, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    order_count = Column(Integer, default=0, nullable=False)
+    pending_count = Column(Integer, default=0, nullable=False)
+    processing_count = Column(Integer, default=0, nullable=False)
+    shipped_count = Column(Integer, default=0, nullable=False)
+    delivered_count = Column(Integer, default=0, nullable=False)
+    cancelled_count = Column(Integer, default=0, nullable=False)
+    other_count = Column(Integer, default=0, nullable=False)  # statuses outside the list above
+    lifetime_total = Column(Integer, default=0, nullable=False)  # excludes cancelled orders
+    last_order_id = Column(Integer, nullable=True)
+    last_order_time = Column(Date, nullable=True)
+    last_order_status = Column(String, nullable=True)
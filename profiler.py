@@ -0,0 +1,163 @@
+# profiler.py
+import hmac
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Off unless a token or a sample rate is configured; main.py only installs the
+# middleware when ENABLED, so disabled profiling adds nothing to a request.
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN")
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/profiles")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000
+PROFILE_ALLOCATIONS = os.getenv("PROFILE_ALLOCATIONS", "1") == "1"
+ENABLED = bool(PROFILE_TOKEN) or PROFILE_SAMPLE_RATE > 0
+
+# Leaf frames of threads that are parked, not working
+IDLE_FRAMES = {
+    ("threading.py", "wait"),
+    ("threading.py", "_wait_for_tstate_lock"),
+    ("queue.py", "get"),
+    ("selectors.py", "select"),
+    ("thread.py", "_worker"),
+}
+
+# Sampling and tracemalloc are process-wide, so one profile at a time
+_busy = threading.Lock()
+
+
+def should_profile(header_token: Optional[str]) -> bool:
+    if PROFILE_TOKEN and header_token and hmac.compare_digest(header_token, PROFILE_TOKEN):
+        return True
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+class SamplingProfiler:
+    """
+    Wall-clock sampler: a background thread records the stacks of all other
+    threads every `interval` seconds. Output is the collapsed-stack format
+    ("root;caller;callee count") read by speedscope and flamegraph.pl.
+
+    Samples are process-wide: they include whatever other requests were doing
+    at the time, since a sync handler runs on a threadpool worker that cannot
+    be told apart from the others. Stacks of `request_thread` (the thread that
+    started the profile) are rooted at a "[profiled request]" label.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL, request_thread: Optional[int] = None):
+        self.interval = interval
+        self.request_thread = request_thread
+        self.samples = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiler-sampler", daemon=True)
+
+    @staticmethod
+    def _frame_label(frame) -> str:
+        code = frame.f_code
+        short_path = "/".join(code.co_filename.replace(os.sep, "/").split("/")[-2:])
+        return f"{code.co_name} ({short_path}:{code.co_firstlineno})"
+
+    def _run(self):
+        own_id = threading.get_ident()
+        names = {}
+        while not self._stop.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(self._frame_label(frame))
+                    frame = frame.f_back
+                name = names.get(thread_id, str(thread_id))
+                stack.append(f"{name} [profiled request]" if thread_id == self.request_thread else name)
+                self.samples[";".join(reversed(stack))] += 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def collapsed(self) -> str:
+        return "\n".join(f"{stack} {count}" for stack, count in self.samples.most_common())
+
+
+class RequestProfile:
+    """
+    Profiles one request; use as a context manager around the handler.
+    Get one from `try_profile`, which holds the process-wide profiling slot.
+    """
+
+    def __init__(self, method: str, path: str):
+        self.method = method
+        self.path = path
+        self.sampler = SamplingProfiler(request_thread=threading.get_ident())
+        self.started_tracemalloc = False
+        self.wall_time = 0.0
+
+    def __enter__(self):
+        if PROFILE_ALLOCATIONS and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.started_tracemalloc = True
+        self._start = time.perf_counter()
+        self.sampler.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self.sampler.stop()
+            self.wall_time = time.perf_counter() - self._start
+            snapshot = tracemalloc.take_snapshot() if tracemalloc.is_tracing() else None
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+            self.write(snapshot)
+        except OSError as e:
+            logger.error(f"Could not write profile for {self.method} {self.path}: {e}")
+        finally:
+            _busy.release()
+        return False
+
+    def write(self, snapshot):
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        slug = re.sub(r"[^A-Za-z0-9]+", "_", self.path).strip("_") or "root"
+        base = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{self.method}-{slug}-{os.getpid()}")
+
+        with open(f"{base}.collapsed", "w", encoding="utf-8") as f:
+            f.write(self.sampler.collapsed())
+
+        with open(f"{base}.txt", "w", encoding="utf-8") as f:
+            f.write(f"{self.method} {self.path}\n")
+            f.write(f"wall time: {self.wall_time * 1000:.1f} ms\n")
+            f.write(f"samples: {sum(self.sampler.samples.values())} every {self.sampler.interval * 1000:.1f} ms\n")
+            f.write("scope: process-wide (all threads, including other requests); "
+                    "the request's own thread is marked [profiled request]\n")
+            if snapshot is not None:
+                stats = snapshot.statistics("lineno")
+                f.write(f"\ntop allocations ({sum(s.size for s in stats) / 1024:.1f} KiB live):\n")
+                for stat in stats[:25]:
+                    f.write(f"{stat}\n")
+
+        logger.info(f"Profile for {self.method} {self.path} written to {base}.collapsed")
+        return base
+
+
+def try_profile(method: str, path: str) -> Optional[RequestProfile]:
+    """A RequestProfile if no other profile is running, else None."""
+    if not _busy.acquire(blocking=False):
+        return None
+    return RequestProfile(method, path)
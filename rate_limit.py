@@ -0,0 +1,162 @@
+# rate_limit.py
+import abc
+import asyncio
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+# -------------------------
+# ROUTE CLASSES & BUDGETS
+# -------------------------
+# Each budget is "<burst>/<seconds>": a bucket holds `burst` tokens and refills
+# at burst/seconds tokens per second. Override with RATE_LIMIT_<CLASS>.
+DEFAULT_BUDGETS = {
+    "catalog": "120/60",
+    "cart": "30/60",
+    "checkout": "5/60",
+    "orders": "60/60",
+    "auth": "10/60",
+    "availability": "120/60",
+    "default": "60/60",
+}
+
+# Paths that never touch the database and are never limited
+EXEMPT_PATHS = {"/", "/docs", "/redoc", "/openapi.json"}
+
+
+def parse_budget(value: str) -> Tuple[int, float]:
+    burst, seconds = value.split("/")
+    burst = int(burst)
+    return burst, burst / float(seconds)
+
+
+def load_budgets() -> Dict[str, Tuple[int, float]]:
+    budgets = {}
+    for name, default in DEFAULT_BUDGETS.items():
+        budgets[name] = parse_budget(os.getenv(f"RATE_LIMIT_{name.upper()}", default))
+    return budgets
+
+
+def classify_route(method: str, path: str) -> str:
+    if path.startswith("/orders/from-cart"):
+        return "checkout"
+    if path.startswith("/cart"):
+        return "cart"
+    if path.startswith("/orders") or (path.startswith("/users/") and path.endswith("/orders")):
+        return "orders"
+    if path == "/profiles/availability":
+        return "availability"
+    if path.startswith("/profiles") or path.startswith("/auth"):
+        return "auth"
+    if method == "GET" and (path.startswith("/products") or path.startswith("/product/")):
+        return "catalog"
+    return "default"
+
+
+# -------------------------
+# TOKEN BUCKET BACKENDS
+# -------------------------
+class RateLimitBackend(abc.ABC):
+    """
+    Storage for token buckets. The default keeps state in-process; subclass
+    and pass an instance to `set_backend` to share buckets across workers.
+    """
+
+    @abc.abstractmethod
+    def take(self, key: str, capacity: int, rate: float, cost: float = 1.0) -> Tuple[bool, float]:
+        """Consume `cost` tokens. Returns (allowed, seconds until retry)."""
+
+
+class InMemoryBackend(RateLimitBackend):
+    def __init__(self, max_keys: int = 50000):
+        self.max_keys = max_keys
+        self._buckets: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def take(self, key: str, capacity: int, rate: float, cost: float = 1.0) -> Tuple[bool, float]:
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.get(key, (float(capacity), now))
+            tokens = min(float(capacity), tokens + (now - last) * rate)
+
+            if tokens >= cost:
+                self._buckets[key] = (tokens - cost, now)
+                allowed, retry_after = True, 0.0
+            else:
+                self._buckets[key] = (tokens, now)
+                allowed, retry_after = False, (cost - tokens) / rate
+
+            if len(self._buckets) > self.max_keys:
+                self._evict_idle()
+        return allowed, retry_after
+
+    def _evict_idle(self):
+        # Drop the least recently touched half; an evicted bucket just starts full again
+        by_age = sorted(self._buckets.items(), key=lambda kv: kv[1][1])
+        for key, _ in by_age[: len(by_age) // 2]:
+            del self._buckets[key]
+
+
+_backend: RateLimitBackend = InMemoryBackend()
+_budgets = load_budgets()
+
+
+def set_backend(backend: RateLimitBackend):
+    global _backend
+    _backend = backend
+
+
+def check_rate_limit(identity: str, route_class: str) -> Tuple[bool, float]:
+    capacity, rate = _budgets.get(route_class, _budgets["default"])
+    return _backend.take(f"{route_class}:{identity}", capacity, rate)
+
+
+# -------------------------
+# CONCURRENCY GATE
+# -------------------------
+class ConcurrencyGate:
+    """
+    Caps in-flight requests at the DB pool size. Requests that cannot get a
+    slot within `max_wait` seconds are shed instead of queuing on the pool.
+    """
+
+    def __init__(self, limit: int, max_wait: float = 0.25):
+        self.limit = limit
+        self.max_wait = max_wait
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def acquire(self) -> bool:
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), timeout=self.max_wait)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def release(self):
+        self._semaphore.release()
+
+
+class ReleaseAfterSend:
+    """
+    Wraps the response returned by `call_next` so `release` runs only once its
+    body has been sent (or sending failed). Streaming bodies are produced while
+    they are sent, so releasing when `call_next` returns would let them run
+    outside the gate.
+    """
+
+    def __init__(self, response, release: Callable[[], None]):
+        self.response = response
+        self.release = release
+        self.status_code = response.status_code
+        self.headers = response.headers
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await self.response(scope, receive, send)
+        finally:
+            self.release()
+
+
+def retry_after_header(seconds: Optional[float]) -> str:
+    return str(max(1, int(seconds + 0.999))) if seconds else "1"
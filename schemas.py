@@ -1,6 +1,6 @@
 # schemas.py
-from pydantic import BaseModel, EmailStr
-from typing import Optional, List
+from pydantic import BaseModel, EmailStr, model_validator
+from typing import Optional, List, Dict, Literal, Union
 from datetime import date
 
 # -------------------------
@@ -99,6 +99,48 @@ class ProductUpdate(BaseModel):
     XL_stock: Optional[float] = None
     XXL_stock: Optional[float] = None
     kids: Optional[bool] = None
+    archived: Optional[bool] = None
+
+class BulkImportError(BaseModel):
+    row: int
+    id: Optional[str] = None
+    error: str
+
+class BulkImportResult(BaseModel):
+    upserted: int
+    error_count: int
+    errors: List[BulkImportError]  # capped; error_count has the full total
+
+class InventoryAdjustment(BaseModel):
+    product_id: str
+    size: Literal["XS", "S", "M", "L", "XL", "XXL"]
+    delta: Optional[float] = None  # add (or subtract) from current stock
+    absolute: Optional[float] = None  # set stock to this value
+
+    @model_validator(mode="after")
+    def check_one_mode(self):
+        if (self.delta is None) == (self.absolute is None):
+            raise ValueError("Provide exactly one of delta or absolute")
+        return self
+
+class InventoryAdjustRequest(BaseModel):
+    adjustments: List[InventoryAdjustment]
+
+class InventoryRejection(BaseModel):
+    product_id: str
+    size: str
+    reason: str
+    current_stock: Optional[float] = None
+    requested_stock: Optional[float] = None
+
+class InventoryAdjustResult(BaseModel):
+    applied: int
+    rejected: List[InventoryRejection]
+
+class StockShardRequest(BaseModel):
+    product_id: str
+    size: Literal["XS", "S", "M", "L", "XL", "XXL"]
+    shards: Optional[int] = None  # defaults to STOCK_SHARDS
 
 class ProductResponse(ProductBase):
     total_reviews: int
@@ -116,10 +158,55 @@ class ProductResponse(ProductBase):
     XL_stock: float
     XXL_stock: float
     kids: Optional[bool] = None
+    archived: bool = False
 
     class Config:
         from_attributes = True
 
+# ?view=card (crud.PRODUCT_VIEWS["card"])
+class ProductCard(BaseModel):
+    id: str
+    name: str
+    image: str
+    discount: int = 0
+    min_price: int
+    average_rating: Optional[float] = 0.0
+    total_reviews: int
+
+# ?fields=...: `id` plus only the requested fields; the others are absent, not null
+class ProductProjection(BaseModel):
+    id: str
+    name: Optional[str] = None
+    image: Optional[str] = None
+    images: Optional[List[str]] = None
+    collection: Optional[str] = None
+    category: Optional[str] = None
+    discount: Optional[int] = None
+    colors: Optional[List[str]] = None
+    description: Optional[str] = None
+    total_reviews: Optional[int] = None
+    average_rating: Optional[float] = None
+    min_price: Optional[int] = None
+    XS_price: Optional[int] = None
+    S_price: Optional[int] = None
+    M_price: Optional[int] = None
+    L_price: Optional[int] = None
+    XL_price: Optional[int] = None
+    XXL_price: Optional[int] = None
+    XS_stock: Optional[float] = None
+    S_stock: Optional[float] = None
+    M_stock: Optional[float] = None
+    L_stock: Optional[float] = None
+    XL_stock: Optional[float] = None
+    XXL_stock: Optional[float] = None
+    kids: Optional[bool] = None
+    archived: Optional[bool] = None
+
+class ProductBatchItem(BaseModel):
+    id: str
+    found: bool
+    product: Optional[Union[ProductResponse, ProductCard, ProductProjection]] = None
+
 # -------------------------
 # REVIEW SCHEMAS
 # -------------------------
@@ -132,6 +219,25 @@ class ReviewDetail(BaseModel):
     class Config:
         from_attributes = True
 
+class ReviewPage(BaseModel):
+    reviews: List[ReviewDetail]
+    next_cursor: Optional[str] = None  # pass back as ?cursor= for the next page
+    histogram: Optional[Dict[str, int]] = None  # star (1-5) -> count
+
+class ReviewStats(BaseModel):
+    total_reviews: int
+    average_rating: float = 0.0
+
+# -------------------------
+# PRODUCT PAGE SCHEMA
+# -------------------------
+class ProductPageResponse(BaseModel):
+    product: ProductResponse
+    description: str
+    review_stats: ReviewStats
+    reviews: List[ReviewDetail]
+    next_cursor: Optional[str] = None
+
 # -------------------------
 # CART RESPONSE SCHEMA
 # -------------------------
@@ -154,6 +260,17 @@ class CartResponse(BaseModel):
     total_products: int
     items: List[CartProduct]
 
+class CartTotals(BaseModel):
+    total_products: int
+    total_quantity: int
+    subtotal: int  # before discounts
+
+class CartDelta(BaseModel):
+    version: int
+    line: Optional[CartProduct] = None  # None when the line was removed
+    removed: bool = False
+    totals: CartTotals
+
 # -------------------------
 # ORDER RESPONSE SCHEMA
 # -------------------------
@@ -189,9 +306,27 @@ class ReviewCreate(BaseModel):
     text: Optional[str] = None
     time: str
 
+class UserOrderSummary(BaseModel):
+    user_id: str
+    order_count: int = 0
+    status_counts: Dict[str, int]  # pending, processing, shipped, delivered, cancelled, other
+    lifetime_total: int = 0  # excludes cancelled orders
+    last_order_id: Optional[int] = None
+    last_order_time: Optional[date] = None
+    last_order_status: Optional[str] = None
+
 class OrderUpdate(BaseModel):
     status: str
 
+class BulkOrderStatusUpdate(BaseModel):
+    order_ids: List[int]
+    status: str
+
+class BulkOrderStatusResult(BaseModel):
+    status: str
+    updated: List[int]
+    not_found: List[int]
+
 class CartUpdate(BaseModel):
     user_id: str
     product_id: str
@@ -0,0 +1,138 @@
+# slow_query.py
+import hashlib
+import logging
+import queue
+import threading
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import List, Optional
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import NullPool
+
+logger = logging.getLogger(__name__)
+
+# Re-explain the same statement at most this often
+EXPLAIN_COOLDOWN = 300
+# Fingerprints remembered for the cooldown; dynamic IN (...) lists make many
+MAX_FINGERPRINTS = 1000
+
+
+class SlowQueryLog:
+    """
+    Records statements slower than `threshold_ms` on an engine into a ring
+    buffer, with bind-parameter shapes (types and lengths, never values) and a
+    query plan. Plans are captured on a background thread over a separate,
+    unpooled connection so the slow request does not wait on EXPLAIN and the
+    app's pool is not used.
+    """
+
+    def __init__(self, threshold_ms: float = 200, maxlen: int = 100, max_fingerprints: int = MAX_FINGERPRINTS):
+        self.threshold = threshold_ms / 1000
+        self.entries = deque(maxlen=maxlen)
+        self.max_fingerprints = max_fingerprints
+        # fingerprint -> last EXPLAIN time, oldest first
+        self._explained_at: "OrderedDict[str, float]" = OrderedDict()
+        self._explained_lock = threading.Lock()
+        self._explain_queue: "queue.Queue" = queue.Queue(maxsize=20)
+        self._explain_engine = None
+        self._worker: Optional[threading.Thread] = None
+
+    def install(self, engine):
+        self._dialect = engine.dialect.name
+        self._url = engine.url
+        event.listen(engine, "before_cursor_execute", self._before)
+        event.listen(engine, "after_cursor_execute", self._after)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("slow_query_start", []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["slow_query_start"].pop()
+        duration = time.perf_counter() - started
+        if duration < self.threshold or statement.lstrip().upper().startswith("EXPLAIN"):
+            return
+
+        entry = {
+            "time": datetime.utcnow().isoformat(),
+            "duration_ms": round(duration * 1000, 1),
+            "statement": statement,
+            "param_shapes": param_shapes(parameters, executemany),
+            "plan": None,
+        }
+        self.entries.append(entry)
+        logger.warning(f"Slow query ({entry['duration_ms']} ms): {statement[:200]}")
+
+        if executemany:
+            return
+        if not self._claim_explain(hashlib.sha1(statement.encode()).hexdigest()):
+            return
+        try:
+            self._explain_queue.put_nowait((entry, statement, parameters))
+        except queue.Full:
+            return
+        self._ensure_worker()
+
+    def _claim_explain(self, fingerprint: str) -> bool:
+        """True if `fingerprint` has not been explained within EXPLAIN_COOLDOWN."""
+        now = time.monotonic()
+        with self._explained_lock:
+            # Entries are kept in time order: drop expired ones, and the oldest past the cap
+            while self._explained_at:
+                oldest, explained_at = next(iter(self._explained_at.items()))
+                if now - explained_at < EXPLAIN_COOLDOWN and len(self._explained_at) < self.max_fingerprints:
+                    break
+                del self._explained_at[oldest]
+            if fingerprint in self._explained_at:
+                return False
+            self._explained_at[fingerprint] = now
+            return True
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._explain_loop, name="slow-query-explain", daemon=True)
+            self._worker.start()
+
+    def _explain_sql(self, statement: str) -> str:
+        if self._dialect == "postgresql":
+            # ANALYZE runs the statement, so only for plain reads
+            upper = statement.lstrip().upper()
+            if upper.startswith("SELECT") and "FOR UPDATE" not in upper:
+                return f"EXPLAIN (ANALYZE, BUFFERS) {statement}"
+            return f"EXPLAIN {statement}"
+        if self._dialect == "sqlite":
+            return f"EXPLAIN QUERY PLAN {statement}"
+        return f"EXPLAIN {statement}"
+
+    def _explain_loop(self):
+        while True:
+            entry, statement, parameters = self._explain_queue.get()
+            try:
+                if self._explain_engine is None:
+                    self._explain_engine = create_engine(self._url, poolclass=NullPool)
+                with self._explain_engine.connect() as conn:
+                    rows = conn.exec_driver_sql(self._explain_sql(statement), parameters).fetchall()
+                    conn.rollback()
+                entry["plan"] = "\n".join(" | ".join(str(col) for col in row) for row in rows)
+            except Exception as e:
+                entry["plan"] = f"EXPLAIN failed: {e}"
+
+    def recent(self) -> List[dict]:
+        return list(reversed(self.entries))
+
+
+def _shape(value):
+    if isinstance(value, (list, tuple)):
+        return f"{type(value).__name__}[{len(value)}]"
+    return type(value).__name__
+
+
+def param_shapes(parameters, executemany: bool):
+    if executemany:
+        return {"executemany": len(parameters)}
+    if isinstance(parameters, dict):
+        return {key: _shape(value) for key, value in parameters.items()}
+    if isinstance(parameters, (list, tuple)):
+        return [_shape(value) for value in parameters]
+    return None
@@ -0,0 +1,80 @@
+# tests/conftest.py
+import os
+import sys
+import tempfile
+
+# Configure before the app modules are imported: they read the environment at import
+_db_dir = tempfile.mkdtemp(prefix="rangista-tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{_db_dir}/test.db"
+os.environ["SUPABASE_JWT_SECRET"] = "test-secret"
+os.environ["ALGORITHM"] = "HS256"
+os.environ["ADMIN_TOKEN"] = "test-admin-token"
+os.environ["CRON_SECRET"] = "test-cron-secret"
+os.environ["CACHE_BUS"] = "off"
+os.environ["SLOW_QUERY_MS"] = "0"
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pytest
+from fastapi.testclient import TestClient
+from jose import jwt
+
+import cache
+import database
+import invalidation
+import main
+import models
+import rate_limit
+
+ADMIN_HEADERS = {"X-Admin-Token": os.environ["ADMIN_TOKEN"]}
+# What Vercel Cron sends
+CRON_HEADERS = {"Authorization": f"Bearer {os.environ['CRON_SECRET']}"}
+
+
+def auth_headers(user_id: str) -> dict:
+    token = jwt.encode({"sub": user_id, "aud": "authenticated"}, "test-secret", algorithm="HS256")
+    return {"Authorization": f"Bearer {token}"}
+
+
+@pytest.fixture(autouse=True)
+def clean_state():
+    with database.engine.begin() as conn:
+        for table in reversed(models.Base.metadata.sorted_tables):
+            conn.execute(table.delete())
+    for target in list(invalidation.CACHES.values()) + [cache.snapshots]:
+        target.clear()
+    rate_limit.set_backend(rate_limit.InMemoryBackend())
+    database.breaker.failures = 0
+    database.breaker.opened_at = None
+    yield
+
+
+@pytest.fixture
+def db():
+    session = database.SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def client():
+    return TestClient(main.app)
+
+
+def add_user(db, user_id: str, disabled: bool = False):
+    db.add(models.User(
+        id=user_id, username=user_id, email=f"{user_id}@example.com", name=user_id,
+        contact_number="0300", permanent_address="Street 1", country="PK", city="Lahore",
+        disabled=disabled,
+    ))
+    db.commit()
+
+
+def add_product(db, product_id: str, stock: float = 5, price: int = 100):
+    db.add(models.Product(
+        id=product_id, name=product_id.upper(), image="image.png", collection="summer", category="lawn",
+        **{f"{size}_price": price for size in ("XS", "S", "M", "L", "XL", "XXL")},
+        **{f"{size}_stock": stock for size in ("XS", "S", "M", "L", "XL", "XXL")},
+    ))
+    db.commit()
@@ -0,0 +1,109 @@
+# tests/test_auth.py
+import json
+
+import pytest
+from sqlalchemy import event
+
+import cache
+import crud
+import database
+import invalidation
+import models
+import schemas
+from conftest import add_product, add_user, auth_headers
+
+LINE = {"user_id": "u1", "product_id": "p1", "size": "M", "color": None}
+
+# Every route that checks the caller's profile via verify_active_user
+ACTIVE_USER_ROUTES = [
+    ("GET", "/cart/u1", None),
+    ("GET", "/users/u1/orders", None),
+    ("GET", "/users/u1/summary", None),
+    ("POST", "/reviews/", {"user_id": "u1", "product_id": "p1", "stars": 5, "time": "2026-10-01"}),
+    ("PUT", "/cart/update", {**LINE, "quantity": 2}),
+    ("DELETE", "/cart/remove", LINE),
+    ("POST", "/cart/", {**LINE, "quantity": 1}),
+    ("POST", "/orders/from-cart/", {"user_id": "u1", "order_time": "2026-10-01T00:00:00Z"}),
+    ("GET", "/reviews/check?user_id=u1&order_id=1&product_id=p1", None),
+    ("GET", "/reviews/check/batch?user_id=u1&product_ids=p1", None),
+]
+
+
+def count_user_queries(fn):
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if "FROM users" in statement:
+            statements.append(statement)
+
+    event.listen(database.engine, "before_cursor_execute", capture)
+    try:
+        fn()
+    finally:
+        event.remove(database.engine, "before_cursor_execute", capture)
+    return len(statements)
+
+
+def test_authenticated_routes_reject_unknown_users(client):
+    response = client.get("/users/ghost/summary", headers=auth_headers("ghost"))
+    assert response.status_code == 401
+
+
+def test_principal_is_cached(client, db):
+    add_user(db, "u1")
+    assert client.get("/users/u1/summary", headers=auth_headers("u1")).status_code == 200
+    assert "u1" in cache.principals._data
+
+    queries = count_user_queries(lambda: client.get("/users/u1/summary", headers=auth_headers("u1")))
+    assert queries == 0
+
+
+def test_disabling_a_user_takes_effect_immediately(client, db):
+    add_user(db, "u1")
+    assert client.get("/users/u1/summary", headers=auth_headers("u1")).status_code == 200
+
+    crud.update_user(db, crud.get_user_by_id(db, "u1"), schemas.UserUpdate(disabled=True))
+
+    response = client.get("/users/u1/summary", headers=auth_headers("u1"))
+    assert response.status_code == 403
+    assert response.json()["detail"] == "User account is disabled"
+    assert client.get("/cart/u1", headers=auth_headers("u1")).status_code == 403
+
+
+@pytest.mark.parametrize("method,url,body", ACTIVE_USER_ROUTES)
+def test_disabled_user_is_rejected_everywhere(client, db, method, url, body):
+    add_user(db, "u1", disabled=True)
+    add_product(db, "p1")
+
+    response = client.request(method, url, json=body, headers=auth_headers("u1"))
+    assert response.status_code == 403
+    assert response.json()["detail"] == "User account is disabled"
+    assert db.query(models.Cart).count() == db.query(models.Review).count() == db.query(models.Order).count() == 0
+
+
+@pytest.mark.parametrize("method,url,body", ACTIVE_USER_ROUTES)
+def test_token_without_a_profile_is_rejected_everywhere(client, db, method, url, body):
+    add_product(db, "p1")
+    response = client.request(method, url, json=body, headers=auth_headers("u1"))
+    assert response.status_code == 401
+
+
+def test_disabling_through_the_api_drops_the_cached_principal(client, db):
+    add_user(db, "u1")
+    assert client.get("/cart/u1", headers=auth_headers("u1")).status_code == 404  # empty cart, but allowed
+    assert "u1" in cache.principals._data
+
+    response = client.put("/users/u1", json={"disabled": True}, headers=auth_headers("u1"))
+    assert response.status_code == 200
+    assert "u1" not in cache.principals._data
+    assert client.get("/cart/u1", headers=auth_headers("u1")).status_code == 403
+
+
+def test_disabling_in_another_process_drops_the_cached_principal(client, db):
+    add_user(db, "u1")
+    assert client.get("/users/u1/summary", headers=auth_headers("u1")).status_code == 200
+    db.query(models.User).filter(models.User.id == "u1").update({models.User.disabled: True})
+    db.commit()
+
+    invalidation._handle_message(json.dumps({"origin": "another-process", "cache": "principals", "keys": ["u1"]}))
+    assert client.get("/users/u1/summary", headers=auth_headers("u1")).status_code == 403
@@ -0,0 +1,69 @@
+# tests/test_bloom.py
+import threading
+import time
+
+import bloom
+from conftest import add_user
+
+
+def wait_until_fresh(names: bloom.TakenNamesFilter, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while names.is_stale():
+        assert time.monotonic() < deadline, "filter was never rebuilt"
+        time.sleep(0.01)
+
+
+def test_filter_is_sized_for_usernames_and_emails():
+    names = bloom.TakenNamesFilter()
+    usernames = [f"user{i}" for i in range(20000)]
+    emails = [f"user{i}@example.com" for i in range(20000)]
+    names.rebuild(usernames, emails)
+
+    assert names._filter.size >= bloom.BloomFilter(capacity=len(usernames) + len(emails)).size
+    false_positives = sum(names.might_be_taken("username", f"free{i}") for i in range(10000))
+    assert false_positives / 10000 <= names.error_rate
+
+
+def test_rebuild_runs_in_the_background():
+    names = bloom.TakenNamesFilter()
+    release = threading.Event()
+
+    def slow_load():
+        release.wait(5)
+        return ["taken"], ["taken@example.com"]
+
+    started = time.monotonic()
+    names.ensure_fresh(slow_load)
+    assert time.monotonic() - started < 1
+    # Not built yet: everything is a possible hit, so callers ask the database
+    assert names.might_be_taken("username", "anything")
+
+    release.set()
+    wait_until_fresh(names)
+    assert names.might_be_taken("username", "taken")
+    assert names.might_be_taken("email", "TAKEN@example.com")
+    assert not names.might_be_taken("username", "free")
+
+
+def test_failed_rebuild_is_retried():
+    names = bloom.TakenNamesFilter()
+
+    def broken_load():
+        raise RuntimeError("database unavailable")
+
+    names.ensure_fresh(broken_load)
+    deadline = time.monotonic() + 5
+    while names._rebuild_lock.locked():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+    names.ensure_fresh(lambda: (["taken"], []))
+    wait_until_fresh(names)
+    assert not names.might_be_taken("username", "free")
+
+
+def test_availability_endpoint(client, db):
+    add_user(db, "u1")
+    response = client.get("/profiles/availability?username=u1&email=U1@example.com")
+    assert response.json() == {"username_available": False, "email_available": False}
+    assert client.get("/profiles/availability?username=someone-new").json() == {"username_available": True}
+    assert client.get("/profiles/availability").status_code == 400
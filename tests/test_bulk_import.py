@@ -0,0 +1,102 @@
+# tests/test_bulk_import.py
+import asyncio
+import json
+
+import pytest
+
+import bulk_import
+import cache
+import crud
+import models
+from conftest import ADMIN_HEADERS, add_product
+
+
+def parse(parser, body: bytes, chunk_size: int = 7):
+    """Run a parser over `body` split into small chunks, so lines straddle them."""
+    async def chunks():
+        for start in range(0, len(body), chunk_size):
+            yield body[start:start + chunk_size]
+
+    async def collect():
+        return [row async for row in parser(chunks())]
+
+    return asyncio.run(collect())
+
+
+def product_row(product_id: str, **fields) -> dict:
+    return {
+        "id": product_id, "name": product_id.upper(), "image": "image.png",
+        "collection": "summer", "category": "lawn",
+        **{f"{size}_price": 100 for size in ("XS", "S", "M", "L", "XL", "XXL")},
+        **{f"{size}_stock": 5 for size in ("XS", "S", "M", "L", "XL", "XXL")},
+        **fields,
+    }
+
+
+def test_ndjson_rows_and_errors():
+    body = b'{"id": "p1"}\r\n\n[1, 2]\n{"id": \n{"id": "p2"}'
+    assert parse(bulk_import.iter_ndjson, body) == [
+        (1, {"id": "p1"}, None),
+        (2, None, "Each line must be a JSON object"),
+        (3, None, "Invalid JSON: Expecting value: line 1 column 8 (char 7)"),
+        (4, {"id": "p2"}, None),
+    ]
+
+
+def test_csv_quoted_cells_may_span_lines():
+    body = b'id,name,colors\np1,"Two\nlines, with comma",red|blue\np2,"Say ""hi""",\n'
+    assert parse(bulk_import.iter_csv, body) == [
+        (1, {"id": "p1", "name": "Two\nlines, with comma", "colors": ["red", "blue"]}, None),
+        (2, {"id": "p2", "name": 'Say "hi"', "colors": None}, None),
+    ]
+
+
+def test_csv_lists_and_bad_rows():
+    body = b'id,images\np1, a.png | b.png |\np2,"[""x.png""]"\np3\np4,"[broken"\np5,"unterminated\n'
+    rows = parse(bulk_import.iter_csv, body)
+
+    assert rows[0] == (1, {"id": "p1", "images": ["a.png", "b.png"]}, None)
+    assert rows[1] == (2, {"id": "p2", "images": ["x.png"]}, None)
+    assert rows[2] == (3, None, "Expected 2 columns, got 1")
+    assert rows[3][0] == 4 and rows[3][2].startswith("Invalid JSON list")
+    assert rows[4] == (5, None, "Unterminated quoted field")
+
+
+def test_invalid_utf8_names_the_line():
+    with pytest.raises(bulk_import.InvalidEncoding) as error:
+        parse(bulk_import.iter_ndjson, b'{"id": "p1"}\n{"id": "\xff"}\n')
+    assert error.value.line == 2
+
+
+def test_bulk_import_needs_the_admin_token(client):
+    body = json.dumps(product_row("p1"))
+    assert client.post("/products/bulk", content=body).status_code == 403
+
+
+def test_bulk_import_rejects_invalid_utf8(client, db):
+    body = json.dumps(product_row("p1")).encode() + b"\n\xff\xfe\n"
+    response = client.post("/products/bulk", content=body, headers=ADMIN_HEADERS)
+    assert response.status_code == 400
+    assert "Line 2 is not valid UTF-8" in response.json()["detail"]
+
+
+def test_bulk_import_invalidates_once_after_all_batches(client, db, monkeypatch):
+    add_product(db, "p1")
+    cache.catalog.set("p1", "stale")
+    monkeypatch.setattr("main.BULK_IMPORT_BATCH_SIZE", 2)
+    calls = []
+    invalidate = crud.invalidate_products
+
+    def recording_invalidate(session, product_ids):
+        calls.append(set(product_ids))
+        invalidate(session, product_ids)
+
+    monkeypatch.setattr(crud, "invalidate_products", recording_invalidate)
+    lines = [json.dumps(product_row(f"p{i}")) for i in range(1, 6)] + ['{"id": "bad"}']
+    response = client.post("/products/bulk", content="\n".join(lines), headers=ADMIN_HEADERS)
+
+    assert response.status_code == 200
+    assert response.json()["upserted"] == 5 and response.json()["error_count"] == 1
+    assert calls == [{"p1", "p2", "p3", "p4", "p5"}]
+    assert cache.catalog.get("p1") is None
+    assert db.query(models.Product).count() == 5
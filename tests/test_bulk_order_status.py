@@ -0,0 +1,54 @@
+# tests/test_bulk_order_status.py
+from datetime import date
+
+import crud
+import main
+import models
+from conftest import ADMIN_HEADERS, add_product, add_user
+
+
+def add_order(db, user_id: str, status: str = "pending") -> int:
+    order = models.Order(user_id=user_id, status=status, status_rank=crud.order_status_rank(status),
+                         time=date(2026, 10, 1))
+    db.add(order)
+    db.flush()
+    db.add(models.OrderItem(order_id=order.id, product_id="p1", size="M", quantity=1, unit_price=100))
+    db.commit()
+    return order.id
+
+
+def test_bulk_update_reports_missing_ids(client, db):
+    add_user(db, "u1")
+    add_product(db, "p1")
+    ids = [add_order(db, "u1") for _ in range(3)]
+
+    body = {"order_ids": [ids[2], ids[0], 999, ids[0]], "status": "shipped"}
+    assert client.put("/orders/status", json=body).status_code == 403
+    response = client.put("/orders/status", json=body, headers=ADMIN_HEADERS)
+
+    assert response.status_code == 200
+    assert response.json() == {"status": "shipped", "updated": sorted([ids[0], ids[2]]), "not_found": [999]}
+    db.expire_all()
+    statuses = {o.id: (o.status, o.status_rank) for o in db.query(models.Order)}
+    assert statuses[ids[0]] == ("shipped", crud.order_status_rank("shipped"))
+    assert statuses[ids[1]][0] == "pending"
+
+
+def test_bulk_update_is_capped(client, monkeypatch):
+    monkeypatch.setattr(main, "MAX_BULK_ORDER_IDS", 2)
+    response = client.put("/orders/status", json={"order_ids": [1, 2, 3], "status": "shipped"}, headers=ADMIN_HEADERS)
+    assert response.status_code == 400
+
+
+def test_bulk_update_keeps_summaries_in_step(db):
+    add_user(db, "u1")
+    add_user(db, "u2")
+    add_product(db, "p1")
+    ids = [add_order(db, "u1"), add_order(db, "u2"), add_order(db, "u2", status="cancelled")]
+
+    crud.bulk_update_order_status(db, ids, "cancelled")
+
+    for user_id, count in (("u1", 1), ("u2", 2)):
+        summary = crud.get_user_order_summary(db, user_id)
+        assert summary.status_counts["cancelled"] == count
+        assert summary.lifetime_total == 0
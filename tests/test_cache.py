@@ -0,0 +1,148 @@
+# tests/test_cache.py
+import asyncio
+import threading
+import time
+
+import pytest
+
+import cache
+import crud
+import schemas
+from conftest import add_product, add_user
+
+
+def test_load_is_dropped_only_if_its_key_was_invalidated():
+    c = cache.TTLCache()
+    generation = c.generation
+    c.invalidate("other")
+    c.set("a", 1, generation=generation)
+    assert c.get("a") == 1
+
+    generation = c.generation
+    c.invalidate("a")
+    c.set("a", 2, generation=generation)
+    assert c.get("a") is None
+
+
+def test_clear_refuses_loads_that_started_before_it():
+    c = cache.TTLCache()
+    generation = c.generation
+    c.clear()
+    c.set("a", 1, generation=generation)
+    assert c.get("a") is None
+    c.set("a", 1, generation=c.generation)
+    assert c.get("a") == 1
+
+
+def test_forgotten_invalidations_stay_conservative():
+    c = cache.TTLCache(maxsize=2)
+    generation = c.generation
+    for key in ("a", "b", "c"):
+        c.invalidate(key)
+    assert len(c._invalidated_at) == 2
+    # "a" is no longer tracked, so any load from before its invalidation is refused
+    c.set("a", 1, generation=generation)
+    assert c.get("a") is None
+
+
+def test_single_flight_runs_one_load_for_concurrent_callers():
+    flight = cache.SingleFlight("test_flight")
+    started, release = threading.Event(), threading.Event()
+    calls, results = [], []
+
+    def load():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "value"
+
+    threads = [threading.Thread(target=lambda: results.append(flight.do("k", load))) for _ in range(5)]
+    threads[0].start()
+    started.wait(5)
+    for t in threads[1:]:
+        t.start()
+    time.sleep(0.05)
+    release.set()
+    for t in threads:
+        t.join(5)
+
+    assert calls == [1]
+    assert results == ["value"] * 5
+    assert flight.do("k", lambda: "next") == "next"
+
+
+def test_single_flight_shares_errors_and_frees_the_key():
+    flight = cache.SingleFlight("test_flight")
+
+    def broken():
+        raise RuntimeError("query failed")
+
+    with pytest.raises(RuntimeError):
+        flight.do("k", broken)
+    assert flight.do("k", lambda: 1) == 1
+
+
+def test_single_flight_coalesces_async_callers_with_sync_ones():
+    flight = cache.SingleFlight("test_flight")
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def load():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return "value"
+
+    sync_result = []
+    leader = threading.Thread(target=lambda: sync_result.append(flight.do("k", load)))
+    leader.start()
+    started.wait(5)
+
+    async def callers():
+        waiting = asyncio.gather(*(flight.do_async("k", load) for _ in range(5)))
+        await asyncio.sleep(0.05)
+        release.set()
+        return await waiting
+
+    assert asyncio.run(callers()) == ["value"] * 5
+    leader.join(5)
+    assert calls == [1]
+    assert sync_result == ["value"]
+
+
+def test_single_flight_async_leader_runs_one_load():
+    flight = cache.SingleFlight("test_flight")
+    calls = []
+
+    def load():
+        calls.append(1)
+        time.sleep(0.05)
+        return "value"
+
+    async def callers():
+        return await asyncio.gather(*(flight.do_async("k", load) for _ in range(5)))
+
+    assert asyncio.run(callers()) == ["value"] * 5
+    assert calls == [1]
+
+    async def broken():
+        return await flight.do_async("k", lambda: 1 / 0)
+
+    with pytest.raises(ZeroDivisionError):
+        asyncio.run(broken())
+    assert asyncio.run(callers()) == ["value"] * 5
+
+
+def test_cart_writes_keep_the_list_cache(client, db):
+    add_user(db, "u1")
+    add_product(db, "p1", stock=5)
+    client.get("/products")
+    assert len(cache.catalog_lists) == 1
+
+    crud.add_to_cart(db, schemas.CartCreate(user_id="u1", product_id="p1", size="M", quantity=1))
+    assert len(cache.catalog_lists) == 1
+    assert client.get("/product/p1").json()["M_stock"] == 4
+
+    crud.update_product(db, "p1", schemas.ProductUpdate(name="Renamed"))
+    assert len(cache.catalog_lists) == 0
+    assert client.get("/products").json()[0]["name"] == "Renamed"
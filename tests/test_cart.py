@@ -0,0 +1,69 @@
+# tests/test_cart.py
+from conftest import add_product, add_user, auth_headers
+
+
+def add(client, quantity=1, delta=False, product_id="p1", size="M"):
+    body = {"user_id": "u1", "product_id": product_id, "size": size, "quantity": quantity}
+    return client.post(f"/cart/?delta={str(delta).lower()}", json=body, headers=auth_headers("u1"))
+
+
+def test_unchanged_cart_gets_304(client, db):
+    add_user(db, "u1")
+    add_product(db, "p1")
+    etag = add(client).headers["ETag"]
+
+    cached = client.get("/cart/u1", headers={**auth_headers("u1"), "If-None-Match": etag})
+    assert cached.status_code == 304
+    assert cached.headers["ETag"] == etag
+    assert cached.content == b""
+
+    stale = client.get("/cart/u1", headers={**auth_headers("u1"), "If-None-Match": '"cart-0"'})
+    assert stale.status_code == 200
+    assert stale.headers["ETag"] == etag
+    assert stale.json()["total_products"] == 1
+
+
+def test_every_cart_write_bumps_the_version(client, db):
+    add_user(db, "u1")
+    add_product(db, "p1")
+    line = {"user_id": "u1", "product_id": "p1", "size": "M", "color": None}
+
+    etags = [add(client).headers["ETag"], add(client).headers["ETag"]]
+    etags.append(client.put("/cart/update", json={**line, "quantity": 3}, headers=auth_headers("u1")).headers["ETag"])
+    etags.append(client.request("DELETE", "/cart/remove", json=line, headers=auth_headers("u1")).headers["ETag"])
+
+    assert etags == ['"cart-1"', '"cart-2"', '"cart-3"', '"cart-4"']
+    empty = client.get("/cart/u1", headers={**auth_headers("u1"), "If-None-Match": etags[-1]})
+    assert empty.status_code == 304
+
+
+def test_delta_has_the_changed_line_and_totals(client, db):
+    add_user(db, "u1")
+    add_product(db, "p1", price=100)
+    add_product(db, "p2", price=40)
+    add(client, quantity=2)
+
+    response = add(client, quantity=1, delta=True, product_id="p2", size="S")
+    assert response.status_code == 200
+    body = response.json()
+    assert set(body) == {"version", "line", "removed", "totals"}
+    assert body["version"] == 2 and response.headers["ETag"] == '"cart-2"'
+    assert body["removed"] is False
+    assert body["line"]["product_id"] == "p2" and body["line"]["size"] == "S" and body["line"]["quantity"] == 1
+    assert body["line"]["price"] == 40
+    assert body["totals"] == {"total_products": 2, "total_quantity": 3, "subtotal": 240}
+
+
+def test_delta_for_a_removed_line(client, db):
+    add_user(db, "u1")
+    add_product(db, "p1")
+    add(client)
+
+    line = {"user_id": "u1", "product_id": "p1", "size": "M", "color": None, "quantity": 0}
+    body = client.put("/cart/update?delta=true", json=line, headers=auth_headers("u1")).json()
+    assert body == {
+        "version": 2,
+        "line": None,
+        "removed": True,
+        "totals": {"total_products": 0, "total_quantity": 0, "subtotal": 0},
+    }
@@ -0,0 +1,124 @@
+# tests/test_cart_sweeper.py
+from datetime import datetime, timedelta
+
+import crud
+import models
+import schemas
+from conftest import ADMIN_HEADERS, CRON_HEADERS, add_product, add_user
+
+
+def add_line(db, user_id: str, product_id: str, size: str, quantity: int):
+    crud.add_to_cart(db, schemas.CartCreate(user_id=user_id, product_id=product_id, size=size, quantity=quantity))
+
+
+def age_cart(db, user_id: str, minutes: int = 120):
+    db.query(models.Cart).filter(models.Cart.user_id == user_id).update(
+        {models.Cart.last_touched: datetime.utcnow() - timedelta(minutes=minutes)}, synchronize_session=False
+    )
+    db.commit()
+
+
+def stock(db, product_id: str, size: str) -> float:
+    db.expire_all()
+    return getattr(db.get(models.Product, product_id), f"{size}_stock")
+
+
+def test_sweep_returns_stock_of_abandoned_carts(db):
+    add_user(db, "u1")
+    add_user(db, "u2")
+    add_product(db, "p1", stock=10)
+    add_line(db, "u1", "p1", "M", 3)
+    add_line(db, "u2", "p1", "M", 2)
+    age_cart(db, "u1")
+    version = crud.get_cart_version(db, "u1")
+
+    totals = crud.sweep_abandoned_carts(db, hold_minutes=60)
+
+    assert (totals["lines"], totals["units"], totals["carts"]) == (1, 3, 1)
+    assert stock(db, "p1", "M") == 8
+    assert db.query(models.Cart).filter(models.Cart.user_id == "u1").count() == 0
+    assert db.query(models.Cart).filter(models.Cart.user_id == "u2").count() == 1
+    assert crud.get_cart_version(db, "u1") == version + 1
+    ledger = db.query(models.StockMovement).filter(models.StockMovement.reason == "cart_expired").one()
+    assert ledger.delta == 3
+
+
+def test_cart_touched_before_the_lock_is_kept(db, monkeypatch):
+    add_user(db, "u1")
+    add_product(db, "p1", stock=10)
+    add_line(db, "u1", "p1", "M", 3)
+    age_cart(db, "u1")
+    lock_carts = crud._lock_carts
+
+    def touched_meanwhile(session, user_ids):
+        # The user added to the cart after the sweeper picked it, before it got the lock
+        crud.touch_cart(session, "u1")
+        return lock_carts(session, user_ids)
+
+    monkeypatch.setattr(crud, "_lock_carts", touched_meanwhile)
+    totals = crud.sweep_abandoned_carts(db, hold_minutes=60)
+
+    assert totals["lines"] == 0
+    assert stock(db, "p1", "M") == 7
+    assert db.query(models.Cart).filter(models.Cart.user_id == "u1").count() == 1
+
+
+def test_carts_in_use_are_skipped_without_spinning(db, monkeypatch):
+    add_user(db, "u1")
+    add_product(db, "p1", stock=10)
+    add_line(db, "u1", "p1", "M", 3)
+    age_cart(db, "u1")
+    monkeypatch.setattr(crud, "_lock_carts", lambda session, user_ids: [])
+
+    totals = crud.sweep_abandoned_carts(db, hold_minutes=60)
+
+    assert totals["batches"] == 0
+    assert stock(db, "p1", "M") == 7
+
+
+def test_legacy_cart_without_version_row_is_swept(db):
+    add_user(db, "u1")
+    add_product(db, "p1", stock=10)
+    db.add(models.Cart(user_id="u1", product_id="p1", size="S", quantity=2,
+                       last_touched=datetime.utcnow() - timedelta(hours=3)))
+    db.query(models.Product).filter(models.Product.id == "p1").update({models.Product.S_stock: 8})
+    db.commit()
+
+    assert crud.sweep_abandoned_carts(db, hold_minutes=60)["lines"] == 1
+    assert stock(db, "p1", "S") == 10
+
+
+def test_cart_writes_lock_the_cart_before_reading_it(db, monkeypatch):
+    add_user(db, "u1")
+    add_product(db, "p1", stock=10)
+    calls = []
+    bump = crud.bump_cart_version
+
+    def locking_bump(session, user_id):
+        calls.append("lock")
+        return bump(session, user_id)
+
+    def recording_reserve(*args):
+        calls.append("reserve")
+        return True
+
+    monkeypatch.setattr(crud, "bump_cart_version", locking_bump)
+    monkeypatch.setattr(crud, "reserve_stock", recording_reserve)
+
+    add_line(db, "u1", "p1", "M", 1)
+    assert calls == ["lock", "reserve"]
+
+
+def test_cron_sweeps_with_the_cron_secret(client, db):
+    add_user(db, "u1")
+    add_product(db, "p1", stock=10)
+    add_line(db, "u1", "p1", "M", 3)
+    age_cart(db, "u1", minutes=crud.CART_HOLD_MINUTES + 5)
+
+    assert client.get("/admin/cart/sweep").status_code == 403
+    assert client.get("/admin/cart/sweep", headers=ADMIN_HEADERS).status_code == 403
+
+    response = client.get("/admin/cart/sweep", headers=CRON_HEADERS)
+    assert response.status_code == 200
+    assert response.json()["lines"] == 1
+    assert stock(db, "p1", "M") == 10
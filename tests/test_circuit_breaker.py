@@ -0,0 +1,111 @@
+# tests/test_circuit_breaker.py
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+import database
+from circuit_breaker import CircuitBreaker, CircuitOpen
+from conftest import add_product, auth_headers
+
+
+def wait_for(condition, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_opens_after_threshold_and_closes_after_probe():
+    healthy = threading.Event()
+    probes = []
+
+    def probe():
+        probes.append(time.monotonic())
+        if not healthy.is_set():
+            raise RuntimeError("still down")
+
+    breaker = CircuitBreaker("test_breaker", probe, failure_threshold=3, probe_base_delay=0.01, probe_max_delay=0.02)
+    breaker.record_failure()
+    breaker.record_failure()
+    breaker.check()
+    breaker.record_failure()
+
+    assert breaker.is_open
+    with pytest.raises(CircuitOpen) as excinfo:
+        breaker.check()
+    assert excinfo.value.retry_after >= 1
+
+    wait_for(lambda: len(probes) >= 2)
+    healthy.set()
+    wait_for(lambda: not breaker.is_open)
+    breaker.check()
+
+
+def test_success_resets_the_failure_count():
+    breaker = CircuitBreaker("test_breaker", lambda: None, failure_threshold=2)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert not breaker.is_open
+
+
+class FakePgError(Exception):
+    def __init__(self, pgcode):
+        super().__init__(f"pgcode {pgcode}")
+        self.pgcode = pgcode
+
+
+def error_context(original, is_pre_ping=False, is_disconnect=False):
+    return SimpleNamespace(
+        is_pre_ping=is_pre_ping,
+        is_disconnect=is_disconnect,
+        original_exception=original,
+        sqlalchemy_exception=OperationalError("SELECT 1", {}, original),
+    )
+
+
+@pytest.mark.parametrize("context", [
+    error_context(FakePgError("08006"), is_pre_ping=True, is_disconnect=True),
+    error_context(FakePgError("40P01")),
+    error_context(FakePgError("40001")),
+    error_context(FakePgError("55P03")),
+    error_context(Exception("database is locked")),
+])
+def test_pre_ping_and_contention_do_not_count(context):
+    database._record_db_error(context)
+    assert database.breaker.failures == 0
+
+
+def test_real_failures_count():
+    database._record_db_error(error_context(FakePgError("08006"), is_disconnect=True))
+    database._record_db_error(error_context(FakePgError("53300")))
+    assert database.breaker.failures == 2
+
+
+def open_breaker():
+    database.breaker.opened_at = time.monotonic()
+    database.breaker.next_probe_at = time.monotonic() + 5
+
+
+def test_product_page_serves_stale_snapshot(client, db):
+    add_product(db, "p1")
+    fresh = client.get("/product/p1/page")
+    assert fresh.status_code == 200 and "X-Served-Stale" not in fresh.headers
+
+    open_breaker()
+    stale = client.get("/product/p1/page")
+    assert stale.status_code == 200
+    assert stale.headers["X-Served-Stale"] == "true"
+    assert stale.json() == fresh.json()
+
+    assert client.get("/product/p2/page").status_code == 503
+
+
+def test_other_endpoints_fail_fast_while_open(client):
+    open_breaker()
+    response = client.get("/users/u1/summary", headers=auth_headers("u1"))
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
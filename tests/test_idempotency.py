@@ -0,0 +1,155 @@
+# tests/test_idempotency.py
+import hashlib
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import crud
+import database
+import models
+import schemas
+from conftest import add_product, add_user, auth_headers
+
+
+def post_cart(client, key, quantity=1, user_id="u1"):
+    headers = {**auth_headers(user_id), "Idempotency-Key": key}
+    body = {"user_id": user_id, "product_id": "p1", "size": "M", "quantity": quantity}
+    return client.post("/cart/", json=body, headers=headers)
+
+
+def stock(db):
+    db.expire_all()
+    return db.get(models.Product, "p1").M_stock
+
+
+def test_retry_replays_the_stored_response(client, db):
+    add_user(db, "u1")
+    add_product(db, "p1", stock=5)
+    first = post_cart(client, "key-1")
+    retry = post_cart(client, "key-1")
+
+    assert first.status_code == retry.status_code == 200
+    assert retry.json() == first.json()
+    assert retry.headers["Idempotent-Replayed"] == "true"
+    assert stock(db) == 4
+
+
+def test_key_reused_with_a_different_body_is_rejected(client, db):
+    add_user(db, "u1")
+    add_product(db, "p1", stock=5)
+    assert post_cart(client, "key-1").status_code == 200
+    assert post_cart(client, "key-1", quantity=2).status_code == 422
+    assert stock(db) == 4
+
+
+def fingerprint(quantity=1):
+    payload = schemas.CartCreate(user_id="u1", product_id="p1", size="M", quantity=quantity)
+    body = json.dumps(jsonable_encoder(payload), sort_keys=True)
+    return hashlib.sha256(f"POST /cart/\n{body}".encode()).hexdigest()
+
+
+@pytest.fixture
+def impatient_db():
+    """A second session that gives up on SQLite's write lock almost at once."""
+    engine = create_engine(database.DATABASE_URL, connect_args={"timeout": 0.1})
+    session = sessionmaker(bind=engine)()
+    try:
+        yield session
+    finally:
+        session.close()
+        engine.dispose()
+
+
+def test_retry_waits_for_the_first_request_then_replays(db, impatient_db):
+    assert crud.claim_idempotency_key(db, "u1", "key-1", "POST /cart/", fingerprint()) is None
+
+    with pytest.raises(crud.IdempotencyKeyBusy):
+        crud.claim_idempotency_key(impatient_db, "u1", "key-1", "POST /cart/", fingerprint())
+    impatient_db.rollback()
+
+    crud.save_idempotency_response(db, "u1", "key-1", 200, {"ok": True})
+    db.commit()
+    record = crud.claim_idempotency_key(impatient_db, "u1", "key-1", "POST /cart/", fingerprint())
+    assert record.status_code == 200 and json.loads(record.response_body) == {"ok": True}
+
+
+def test_claim_of_a_crashed_request_is_not_kept(db, impatient_db):
+    assert crud.claim_idempotency_key(db, "u1", "key-1", "POST /cart/", fingerprint()) is None
+    db.rollback()  # the request died before committing
+
+    assert crud.claim_idempotency_key(impatient_db, "u1", "key-1", "POST /cart/", fingerprint()) is None
+
+
+def test_busy_key_gets_409(client, db, monkeypatch):
+    add_user(db, "u1")
+    add_product(db, "p1", stock=5)
+
+    def busy(*args):
+        raise crud.IdempotencyKeyBusy("key-1")
+
+    monkeypatch.setattr(crud, "claim_idempotency_key", busy)
+    response = post_cart(client, "key-1")
+    assert response.status_code == 409
+    assert response.headers["Retry-After"] == "1"
+    assert stock(db) == 5
+
+
+def test_response_is_committed_with_the_writes(client, db, monkeypatch):
+    add_user(db, "u1")
+    add_product(db, "p1", stock=5)
+
+    def crash(*args):
+        raise RuntimeError("process died before the response was stored")
+
+    monkeypatch.setattr(crud, "save_idempotency_response", crash)
+    with pytest.raises(RuntimeError):
+        post_cart(client, "key-1")
+    assert stock(db) == 5
+    assert db.query(models.Cart).count() == 0
+    assert db.query(models.IdempotencyKey).count() == 0
+
+
+def test_expired_keys_are_purged(db):
+    past = datetime.utcnow() - timedelta(hours=1)
+    for i in range(3):
+        db.add(models.IdempotencyKey(
+            user_id="u1", key=f"old-{i}", scope="POST /cart/", fingerprint="x",
+            status_code=200, response_body="{}", created_at=past, expires_at=past
+        ))
+    assert crud.claim_idempotency_key(db, "u1", "new", "POST /cart/", fingerprint()) is None
+    db.commit()
+
+    assert crud.purge_idempotency_keys(db, limit=2) == 2
+    assert crud.purge_idempotency_keys(db) == 1
+    db.commit()
+    assert [row.key for row in db.query(models.IdempotencyKey)] == ["new"]
+
+
+def test_failed_request_releases_the_key(client, db):
+    add_user(db, "u1")
+    add_product(db, "p1", stock=1)
+    assert post_cart(client, "key-1", quantity=3).status_code == 400
+
+    db.query(models.Product).filter(models.Product.id == "p1").update({models.Product.M_stock: 5})
+    db.commit()
+    assert post_cart(client, "key-1", quantity=3).status_code == 200
+    assert stock(db) == 2
+
+
+def test_checkout_retry_creates_one_order(client, db):
+    add_user(db, "u1")
+    add_product(db, "p1", stock=5)
+    assert post_cart(client, "cart-key").status_code == 200
+    headers = {**auth_headers("u1"), "Idempotency-Key": "checkout-key"}
+    body = {"user_id": "u1", "order_time": "2026-10-01T00:00:00Z"}
+
+    first = client.post("/orders/from-cart/", json=body, headers=headers)
+    retry = client.post("/orders/from-cart/", json=body, headers=headers)
+
+    assert first.status_code == retry.status_code == 200
+    assert retry.json() == first.json()
+    assert db.query(models.Order).count() == 1
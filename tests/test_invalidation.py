@@ -0,0 +1,138 @@
+# tests/test_invalidation.py
+import json
+import threading
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.orm import sessionmaker
+
+import cache
+import crud
+import database
+import invalidation
+import models
+
+
+@pytest.fixture
+def bus():
+    """An outbox bus with a stand-in for its running thread, so commits queue messages."""
+    bus = invalidation.InvalidationBus(database.engine, mode="outbox")
+    bus._thread = threading.Thread(target=bus._stop.wait)
+    bus._thread.start()
+    yield bus
+    bus.stop()
+    bus._thread.join()
+
+
+@pytest.fixture
+def session(bus):
+    factory = sessionmaker(bind=database.engine)
+    bus.install(factory)
+    session = factory()
+    yield session
+    session.close()
+
+
+def writer_statements(fn):
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(database.engine, "before_cursor_execute", capture)
+    try:
+        fn()
+    finally:
+        event.remove(database.engine, "before_cursor_execute", capture)
+    return statements
+
+
+def test_product_writes_are_sent_after_commit(bus, session):
+    cache.catalog.set("p1", "stale")
+    cache.catalog_lists.set(("products", None), "stale")
+
+    crud.invalidate_products(session, ["p1"])
+    statements = writer_statements(session.commit)
+
+    assert not any("cache_invalidations" in s or "pg_notify" in s for s in statements)
+    assert cache.catalog.get("p1") is None and cache.catalog_lists.get(("products", None)) is None
+    assert bus._take_outgoing() == {("catalog", "p1"), ("catalog_lists", None)}
+
+
+def test_cart_stock_movements_are_not_broadcast(bus, session):
+    cache.catalog.set("p1", "stale")
+    cache.catalog_lists.set(("products", None), "kept")
+
+    crud.invalidate_stock(session, ["p1"])
+    session.commit()
+
+    assert cache.catalog.get("p1") is None
+    assert cache.catalog_lists.get(("products", None)) == "kept"
+    assert bus._take_outgoing() == set()
+
+
+def test_rolled_back_invalidations_are_dropped(bus, session):
+    cache.catalog.set("p1", "kept")
+    crud.invalidate_products(session, ["p1"])
+    session.rollback()
+
+    assert cache.catalog.get("p1") == "kept"
+    assert bus._take_outgoing() == set()
+
+
+def test_commits_are_published_as_one_batch(bus, session, db, monkeypatch):
+    for product_id in ("p1", "p2", "p3"):
+        crud.invalidate_products(session, [product_id])
+        session.commit()
+
+    with database.engine.connect() as conn:
+        bus._publish(conn)
+    rows = [json.loads(row.payload) for row in db.query(models.CacheInvalidation)]
+    assert sorted((row["cache"], sorted(row["keys"], key=str)) for row in rows) == [
+        ("catalog", ["p1", "p2", "p3"]), ("catalog_lists", [None]),
+    ]
+
+    # Another process applies them
+    monkeypatch.setattr(invalidation, "ORIGIN", "another-process")
+    cache.catalog.set("p2", "stale")
+    for row in rows:
+        invalidation._handle_message(json.dumps(row))
+    assert cache.catalog.get("p2") is None
+
+
+class RecordingConnection:
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.calls = []
+
+    def execute(self, statement, params=None):
+        if self.fail:
+            raise ConnectionError("listener connection lost")
+        self.calls.append((str(statement), params))
+
+
+def test_notify_sends_one_statement_per_batch(monkeypatch):
+    monkeypatch.setattr(invalidation, "MAX_PAYLOAD_BYTES", 8)  # one key per message
+    bus = invalidation.InvalidationBus(database.engine, mode="notify")
+    bus._outgoing.put({("catalog", "p1"), ("catalog", "p2")})
+    bus._outgoing.put({("catalog_lists", None)})
+    conn = RecordingConnection()
+
+    bus._publish(conn)
+
+    [(statement, params)] = conn.calls
+    assert statement.count("pg_notify(") == 3
+    assert params["channel"] == invalidation.CHANNEL
+    bus._publish(conn)
+    assert len(conn.calls) == 1  # nothing new to send
+
+
+def test_failed_send_is_retried():
+    bus = invalidation.InvalidationBus(database.engine, mode="notify")
+    bus._outgoing.put({("catalog", "p1")})
+
+    with pytest.raises(ConnectionError):
+        bus._publish(RecordingConnection(fail=True))
+    conn = RecordingConnection()
+    bus._publish(conn)
+    assert "p1" in json.dumps(conn.calls[0][1])
@@ -0,0 +1,61 @@
+# tests/test_inventory.py
+from sqlalchemy import event
+
+import crud
+import database
+import models
+import schemas
+from conftest import ADMIN_HEADERS, add_product
+
+
+def adjustment(product_id: str, size: str, delta=None, absolute=None) -> schemas.InventoryAdjustment:
+    return schemas.InventoryAdjustment(product_id=product_id, size=size, delta=delta, absolute=absolute)
+
+
+def test_adjustments_apply_and_reject_negative_stock(db):
+    add_product(db, "p1", stock=5)
+    add_product(db, "p2", stock=5)
+
+    applied, rejected = crud.adjust_inventory(db, [
+        adjustment("p1", "M", delta=3),
+        adjustment("p2", "S", absolute=1),
+        adjustment("p2", "L", delta=-6),
+        adjustment("missing", "M", delta=1),
+    ])
+
+    assert applied == 2
+    assert [(r.product_id, r.reason) for r in rejected] == [
+        ("p2", "Stock would go negative"), ("missing", "Product not found"),
+    ]
+    db.expire_all()
+    assert db.get(models.Product, "p1").M_stock == 8
+    assert db.get(models.Product, "p2").S_stock == 1
+
+
+def test_rows_are_locked_in_id_order(db):
+    for pid in ("p3", "p1", "p2"):
+        add_product(db, pid)
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().startswith("SELECT") and "FROM products" in statement:
+            statements.append(statement)
+
+    event.listen(database.engine, "before_cursor_execute", capture)
+    try:
+        crud.adjust_inventory(db, [adjustment(pid, "M", delta=1) for pid in ("p3", "p1", "p2")])
+    finally:
+        event.remove(database.engine, "before_cursor_execute", capture)
+
+    assert statements and all("ORDER BY products.id" in s for s in statements)
+
+
+def test_endpoint_needs_the_admin_token(client, db):
+    add_product(db, "p1", stock=5)
+    body = {"adjustments": [{"product_id": "p1", "size": "M", "delta": 2}]}
+
+    assert client.post("/inventory/adjust", json=body).status_code == 403
+    response = client.post("/inventory/adjust", json=body, headers=ADMIN_HEADERS)
+    assert response.json() == {"applied": 1, "rejected": []}
+    db.expire_all()
+    assert db.get(models.Product, "p1").M_stock == 7
@@ -0,0 +1,120 @@
+# tests/test_jwks.py
+import json
+import threading
+import time
+
+import pytest
+import rsa
+from jose import jwk, jwt
+
+import auth
+import jwks
+from conftest import add_user
+
+
+def make_key(kid: str):
+    _, private = rsa.newkeys(1024)
+    pem = private.save_pkcs1().decode()
+    public = jwk.construct(pem, "RS256").public_key().to_dict()
+    public["kid"] = kid
+    return pem, public
+
+
+@pytest.fixture(scope="module")
+def keys():
+    return {kid: make_key(kid) for kid in ("k1", "k2")}
+
+
+def write_jwks(path, keys, kids):
+    path.write_text(json.dumps({"keys": [keys[kid][1] for kid in kids]}))
+
+
+def rs256_token(keys, kid: str, user_id: str = "u1") -> str:
+    return jwt.encode({"sub": user_id, "aud": "authenticated"}, keys[kid][0], algorithm="RS256", headers={"kid": kid})
+
+
+def wait_for_refresh(cache: jwks.JWKSCache, timeout: float = 5):
+    deadline = time.monotonic() + timeout
+    while cache._refreshing:
+        assert time.monotonic() < deadline, "refresh never finished"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def jwks_file(tmp_path, keys, monkeypatch):
+    path = tmp_path / "jwks.json"
+    write_jwks(path, keys, ["k1"])
+    monkeypatch.setenv("SUPABASE_JWKS_FILE", str(path))
+    cache = jwks.from_env()
+    cache.refresh()
+    monkeypatch.setattr(auth, "jwks_cache", cache)
+    return path
+
+
+def test_token_signed_with_a_known_key_is_accepted(client, db, keys, jwks_file):
+    add_user(db, "u1")
+    headers = {"Authorization": f"Bearer {rs256_token(keys, 'k1')}"}
+
+    assert auth.decode_token(rs256_token(keys, "k1"), audience="authenticated")["sub"] == "u1"
+    assert client.get("/users/u1/summary", headers=headers).status_code == 200
+
+
+def test_unknown_kid_is_rejected_without_waiting_for_the_fetch(keys, jwks_file):
+    cache = auth.jwks_cache
+    cache._attempted_at = 0.0
+    release = threading.Event()
+    load = cache._load
+
+    def slow_load():
+        release.wait(5)
+        return load()
+
+    cache._load = slow_load
+    write_jwks(jwks_file, keys, ["k1", "k2"])
+
+    started = time.monotonic()
+    assert cache.get_key("k2") is None
+    assert cache.get_key("k2") is None  # while the refetch runs
+    assert time.monotonic() - started < 1
+
+    release.set()
+    wait_for_refresh(cache)
+    assert cache.get_key("k2") == keys["k2"][1]
+
+
+def test_unknown_kid_refetches_at_most_once_per_interval(keys, jwks_file):
+    cache = auth.jwks_cache
+    calls = []
+    load = cache._load
+
+    def counting_load():
+        calls.append(1)
+        return load()
+
+    cache._load = counting_load
+    cache._attempted_at = 0.0
+    for _ in range(5):
+        cache.get_key("missing")
+        wait_for_refresh(cache)
+    assert len(calls) == 1
+
+
+def test_rotated_key_is_unauthorized_until_the_refetch_lands(client, db, keys, jwks_file):
+    add_user(db, "u1")
+    cache = auth.jwks_cache
+    cache._attempted_at = 0.0
+    release = threading.Event()
+    load = cache._load
+
+    def slow_load():
+        release.wait(5)
+        return load()
+
+    cache._load = slow_load
+    write_jwks(jwks_file, keys, ["k2"])
+    headers = {"Authorization": f"Bearer {rs256_token(keys, 'k2')}"}
+
+    assert client.get("/users/u1/summary", headers=headers).status_code == 401
+    release.set()
+    wait_for_refresh(cache)
+    assert client.get("/users/u1/summary", headers=headers).status_code == 200
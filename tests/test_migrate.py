@@ -0,0 +1,92 @@
+# tests/test_migrate.py
+from datetime import date
+
+import pytest
+from sqlalchemy import inspect, text
+
+import crud
+import database
+import migrate
+import models
+from conftest import add_product, add_user
+
+
+def index_names(table: str) -> set:
+    return {index["name"] for index in inspect(database.engine).get_indexes(table)}
+
+
+def test_migration_adds_missing_indexes_and_backfills(db):
+    add_user(db, "u1")
+    add_product(db, "p1")
+    db.add(models.Order(user_id="u1", status="shipped", time=date(2026, 10, 1)))
+    db.add(models.StockShard(product_id="p1", size="M", shard=0, available=1))
+    db.commit()
+    with database.engine.begin() as conn:
+        conn.execute(text("DROP INDEX ix_orders_status_rank_time_id"))
+        conn.execute(text("UPDATE products SET stock_sharded = 0"))
+
+    migrate.migrate()
+    migrate.migrate()  # a second run finds nothing left to do
+
+    assert "ix_orders_status_rank_time_id" in index_names("orders")
+    db.expire_all()
+    assert db.query(models.Order).one().status_rank == crud.order_status_rank("shipped")
+    assert db.get(models.Product, "p1").stock_sharded is True
+
+
+def test_backfills_leave_filled_rows_alone(db):
+    add_user(db, "u1")
+    db.add(models.Order(user_id="u1", status="shipped", status_rank=0, time=date(2026, 10, 1)))
+    db.commit()
+
+    crud.backfill_order_status_rank(db)
+    db.expire_all()
+    assert db.query(models.Order).one().status_rank == 0
+
+
+def test_failed_index_fails_the_migration(monkeypatch):
+    def broken(index):
+        raise RuntimeError("cannot build")
+
+    monkeypatch.setattr(database, "create_index", broken)
+    with pytest.raises(RuntimeError, match="Schema sync failed"):
+        migrate.migrate()
+
+
+def test_duplicate_reviews_are_removed_before_the_unique_index(db):
+    add_user(db, "u1")
+    add_user(db, "u2")
+    add_product(db, "p1")
+    with database.engine.begin() as conn:
+        conn.execute(text("DROP INDEX uq_reviews_user_product"))
+    for user_id, stars in (("u1", 1), ("u1", 5), ("u2", 4)):
+        db.add(models.Review(user_id=user_id, product_id="p1", stars=stars, text="", time=date(2026, 10, 1)))
+    db.add(models.ProductReviewStats(product_id="p1", stars_1=1, stars_4=1, stars_5=1))
+    db.commit()
+
+    migrate.migrate()
+
+    assert "uq_reviews_user_product" in index_names("reviews")
+    db.expire_all()
+    assert sorted((r.user_id, r.stars) for r in db.query(models.Review)) == [("u1", 5), ("u2", 4)]
+    stats = db.get(models.ProductReviewStats, "p1")
+    assert (stats.stars_1, stats.stars_4, stats.stars_5) == (0, 1, 1)
+
+
+def test_unique_index_that_cannot_be_built_fails_the_migration(db, monkeypatch):
+    add_user(db, "u1")
+    add_product(db, "p1")
+    with database.engine.begin() as conn:
+        conn.execute(text("DROP INDEX uq_reviews_user_product"))
+    for stars in (1, 5):
+        db.add(models.Review(user_id="u1", product_id="p1", stars=stars, text="", time=date(2026, 10, 1)))
+    db.commit()
+    # A duplicate that slips in after the dedupe step
+    monkeypatch.setattr(crud, "dedupe_reviews", lambda session: 0)
+
+    with pytest.raises(RuntimeError, match="uq_reviews_user_product"):
+        migrate.migrate()
+
+    monkeypatch.undo()
+    migrate.migrate()
+    assert "uq_reviews_user_product" in index_names("reviews")
@@ -0,0 +1,110 @@
+# tests/test_order_summary.py
+from sqlalchemy import insert
+
+import crud
+import models
+import schemas
+from conftest import add_product, add_user, auth_headers
+
+
+def checkout(db, user_id: str, product_id: str, size: str, quantity: int, day: int):
+    crud.add_to_cart(db, schemas.CartCreate(user_id=user_id, product_id=product_id, size=size, quantity=quantity))
+    crud.create_order_from_cart(db, schemas.OrderCreate(user_id=user_id, order_time=f"2026-10-{day:02d}T00:00:00Z"))
+    return db.query(models.Order.id).filter(models.Order.user_id == user_id).order_by(models.Order.id.desc()).first().id
+
+
+def summary_row(db, user_id: str):
+    db.expire_all()
+    return db.get(models.UserOrderSummary, user_id)
+
+
+def test_summary_follows_checkout_and_status_changes(client, db):
+    add_user(db, "u1")
+    add_product(db, "p1", price=100)
+    add_product(db, "p2", price=50)
+    first = checkout(db, "u1", "p1", "M", 2, day=10)
+    second = checkout(db, "u1", "p2", "S", 1, day=12)
+
+    crud.update_order_status(db, first, "cancelled")
+    crud.bulk_update_order_status(db, [second, 999], "shipped")
+
+    summary = client.get("/users/u1/summary", headers=auth_headers("u1")).json()
+    assert summary["order_count"] == 2
+    assert summary["status_counts"]["cancelled"] == 1 and summary["status_counts"]["shipped"] == 1
+    assert summary["status_counts"]["pending"] == 0
+    assert summary["lifetime_total"] == 50
+    assert (summary["last_order_id"], summary["last_order_status"]) == (second, "shipped")
+
+    crud.update_order_status(db, first, "pending")
+    assert summary_row(db, "u1").lifetime_total == 250
+
+
+def test_summary_totals_use_the_price_charged_at_checkout(client, db):
+    add_user(db, "u1")
+    add_product(db, "p1", price=100)
+    order_id = checkout(db, "u1", "p1", "M", 2, day=10)
+
+    crud.update_product(db, "p1", schemas.ProductUpdate(M_price=500))
+    db.query(models.UserOrderSummary).delete()
+    db.commit()
+
+    summary = client.get("/users/u1/summary", headers=auth_headers("u1")).json()
+    assert summary["lifetime_total"] == 200
+    # Order views still price lines at today's size price
+    order = client.get("/users/u1/orders", headers=auth_headers("u1")).json()[0]
+    assert (order["order_id"], order["total_price"]) == (order_id, 1000)
+
+
+def test_summary_read_does_not_write(client, db):
+    add_user(db, "u1")
+    add_product(db, "p1", price=100)
+    checkout(db, "u1", "p1", "M", 1, day=10)
+    db.query(models.UserOrderSummary).delete()
+    db.commit()
+
+    summary = client.get("/users/u1/summary", headers=auth_headers("u1")).json()
+    assert (summary["order_count"], summary["lifetime_total"]) == (1, 100)
+    assert summary_row(db, "u1") is None
+
+    add_user(db, "u2")
+    empty = client.get("/users/u2/summary", headers=auth_headers("u2")).json()
+    assert empty["order_count"] == 0 and empty["last_order_id"] is None
+    assert client.get("/users/u1/summary", headers=auth_headers("u2")).status_code == 403
+
+
+def test_backfill_race_still_counts_the_new_order(db, monkeypatch):
+    add_user(db, "u1")
+    add_product(db, "p1", price=100)
+    checkout(db, "u1", "p1", "M", 1, day=10)
+    db.query(models.UserOrderSummary).delete()
+    db.commit()
+    compute = crud._compute_user_order_summary
+
+    def concurrent_backfill(session, user_id):
+        summary = compute(session, user_id)
+        # Another request committed its backfill first; it could not see our uncommitted order
+        session.execute(insert(models.UserOrderSummary).values(
+            user_id=user_id, order_count=1, pending_count=1, processing_count=0, shipped_count=0,
+            delivered_count=0, cancelled_count=0, other_count=0, lifetime_total=100,
+        ))
+        return summary
+
+    monkeypatch.setattr(crud, "_compute_user_order_summary", concurrent_backfill)
+    checkout(db, "u1", "p1", "M", 1, day=11)
+
+    summary = summary_row(db, "u1")
+    assert (summary.order_count, summary.pending_count, summary.lifetime_total) == (2, 2, 200)
+
+
+def test_status_change_backfills_with_the_old_status(db):
+    add_user(db, "u1")
+    add_product(db, "p1", price=100)
+    order_id = checkout(db, "u1", "p1", "M", 1, day=10)
+    db.query(models.UserOrderSummary).delete()
+    db.commit()
+
+    crud.update_order_status(db, order_id, "delivered")
+
+    summary = summary_row(db, "u1")
+    assert (summary.pending_count, summary.delivered_count, summary.order_count) == (0, 1, 1)
+    assert summary.last_order_status == "delivered"
@@ -0,0 +1,141 @@
+# tests/test_products.py
+import json
+from datetime import date
+
+import pytest
+from sqlalchemy.exc import OperationalError
+
+import crud
+import database
+import main
+import models
+import schemas
+from conftest import add_product, add_user
+
+
+def test_card_view_matches_its_schema(client, db):
+    add_product(db, "p1", price=100)
+
+    [card] = client.get("/products?view=card").json()
+    assert card == {
+        "id": "p1", "name": "P1", "image": "image.png", "discount": 0,
+        "min_price": 100, "average_rating": 0.0, "total_reviews": 0,
+    }
+    assert set(card) == set(schemas.ProductCard.model_fields)
+
+
+def test_fields_projection_returns_only_the_requested_keys(client, db):
+    add_product(db, "p1", stock=3, price=80)
+
+    response = client.get("/products?fields=name,M_stock,min_price")
+    assert response.status_code == 200
+    assert response.json() == [{"id": "p1", "name": "P1", "M_stock": 3, "min_price": 80}]
+    schemas.ProductProjection.model_validate(response.json()[0])
+
+
+def test_unknown_projection_is_rejected(client):
+    assert client.get("/products?fields=name,password").status_code == 400
+    assert client.get("/products?view=poster").status_code == 400
+
+
+def test_full_products_by_default(client, db):
+    add_product(db, "p1")
+
+    [product] = client.get("/products").json()
+    assert set(product) == set(schemas.ProductResponse.model_fields)
+
+
+def test_batch_keeps_request_order_and_flags_missing_ids(client, db):
+    add_product(db, "p1")
+    add_product(db, "p2")
+
+    response = client.get("/products/batch?ids=p2,missing,p1&fields=name")
+    assert response.status_code == 200
+    assert response.json() == [
+        {"id": "p2", "found": True, "product": {"id": "p2", "name": "P2"}},
+        {"id": "missing", "found": False, "product": None},
+        {"id": "p1", "found": True, "product": {"id": "p1", "name": "P1"}},
+    ]
+
+
+def test_batch_with_full_products(client, db):
+    add_product(db, "p1")
+
+    [found, missing] = client.get("/products/batch?ids=p1,nope").json()
+    assert found["found"] is True and set(found["product"]) == set(schemas.ProductResponse.model_fields)
+    assert missing == {"id": "nope", "found": False, "product": None}
+
+
+def add_catalog(db, count: int):
+    add_user(db, "u1")
+    for i in range(count):
+        db.add(models.Product(
+            id=f"p{i:04d}", name=f"Product {i}", image="image.png", collection="summer", category="lawn",
+            discount=i % 30, images='["a.png", "b.png"]', colors='["red"]', archived=(i % 50 == 0),
+            **{f"{size}_price": 100 + i for size in ("XS", "S", "M", "L", "XL", "XXL")},
+            **{f"{size}_stock": i % 7 for size in ("XS", "S", "M", "L", "XL", "XXL")},
+        ))
+    db.flush()
+    for i in range(0, count, 3):
+        db.add(models.Review(user_id="u1", product_id=f"p{i:04d}", stars=1 + i % 5, time=date(2026, 10, 1)))
+    db.commit()
+
+
+@pytest.fixture
+def small_stream_batches(monkeypatch):
+    """Several fetch batches and chunks even for a few hundred rows."""
+    iter_products = crud.iter_products
+    monkeypatch.setattr(crud, "iter_products", lambda db, fields=None: iter_products(db, fields, batch_size=40))
+    monkeypatch.setattr(main, "STREAM_CHUNK_BYTES", 2048)
+
+
+@pytest.mark.parametrize("query", ["", "view=card", "fields=name,colors,min_price,M_stock"])
+def test_stream_matches_the_buffered_response(client, db, small_stream_batches, query):
+    add_catalog(db, 300)
+
+    buffered = client.get(f"/products?{query}").json()
+    streamed = client.get(f"/products?stream=true&{query}")
+
+    assert streamed.status_code == 200
+    assert streamed.headers["content-type"] == "application/json"
+    assert len(buffered) == 294  # archived products are left out
+    by_id = lambda product: product["id"]
+    assert sorted(streamed.json(), key=by_id) == sorted(buffered, key=by_id)
+
+
+def test_database_error_mid_stream_truncates_and_cleans_up(client, db, monkeypatch):
+    add_catalog(db, 100)
+    iter_products = crud.iter_products
+
+    def failing(session, fields=None):
+        for n, product in enumerate(iter_products(session, fields)):
+            if n == 60:
+                raise OperationalError("SELECT", {}, Exception("server closed the connection"))
+            yield product
+
+    sessions = []
+    session_factory = database.SessionLocal
+
+    def tracking_session():
+        session = session_factory()
+        sessions.append(session)
+        return session
+
+    monkeypatch.setattr(crud, "iter_products", failing)
+    monkeypatch.setattr(main, "STREAM_CHUNK_BYTES", 1024)
+    monkeypatch.setattr(database, "SessionLocal", tracking_session)
+    free_slots = main.concurrency_gate._semaphore._value
+
+    with pytest.raises(OperationalError):
+        client.get("/products?stream=true&view=card")
+    assert main.concurrency_gate._semaphore._value == free_slots
+    assert sessions and all(not session.in_transaction() for session in sessions)
+
+    # What a client receives before the error: whole objects, and no closing bracket
+    chunks = []
+    with pytest.raises(OperationalError):
+        for chunk in main.stream_products_json(crud.PRODUCT_VIEWS["card"]):
+            chunks.append(chunk)
+    body = "".join(chunks)
+    assert body.startswith("[") and not body.endswith("]")
+    assert 0 < len(json.loads(body + "]")) < 60
@@ -0,0 +1,34 @@
+# tests/test_profiler.py
+import threading
+import time
+
+import profiler
+
+
+def busy(stop: threading.Event):
+    while not stop.is_set():
+        sum(range(1000))
+
+
+def test_profile_is_labelled_process_wide(tmp_path, monkeypatch):
+    monkeypatch.setattr(profiler, "PROFILE_DIR", str(tmp_path))
+    monkeypatch.setattr(profiler, "PROFILE_ALLOCATIONS", False)
+    stop = threading.Event()
+    other = threading.Thread(target=busy, args=(stop,), name="other-request")
+    other.start()
+    try:
+        with profiler.try_profile("GET", "/products") as profile:
+            deadline = time.monotonic() + 0.2
+            while time.monotonic() < deadline:
+                sum(range(1000))
+    finally:
+        stop.set()
+        other.join()
+
+    roots = {stack.split(";")[0] for stack in profile.sampler.samples}
+    assert "MainThread [profiled request]" in roots
+    assert "other-request" in roots
+
+    [summary] = tmp_path.glob("*.txt")
+    assert "scope: process-wide" in summary.read_text()
+    assert not profiler._busy.locked()
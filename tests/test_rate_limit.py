@@ -0,0 +1,104 @@
+# tests/test_rate_limit.py
+import asyncio
+
+import pytest
+from starlette.responses import StreamingResponse
+
+import main
+import rate_limit
+
+
+def test_backend_is_abstract():
+    with pytest.raises(TypeError):
+        rate_limit.RateLimitBackend()
+
+    class Incomplete(rate_limit.RateLimitBackend):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_token_bucket_allows_burst_then_limits():
+    backend = rate_limit.InMemoryBackend()
+    results = [backend.take("k", capacity=3, rate=0.001)[0] for _ in range(4)]
+    assert results == [True, True, True, False]
+    allowed, retry_after = backend.take("k", capacity=3, rate=0.001)
+    assert not allowed and retry_after > 0
+
+
+def test_requests_over_budget_get_429(client, monkeypatch):
+    monkeypatch.setitem(rate_limit._budgets, "catalog", (2, 0.001))
+    codes = [client.get("/products/batch?ids=p1").status_code for _ in range(3)]
+    assert codes[:2] == [200, 200]
+    assert codes[2] == 429
+
+
+def test_requests_are_shed_when_gate_is_full(client, monkeypatch):
+    async def no_slot():
+        return False
+
+    monkeypatch.setattr(main.concurrency_gate, "acquire", no_slot)
+    response = client.get("/products/batch?ids=p1")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "1"
+
+
+def test_gate_slot_is_held_until_stream_finishes():
+    async def scenario():
+        gate = rate_limit.ConcurrencyGate(1)
+        assert await gate.acquire()
+        held_while_streaming = []
+
+        async def body():
+            for chunk in (b"[", b"]"):
+                held_while_streaming.append(gate._semaphore.locked())
+                yield chunk
+
+        wrapped = rate_limit.ReleaseAfterSend(StreamingResponse(body()), gate.release)
+        sent = []
+
+        async def receive():
+            return {"type": "http.request"}
+
+        async def send(message):
+            sent.append(message)
+
+        await wrapped({"type": "http", "asgi": {"spec_version": "2.4"}}, receive, send)
+        return gate, held_while_streaming, sent
+
+    gate, held_while_streaming, sent = asyncio.run(scenario())
+    assert held_while_streaming == [True, True]
+    assert not gate._semaphore.locked()
+    assert sent[-1] == {"type": "http.response.body", "body": b"", "more_body": False}
+
+
+def test_gate_slot_is_released_when_sending_fails():
+    async def scenario():
+        gate = rate_limit.ConcurrencyGate(1)
+        assert await gate.acquire()
+
+        async def body():
+            yield b"["
+            raise RuntimeError("database went away mid-stream")
+
+        wrapped = rate_limit.ReleaseAfterSend(StreamingResponse(body()), gate.release)
+
+        async def receive():
+            return {"type": "http.request"}
+
+        async def send(message):
+            pass
+
+        with pytest.raises(RuntimeError):
+            await wrapped({"type": "http", "asgi": {"spec_version": "2.4"}}, receive, send)
+        return gate
+
+    assert not asyncio.run(scenario())._semaphore.locked()
+
+
+def test_streamed_catalog_returns_its_gate_slot(client):
+    response = client.get("/products?stream=true")
+    assert response.status_code == 200
+    assert response.json() == []
+    assert main.concurrency_gate._semaphore._value == main.concurrency_gate.limit
@@ -0,0 +1,107 @@
+# tests/test_reviews.py
+from datetime import date
+
+from sqlalchemy import insert
+
+import crud
+import models
+import schemas
+from conftest import add_product, add_user, auth_headers
+
+
+def review(user_id: str, product_id: str, stars: float) -> schemas.ReviewCreate:
+    return schemas.ReviewCreate(user_id=user_id, product_id=product_id, stars=stars, time="2026-10-01T00:00:00Z")
+
+
+def add_legacy_review(db, user_id: str, product_id: str, stars: float):
+    """A review written before the histogram counters existed."""
+    db.add(models.Review(user_id=user_id, product_id=product_id, stars=stars, time=date(2026, 9, 1)))
+    db.commit()
+
+
+def stats_row(db, product_id: str):
+    db.expire_all()
+    return db.get(models.ProductReviewStats, product_id)
+
+
+def test_first_write_backfills_counters(db):
+    add_user(db, "u1")
+    add_user(db, "u2")
+    add_product(db, "p1")
+    add_legacy_review(db, "u1", "p1", 4)
+
+    crud.create_review(db, review("u2", "p1", 5))
+
+    stats = stats_row(db, "p1")
+    assert (stats.stars_4, stats.stars_5) == (1, 1)
+
+
+def test_backfill_race_still_counts_the_new_review(db, monkeypatch):
+    add_user(db, "u1")
+    add_user(db, "u2")
+    add_product(db, "p1")
+    add_legacy_review(db, "u1", "p1", 4)
+    count_stars = crud._count_review_stars
+
+    def concurrent_backfill(session, product_id):
+        counts = count_stars(session, product_id)
+        # Another request committed its backfill first; it could not see our uncommitted review
+        session.execute(insert(models.ProductReviewStats).values(
+            product_id=product_id, stars_1=0, stars_2=0, stars_3=0, stars_4=1, stars_5=0
+        ))
+        return counts
+
+    monkeypatch.setattr(crud, "_count_review_stars", concurrent_backfill)
+    crud.create_review(db, review("u2", "p1", 5))
+
+    stats = stats_row(db, "p1")
+    assert (stats.stars_4, stats.stars_5) == (1, 1)
+
+
+def test_histogram_read_does_not_write(db):
+    add_user(db, "u1")
+    add_product(db, "p1")
+    add_legacy_review(db, "u1", "p1", 2)
+
+    assert crud.get_review_histogram(db, "p1") == {"1": 0, "2": 1, "3": 0, "4": 0, "5": 0}
+    assert stats_row(db, "p1") is None
+    assert crud.get_review_histogram(db, "p2") == {str(i): 0 for i in range(1, 6)}
+
+
+def test_reviews_endpoint_keeps_list_shape_by_default(client, db):
+    for i in range(3):
+        add_user(db, f"u{i}")
+    add_product(db, "p1")
+    for i, stars in enumerate((3, 4, 5)):
+        add_legacy_review(db, f"u{i}", "p1", stars)
+
+    response = client.get("/products/p1/reviews")
+    assert response.status_code == 200
+    assert isinstance(response.json(), list) and len(response.json()) == 3
+
+    first = client.get("/products/p1/reviews?paged=true&limit=2&histogram=true").json()
+    assert len(first["reviews"]) == 2 and first["next_cursor"]
+    assert first["histogram"]["5"] == 1
+    second = client.get(f"/products/p1/reviews?limit=2&cursor={first['next_cursor']}").json()
+    assert len(second["reviews"]) == 1 and second["next_cursor"] is None
+
+    assert client.get("/products/p2/reviews").status_code == 404
+
+
+def test_duplicate_review_is_rejected(client, db):
+    add_user(db, "u1")
+    add_product(db, "p1")
+    body = {"user_id": "u1", "product_id": "p1", "stars": 4, "time": "2026-10-01T00:00:00Z"}
+
+    assert client.post("/reviews/", json=body, headers=auth_headers("u1")).status_code == 200
+    response = client.post("/reviews/", json=body, headers=auth_headers("u1"))
+    assert response.status_code == 400
+    assert response.json()["detail"] == "You have already reviewed this product"
+
+
+def test_review_of_unknown_product_is_404(client, db):
+    add_user(db, "u1")
+    body = {"user_id": "u1", "product_id": "missing", "stars": 4, "time": "2026-10-01T00:00:00Z"}
+
+    response = client.post("/reviews/", json=body, headers=auth_headers("u1"))
+    assert response.status_code == 404
@@ -0,0 +1,28 @@
+# tests/test_slow_query.py
+import slow_query
+
+
+def test_same_statement_is_explained_once_per_cooldown():
+    log = slow_query.SlowQueryLog()
+    assert log._claim_explain("a")
+    assert not log._claim_explain("a")
+
+
+def test_fingerprints_are_bounded():
+    log = slow_query.SlowQueryLog(max_fingerprints=100)
+    for i in range(1000):
+        assert log._claim_explain(f"statement-{i}")
+    assert len(log._explained_at) <= 100
+    assert "statement-999" in log._explained_at
+
+
+def test_expired_fingerprints_are_pruned(monkeypatch):
+    log = slow_query.SlowQueryLog()
+    now = [1000.0]
+    monkeypatch.setattr(slow_query.time, "monotonic", lambda: now[0])
+    for i in range(10):
+        log._claim_explain(f"statement-{i}")
+
+    now[0] += slow_query.EXPLAIN_COOLDOWN + 1
+    assert log._claim_explain("statement-0")
+    assert list(log._explained_at) == ["statement-0"]
@@ -0,0 +1,99 @@
+# tests/test_stock.py
+import crud
+import models
+import schemas
+from conftest import ADMIN_HEADERS, CRON_HEADERS, add_product
+
+
+def product_create(product_id: str, stock: float) -> schemas.ProductCreate:
+    return schemas.ProductCreate(
+        id=product_id, name=product_id.upper(), image="image.png", collection="summer", category="lawn",
+        **{f"{size}_price": 100 for size in crud.SIZES},
+        **{f"{size}_stock": stock for size in crud.SIZES},
+    )
+
+
+def shard_total(db, product_id: str, size: str) -> float:
+    return sum(
+        s.available for s in db.query(models.StockShard)
+        .filter(models.StockShard.product_id == product_id, models.StockShard.size == size)
+    )
+
+
+def test_catalog_counts_shard_stock(client, db):
+    add_product(db, "p1", stock=8)
+    assert client.post("/admin/stock/shards", json={"product_id": "p1", "size": "M", "shards": 4},
+                       headers=ADMIN_HEADERS).status_code == 200
+
+    db.expire_all()
+    assert db.get(models.Product, "p1").stock_sharded
+    assert shard_total(db, "p1", "M") == 8
+    product = client.get("/product/p1").json()
+    assert (product["M_stock"], product["S_stock"]) == (8, 8)
+
+
+def test_bulk_upsert_folds_shards_first(client, db):
+    add_product(db, "p1", stock=8)
+    crud.shard_sku(db, "p1", "M", 4)
+
+    crud.upsert_products(db, [product_create("p1", stock=3)])
+
+    db.expire_all()
+    assert shard_total(db, "p1", "M") == 0
+    assert client.get("/product/p1").json()["M_stock"] == 3
+
+
+def test_reservations_never_oversell_a_sharded_sku(db):
+    add_product(db, "p1", stock=10)
+    crud.shard_sku(db, "p1", "M", 4)
+
+    taken = 0
+    while crud.reserve_stock(db, "p1", "M", 3, "test"):
+        taken += 3
+        db.commit()
+    db.commit()
+
+    db.expire_all()
+    assert taken == 9
+    assert db.get(models.Product, "p1").M_stock + shard_total(db, "p1", "M") == 1
+    # A failed reservation takes nothing
+    assert crud.reserve_stock(db, "p1", "M", 1, "test")
+
+
+def test_unshard_clears_the_flag_once_no_size_is_sharded(db):
+    add_product(db, "p1", stock=8)
+    crud.shard_sku(db, "p1", "M", 2)
+    crud.shard_sku(db, "p1", "L", 2)
+
+    crud.unshard_sku(db, "p1", "M")
+    db.expire_all()
+    product = db.get(models.Product, "p1")
+    assert product.stock_sharded and product.M_stock == 8
+
+    crud.unshard_sku(db, "p1", "L")
+    db.expire_all()
+    product = db.get(models.Product, "p1")
+    assert not product.stock_sharded and product.L_stock == 8
+
+
+def test_stock_movements_are_logged(db):
+    add_product(db, "p1", stock=5)
+    assert crud.reserve_stock(db, "p1", "S", 2, "cart")
+    crud.release_stock(db, "p1", "S", 2, "cart_remove")
+    db.commit()
+
+    deltas = [m.delta for m in db.query(models.StockMovement).order_by(models.StockMovement.id)]
+    assert deltas == [-2, 2]
+
+
+def test_cron_compacts_with_the_cron_secret(client, db):
+    add_product(db, "p1", stock=8)
+    crud.shard_sku(db, "p1", "M", 4)
+
+    assert client.get("/admin/stock/compact").status_code == 403
+    assert client.get("/admin/stock/compact", headers=ADMIN_HEADERS).status_code == 403
+    assert client.get("/admin/stock/compact", headers={"Authorization": "Bearer wrong"}).status_code == 403
+
+    response = client.get("/admin/stock/compact", headers=CRON_HEADERS)
+    assert response.status_code == 200
+    assert response.json() == {"rebalanced": 1, "pruned": 0}